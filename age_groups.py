@@ -0,0 +1,101 @@
+################################################################################
+#  Here we split the stars into age groups. Given the age of every star and
+#  the list of the groups' delimiters (e.g.  age_bins_separator = [1, 3]), we
+#  find the group of each star with a single pass and then sort the stars by
+#  group, so that each group is a slice of one array of row indices.
+#  The row indices can be used with every column of the catalog.
+################################################################################
+
+
+
+import numpy as np
+
+
+
+def assign_age_groups(age, age_bins_separator):
+    """Return the age group (0, 1, ..., len(age_bins_separator)) of each star.
+
+    Group 0 holds the stars with  t < age_bins_separator[0] , group i the
+    stars with  age_bins_separator[i-1] <= t < age_bins_separator[i]  and the
+    last group the stars with  t >= age_bins_separator[-1] .
+    """
+    group_of_star = np.searchsorted(np.asarray(age_bins_separator), age,
+                                    side='right')
+
+    # Small integer types let the stable sort below use a radix sort, which
+    # takes linear time.
+    return group_of_star.astype(np.min_scalar_type(len(age_bins_separator)))
+
+
+def fine_age_separators(age_bins_separator, age_bins_edges):
+    """Return the delimiters of the fine age bins: the ages of both lists,
+    sorted. The fine bins are found as the age groups (see
+    assign_age_groups() ) with these delimiters, and every age group of
+    age_bins_separator  is made of whole fine bins."""
+    return np.union1d(np.asarray(age_bins_separator, dtype=float),
+                      np.asarray(age_bins_edges, dtype=float))
+
+
+def groups_of_fine_bins(fine_separators, age_bins_separator):
+    """Return the age group of each fine bin (see  fine_age_separators() ).
+
+    Raises ValueError if a delimiter of the age groups is not one of the
+    fine bins' delimiters: then a fine bin is split between two groups.
+    """
+    if not np.all(np.isin(np.asarray(age_bins_separator, dtype=float), fine_separators)):
+        raise ValueError('the age groups {} are not made of whole fine age bins, '
+                         'delimited by {}'.format(list(age_bins_separator),
+                                                  list(fine_separators)))
+    # Each fine bin is in the group of its lower delimiter.
+    lower_delimiters = np.concatenate(([-np.inf], fine_separators))
+    return assign_age_groups(lower_delimiters, age_bins_separator)
+
+
+def partition_by_age(age, age_bins_separator):
+    """Return a list with the row indices of the stars in each age group.
+
+    The lists are slices (views) of one array, and within each group the stars
+    keep the order they have in the catalog.
+    """
+    return partition_groups(assign_age_groups(age, age_bins_separator),
+                            len(age_bins_separator) + 1)
+
+
+def partition_groups(group_of_star, num_of_groups):
+    """Same as  partition_by_age() , given the group of each star."""
+    return split_order(*sort_by_group(group_of_star, num_of_groups))
+
+
+def sort_by_group(group_of_star, num_of_groups):
+    """Return the row indices sorted by group and the number of stars per group.
+
+    These two arrays describe the whole partition, see  split_order() .
+    """
+    order = np.argsort(group_of_star, kind='stable')
+    sizes = np.bincount(group_of_star, minlength=num_of_groups)
+    return order, sizes
+
+
+def split_order(order, sizes):
+    """Return the list of the row indices of each group (views of  order )."""
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    return [order[bounds[i]:bounds[i+1]] for i in range(len(sizes))]
+
+
+def split_column(column, groups):
+    """Return a dict {group number: values of  column  for stars in group}."""
+    return {i: column[rows] for i, rows in enumerate(groups)}
+
+
+def age_group_labels(age_bins_separator):
+    """Return a dict {group number: LaTeX label} of the age groups."""
+    if len(age_bins_separator) == 0:
+        return {0: ' $ t $ '}
+
+    labels = {0: ' $ t < {} $ '.format(age_bins_separator[0])}
+    for i in range(1, len(age_bins_separator)):
+        labels[i] = r' $ {} \leq t < {} $ '.format(age_bins_separator[i-1],
+                                                   age_bins_separator[i])
+    labels[len(age_bins_separator)] = r' $ t \geq {} $ '.format(
+        age_bins_separator[-1])
+    return labels
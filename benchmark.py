@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+
+
+################################################################################
+#  Here we time the stages of plot_stars.py on synthetic catalogs of growing
+#  size, to find out where the time goes and to catch performance regressions.
+#
+#  The synthetic catalogs have the same layout as Nemo_6670.dat (15 space
+#  separated columns and a #header line, the columns we use in the positions
+#  listed in catalog.py), they are written once in a data directory and reused
+#  by the following runs.
+#  For each size we time, separately:
+#    * load           parsing of the text file (catalog.load_catalog)
+#    * cache_build    parsing and writing of the binary cache
+#    * cache_load     reading of the columns from the binary cache
+#    * partition      assignment of the stars to the age groups
+#  and the stages of  plot_stars.compute_figures_data() :
+#    * ranges         ranges of the values and edges of the bins
+#    * histograms_1d  metallicity count cube and moments of figure 2
+#    * histograms_2d  mass-metallicity count cubes of figures 4 and 5 and of
+#                     the density estimate
+#    * counts         both at once, as the script does
+#    * statistics     exact medians of the metallicity (figure 2)
+#    * density        density estimate and contour levels of figure 5
+#    * from_partials  figures' data from the partial results, without and
+#                     (from_partials_bands) with the confidence bands
+#    * contours       polygons of the contours of figure 5
+#    * figures_data   all of the above at once, as the script does
+#  and the figures:
+#    * figure_N       drawing and saving of figure N (figure 5 includes the
+#                     contours)
+#  The results are saved as JSON. When a baseline (the JSON of a previous run)
+#  is given, the script fails if a stage got slower than the threshold.
+################################################################################
+
+
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import matplotlib
+import numpy as np
+
+import age_groups
+import catalog
+import kde
+import plot_stars
+import streaming_stats
+
+
+
+DEFAULT_SIZES = (10**4, 10**5, 10**6, 10**7)
+DEFAULT_DATA_DIR = 'benchmark_data'
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_MIN_SECONDS = 0.01
+
+# Rows written at a time by the generator.
+GENERATOR_CHUNK_ROWS = 1 << 20
+CATALOG_NUM_OF_COLUMNS = 15
+
+
+
+################################################################################
+#  Synthetic catalogs.
+################################################################################
+
+def _synthetic_columns(rng, rows):
+    # A rough imitation of a simulated stellar population: the older stars are
+    # more metal poor, the initial masses follow a power law, and the colour
+    # and magnitude depend on mass and age.
+    age = 13.5 * rng.power(1.5, rows)
+    MsuH = np.clip(0.3 - 0.12*age + rng.normal(0, 0.25, rows), -2.0, 0.7)
+    m_ini = np.clip((0.1**-1.3 - rng.uniform(0, 1, rows)*(0.1**-1.3 - 8.**-1.3))
+                    ** (-1/1.3), 0.1, 8.)
+    M_ass = np.clip(2.5 - 4.*np.log10(m_ini) + 0.1*age + rng.normal(0, 0.4, rows),
+                    -4., 8.4)
+    b_y = np.clip(0.05 + 0.06*M_ass + 0.1*MsuH + rng.normal(0, 0.04, rows),
+                  -0.1, 1.)
+
+    columns = rng.normal(0, 1, (rows, CATALOG_NUM_OF_COLUMNS))
+    for name, values in (('M_ass', M_ass), ('b_y', b_y), ('age_parent', age),
+                         ('MsuH', MsuH), ('m_ini', m_ini)):
+        columns[:, catalog.CATALOG_USECOLS[catalog.CATALOG_COLUMNS.index(name)]] = values
+    return columns
+
+
+def synthetic_catalog_filename(rows, seed, data_dir=DEFAULT_DATA_DIR):
+    return os.path.join(data_dir, 'synthetic_{}_{}.dat'.format(rows, seed))
+
+
+def generate_catalog(data_filename, rows, seed=0):
+    """Write a synthetic catalog of  rows  stars, chunk by chunk."""
+    rng = np.random.default_rng(seed)
+    header = '#' + ' '.join('col{}'.format(i)
+                            for i in range(CATALOG_NUM_OF_COLUMNS))
+    for name, i in zip(catalog.CATALOG_COLUMNS, catalog.CATALOG_USECOLS):
+        header = header.replace('col{} '.format(i), name + ' ', 1)
+
+    # We write to a temporary file and rename it, so that an interrupted run
+    # doesn't leave a truncated catalog behind.
+    with open(data_filename + '.tmp', 'w') as data_file:
+        data_file.write(header + '\n')
+        for start in range(0, rows, GENERATOR_CHUNK_ROWS):
+            np.savetxt(data_file, _synthetic_columns(
+                rng, min(GENERATOR_CHUNK_ROWS, rows - start)),
+                fmt='%.5f', delimiter=' ')
+    os.replace(data_filename + '.tmp', data_filename)
+
+
+def ensure_catalog(rows, seed=0, data_dir=DEFAULT_DATA_DIR):
+    """Return the file name of the synthetic catalog, generating it if needed."""
+    data_filename = synthetic_catalog_filename(rows, seed, data_dir)
+    if not os.path.isfile(data_filename):
+        os.makedirs(data_dir, exist_ok=True)
+        generate_catalog(data_filename, rows, seed)
+    return data_filename
+
+
+
+
+################################################################################
+#  Timing of the stages.
+################################################################################
+
+def time_stage(function, repeat):
+    """Run  function  repeat  times, return the list of the elapsed times and
+    its last result."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def benchmark_catalog(data_filename, repeat=3, figures=plot_stars.FIGURES,
+                      cmd_render='scatter'):
+    """Return a dict {stage: list of elapsed times} for one catalog."""
+    times = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        cache_dir = os.path.join(work_dir, 'cache')
+
+        times['load'], _ = time_stage(
+            lambda: catalog.load_catalog(data_filename), repeat)
+        times['cache_build'], _ = time_stage(
+            lambda: catalog.build_cache(data_filename, cache_dir), repeat)
+        times['cache_load'], data = time_stage(
+            lambda: {name: np.array(column) for name, column in
+                     catalog.open_cache(cache_dir).items()}, repeat)
+
+        age_bins_separator = plot_stars.age_bins_separator
+        num_of_age_groups = len(age_bins_separator) + 1
+
+        # The stages of  plot_stars.compute_figures_data() , each timed on the
+        # result of the previous one.
+        def partition():
+            group_of_star = age_groups.assign_age_groups(data['age_parent'],
+                                                         age_bins_separator)
+            return group_of_star, age_groups.sort_by_group(group_of_star,
+                                                           num_of_age_groups)
+        times['partition'], (group_of_star, _) = time_stage(partition, repeat)
+
+        def chunks():
+            for start, chunk in zip(range(0, len(group_of_star), plot_stars.CHUNK_ROWS),
+                                    plot_stars.iter_chunks(data)):
+                chunk['age_group'] = group_of_star[start:start+plot_stars.CHUNK_ROWS]
+                yield chunk
+
+        def ranges():
+            ranges = plot_stars.reduce_partials(
+                (plot_stars.ranges_partial(chunk, age_bins_separator) for chunk in chunks()),
+                plot_stars.merge_ranges)
+            return ranges, plot_stars.figures_edges(ranges, plot_stars.num_of_bins,
+                                                    plot_stars.num_of_bins_2d)
+        times['ranges'], (figures_ranges, edges) = time_stage(ranges, repeat)
+
+        # The 1D and the 2D histograms, each with the age bins of its stars.
+        times['histograms_1d'], _ = time_stage(
+            lambda: plot_stars.reduce_partials(
+                (plot_stars.counts_1d_partial(chunk, edges, age_bins_separator)
+                 for chunk in chunks()), plot_stars.merge_counts), repeat)
+        times['histograms_2d'], _ = time_stage(
+            lambda: plot_stars.reduce_partials(
+                (plot_stars.counts_2d_partial(chunk, edges, age_bins_separator)
+                 for chunk in chunks()), plot_stars.merge_counts), repeat)
+        times['counts'], counts = time_stage(
+            lambda: plot_stars.reduce_partials(
+                (plot_stars.counts_partial(chunk, edges, age_bins_separator)
+                 for chunk in chunks()), plot_stars.merge_counts), repeat)
+
+        times['statistics'], metallicity_medians = time_stage(
+            lambda: streaming_stats.group_medians(
+                lambda: streaming_stats.iter_group_chunks(data['MsuH'], group_of_star),
+                num_of_age_groups, moments=counts['metallicity_moments']), repeat)
+
+        # The density estimate and the levels of the contours of figure 5.
+        def density():
+            kde_counts = plot_stars.regroup_cube(
+                counts['kde_counts'], plot_stars.fine_age_separators(age_bins_separator),
+                age_bins_separator)
+            density = kde.density_grid(kde_counts, edges['log_mass_edges_kde'],
+                                       edges['metallicity_edges_kde'])['density']
+            return kde.enclosed_probability_levels(
+                density, [plot_stars.contour_probability(i)
+                          for i in range(num_of_age_groups)])
+        times['density'], _ = time_stage(density, repeat)
+
+        # The histograms' data from the partial results, without and with the
+        # confidence bands (see confidence_bands.py).
+        times['from_partials'], figures_data = time_stage(
+            lambda: plot_stars.figures_data_from_partials(
+                figures_ranges, edges, counts, metallicity_medians, age_bins_separator,
+                bands=None), repeat)
+        if plot_stars.bands is not None:
+            times['from_partials_bands'], _ = time_stage(
+                lambda: plot_stars.figures_data_from_partials(
+                    figures_ranges, edges, counts, metallicity_medians,
+                    age_bins_separator, bands=plot_stars.bands), repeat)
+
+        # The contours of figure 5, as polygons.
+        times['contours'], _ = time_stage(
+            lambda: [plot_stars.contour_polygons(figures_data, i)
+                     for i in range(num_of_age_groups)
+                     if figures_data['age_groups_sizes'][i] > 0], repeat)
+
+        # All of the above at once, as  plot_stars.process_catalog()  does.
+        times['figures_data'], figures_data = time_stage(
+            lambda: plot_stars.compute_figures_data(
+                data, age_bins_separator=age_bins_separator,
+                num_of_bins=plot_stars.num_of_bins,
+                num_of_bins_2d=plot_stars.num_of_bins_2d, bands=plot_stars.bands), repeat)
+
+        # The figures are drawn with everything they need computed beforehand,
+        # as in  plot_stars.process_catalog() .
+        for number in figures:
+            plot_options = {'cmd_render': cmd_render} if number == 1 else {}
+            times['figure_{}'.format(number)], _ = time_stage(
+                lambda: plot_stars.FIGURE_STAGES[number]['function'](
+                    data, figures_data, output_dir=work_dir, show=False,
+                    **plot_options), repeat)
+    return times
+
+
+def run_benchmarks(sizes, repeat=3, seed=0, data_dir=DEFAULT_DATA_DIR,
+                   figures=plot_stars.FIGURES, cmd_render='scatter', log=sys.stderr):
+    """Benchmark catalogs of the given sizes, return the results as a dict."""
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'matplotlib': matplotlib.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'parameters': {'repeat': repeat, 'seed': seed, 'cmd_render': cmd_render},
+        'sizes': {},
+    }
+    for rows in sizes:
+        if not os.path.isfile(synthetic_catalog_filename(rows, seed, data_dir)):
+            print('{} rows: generating the catalog'.format(rows), file=log)
+        data_filename = ensure_catalog(rows, seed, data_dir)
+        print('{} rows: timing'.format(rows), file=log)
+        stages = benchmark_catalog(data_filename, repeat, figures, cmd_render)
+        # We keep the best time of each stage, the least affected by noise.
+        results['sizes'][str(rows)] = {
+            stage: {'best': min(times), 'mean': sum(times)/len(times), 'runs': times}
+            for stage, times in stages.items()}
+    return results
+
+
+
+
+################################################################################
+#  Comparison with a baseline.
+################################################################################
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD,
+                     min_seconds=DEFAULT_MIN_SECONDS):
+    """Return the list of (rows, stage, baseline time, time) of the stages more
+    than  threshold  (a fraction) slower than in the baseline.
+
+    Stages faster than  min_seconds  in both runs are ignored, they are
+    dominated by noise.
+    """
+    regressions = []
+    for rows, stages in results['sizes'].items():
+        for stage, timing in stages.items():
+            try:
+                old = baseline['sizes'][rows][stage]['best']
+            except KeyError:
+                continue
+            new = timing['best']
+            if max(old, new) < min_seconds:
+                continue
+            if new > old * (1 + threshold):
+                regressions.append((rows, stage, old, new))
+    return regressions
+
+
+def print_summary(results, file=sys.stderr):
+    stages = []
+    for timings in results['sizes'].values():
+        stages.extend(stage for stage in timings if stage not in stages)
+    sizes = list(results['sizes'])
+
+    print('{:<20}'.format('stage') + ''.join('{:>14}'.format(rows) for rows in sizes),
+          file=file)
+    for stage in stages:
+        print('{:<20}'.format(stage) + ''.join(
+            '{:>13.4f}s'.format(results['sizes'][rows][stage]['best'])
+            if stage in results['sizes'][rows] else '{:>14}'.format('-')
+            for rows in sizes), file=file)
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the stages of plot_stars.py on synthetic catalogs.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='numbers of rows of the catalogs (default: {})'.format(
+                            ' '.join(str(rows) for rows in DEFAULT_SIZES)))
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='times each stage is run, the best time is kept '
+                             '(default: 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic catalogs (default: 0)')
+    parser.add_argument('-d', '--data-dir', default=DEFAULT_DATA_DIR,
+                        help='where the synthetic catalogs are kept '
+                             '(default: {})'.format(DEFAULT_DATA_DIR))
+    parser.add_argument('--figures', type=int, nargs='*', default=plot_stars.FIGURES,
+                        choices=plot_stars.FIGURES,
+                        help='figures to time (default: all)')
+    parser.add_argument('--cmd-render', default='scatter',
+                        choices=('scatter',) + plot_stars.density.RENDER_MODES,
+                        help='see  plot_stars.py --help')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSON file of the results (default: standard output)')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON file of a previous run: fail if a stage is '
+                             'slower than in it by more than the threshold')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown, as a fraction (default: '
+                             '{})'.format(DEFAULT_THRESHOLD))
+    parser.add_argument('--min-seconds', type=float, default=DEFAULT_MIN_SECONDS,
+                        help='stages faster than this are not compared '
+                             '(default: {})'.format(DEFAULT_MIN_SECONDS))
+    args = parser.parse_args(argv)
+
+    plot_stars.use_batch_backend()
+
+    results = run_benchmarks(args.sizes, repeat=args.repeat, seed=args.seed,
+                             data_dir=args.data_dir, figures=args.figures,
+                             cmd_render=args.cmd_render)
+    print_summary(results)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline, args.threshold,
+                                       args.min_seconds)
+        for rows, stage, old, new in regressions:
+            print('REGRESSION {} rows, {}: {:.4f} s -> {:.4f} s (+{:.0%})'.format(
+                rows, stage, old, new, new/old - 1), file=sys.stderr)
+        if regressions:
+            sys.exit('{} stages regressed'.format(len(regressions)))
+
+
+
+if __name__ == '__main__':
+    main()
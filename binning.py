@@ -0,0 +1,141 @@
+################################################################################
+#  Here we bin the stars once and store the number of stars per bin in a
+#  "count cube": an array with one axis for the age groups and one axis for
+#  each binned quantity (e.g. age group x initial mass x metallicity).
+#  The histograms in the figures are then drawn from slices of the cubes, so
+#  drawing them doesn't depend on the number of stars.
+#  When the first axis is made of fine bins (e.g. fine age bins) the cube of
+#  any grouping of the bins is the sum of its slices, see  regroup_counts() .
+################################################################################
+
+
+
+import numpy as np
+
+
+
+# Number of stars binned at once, it bounds the size of the temporary arrays.
+DEFAULT_CHUNK_ROWS = 1 << 20
+
+
+
+def uniform_edges(min_value, max_value, num_of_bins):
+    """Return the edges of  num_of_bins  equal bins, as  np.histogram()  does."""
+    return np.linspace(min_value, max_value, num_of_bins + 1)
+
+
+def bin_index(values, edges, group_of_star=None):
+    """Return the bin of each value, or -1 for values outside the edges.
+
+    The bins must have the same width. As in  np.histogram()  the last bin
+    includes its right edge. If  edges  is a 2D array, row  g  holds the edges
+    used for the stars in age group  g  (see  group_of_star ).
+    """
+    edges = np.asarray(edges, dtype=float)
+    values = np.asarray(values)
+    num_of_bins = edges.shape[-1] - 1
+
+    if edges.ndim == 1:
+        star_edges = edges
+        first_edge, last_edge = edges[0], edges[-1]
+    else:
+        star_edges = edges[group_of_star]
+        first_edge, last_edge = star_edges[:, 0], star_edges[:, -1]
+
+    # Same algorithm as  np.histogram()  for equal bins: we compute the bin
+    # arithmetically, then fix the values that rounding put in the wrong bin
+    # by comparing them with the actual edges.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        inside = (values >= first_edge) & (values <= last_edge)
+        norm = num_of_bins / (last_edge - first_edge)
+        f_index = (values - first_edge) * norm
+    index = np.where(inside, f_index, 0).astype(np.intp)
+    index[index == num_of_bins] -= 1
+
+    def edge(i):
+        if edges.ndim == 1:
+            return edges[i]
+        return np.take_along_axis(star_edges, i[:, None], axis=1)[:, 0]
+
+    index[values < edge(index)] -= 1
+    index[(values >= edge(index + 1)) & (index != num_of_bins - 1)] += 1
+    index[~inside] = -1
+
+    return index
+
+
+def count_cube(group_of_star, num_of_groups, axes, chunk_rows=DEFAULT_CHUNK_ROWS,
+               weights=None):
+    """Return the count cube of the stars and the edges of its axes.
+
+    axes  is a list of  (values, edges)  pairs, one for each binned quantity
+    (see  bin_index()  for the edges). The result is a dict with:
+      'counts' - array of shape  (num_of_groups, bins of axis 1, ...) ,
+      'edges'  - list with the edges of each axis.
+    Stars outside the edges of any axis are not counted. If  weights  is
+    given, 'counts' holds the sum of the weights of the stars in each bin.
+    """
+    shape = (num_of_groups,) + tuple(np.shape(edges)[-1] - 1
+                                     for values, edges in axes)
+    counts = np.zeros(int(np.prod(shape)),
+                      dtype=np.int64 if weights is None else np.float64)
+
+    # We go through the stars in chunks. For each chunk we compute the bin of
+    # every star along every axis, combine them in a single index of the
+    # flattened cube and count the stars per index with  np.bincount() .
+    num_of_stars = len(group_of_star)
+    for start in range(0, num_of_stars, chunk_rows):
+        stop = min(start + chunk_rows, num_of_stars)
+        group_chunk = np.asarray(group_of_star[start:stop]).astype(np.intp)
+
+        flat_index = group_chunk
+        valid = (group_chunk >= 0) & (group_chunk < num_of_groups)
+        for axis, (values, edges) in enumerate(axes, start=1):
+            index = bin_index(values[start:stop], edges,
+                              group_chunk.clip(0, num_of_groups-1))
+            valid &= index >= 0
+            flat_index = flat_index * shape[axis] + index
+
+        counts += np.bincount(flat_index[valid], minlength=counts.size,
+                              weights=(None if weights is None
+                                       else weights[start:stop][valid]))
+
+    return {'counts': counts.reshape(shape),
+            'edges': [np.asarray(edges, dtype=float) for values, edges in axes]}
+
+
+def regroup_counts(counts, group_of_bin, num_of_groups):
+    """Return the count cube with the first axis (e.g. fine age bins) summed
+    into groups: the counts of bin  b  go to group  group_of_bin[b] ."""
+    counts = np.asarray(counts)
+    regrouped = np.zeros((num_of_groups,) + counts.shape[1:], dtype=counts.dtype)
+    np.add.at(regrouped, np.asarray(group_of_bin, dtype=np.intp), counts)
+    return regrouped
+
+
+def bin_centres(edges):
+    """Return the centres of the bins (for 2D edges, of each row)."""
+    edges = np.asarray(edges, dtype=float)
+    return (edges[..., :-1] + edges[..., 1:]) / 2.
+
+
+def hist_from_counts(ax, counts, edges, **kwargs):
+    """Draw a histogram of precomputed  counts  with  ax.hist() .
+
+    Each bin is drawn as a single point at its centre weighted by its count,
+    so the cost doesn't depend on the number of stars. Returns what
+    ax.hist()  returns.
+    """
+    return ax.hist(bin_centres(edges), edges, weights=counts, **kwargs)
+
+
+def hist2d_from_counts(ax, counts, xedges, yedges, **kwargs):
+    """Draw a 2D histogram of precomputed  counts  with  ax.hist2d() .
+
+    Same as  hist_from_counts() , in two dimensions. Returns what
+    ax.hist2d()  returns.
+    """
+    x_centres, y_centres = np.meshgrid(bin_centres(xedges), bin_centres(yedges),
+                                       indexing='ij')
+    return ax.hist2d(x_centres.ravel(), y_centres.ravel(),
+                     bins=[xedges, yedges], weights=np.ravel(counts), **kwargs)
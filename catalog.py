@@ -0,0 +1,274 @@
+################################################################################
+#  Here we read the stars' catalog (e.g. Nemo_6670.dat) in fixed-size chunks
+#  instead of loading the whole text file at once. Each chunk is parsed by
+#  NumPy's C text parser and only the five columns we need are converted, so
+#  that the memory used while reading doesn't grow with the size of the
+#  catalog.
+#  The parsed columns are also saved in a binary cache next to the catalog, so
+#  that following runs memory-map them instead of parsing the text again.
+################################################################################
+
+
+
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+
+# The columns we use and their position in the file (each col in the file has
+# a #header label). The order is the one used by plot_stars.py.
+CATALOG_COLUMNS = ('M_ass', 'b_y', 'age_parent', 'MsuH', 'm_ini')
+CATALOG_USECOLS = (4, 8, 12, 0, 1)
+
+# Default size (in bytes) of the text blocks read from the file.
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+
+def _parse_block(block, dtype):
+    """Parse a block of complete lines and return the five columns we use."""
+    # np.loadtxt() is implemented in C: given an in-memory block and  usecols
+    # it only converts the values we need, and skips the #header lines.
+    return np.loadtxt(io.BytesIO(block), dtype=dtype, delimiter=' ',
+                      usecols=CATALOG_USECOLS, comments='#', ndmin=2)
+
+
+def read_blocks(data_filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the content of a file in blocks of  chunk_size  bytes."""
+    with open(data_filename, 'rb') as data_file:
+        while True:
+            raw = data_file.read(chunk_size)
+            if not raw:
+                break
+            yield raw
+
+
+def iter_catalog_chunks(data_filename, chunk_size=DEFAULT_CHUNK_SIZE,
+                        dtype=np.float64, hasher=None, blocks=None):
+    """Yield the catalog as a stream of dicts {column name: 1D array}.
+
+    Each dict holds the rows of one block of about  chunk_size  bytes, the
+    arrays are contiguous and of the given dtype. If a  hashlib  object is
+    given as  hasher , it is updated with the raw bytes of the file.
+    If  blocks  (an iterable of bytes, e.g. a download in progress) is given,
+    it is parsed instead of the file.
+    """
+    if blocks is None:
+        blocks = read_blocks(data_filename, chunk_size)
+    leftover = b''
+
+    # An empty block at the end flushes the last line.
+    for raw in itertools.chain(blocks, [b'']):
+        if hasher is not None:
+            hasher.update(raw)
+        block = leftover + raw
+
+        # We only parse complete lines, the last (partial) line is kept
+        # for the next block.
+        if raw:
+            cut = block.rfind(b'\n') + 1
+            block, leftover = block[:cut], block[cut:]
+
+        if block.strip():
+            rows = _parse_block(block, dtype)
+            if rows.shape[0]:
+                yield {name: np.ascontiguousarray(rows[:, i])
+                       for i, name in enumerate(CATALOG_COLUMNS)}
+
+
+def load_catalog(data_filename, chunk_size=DEFAULT_CHUNK_SIZE,
+                 dtype=np.float64):
+    """Read the whole catalog, chunk by chunk, into one array per column."""
+    chunks = {name: [] for name in CATALOG_COLUMNS}
+    for chunk in iter_catalog_chunks(data_filename, chunk_size, dtype):
+        for name in CATALOG_COLUMNS:
+            chunks[name].append(chunk[name])
+
+    return {name: (np.concatenate(chunks[name]) if chunks[name]
+                   else np.empty(0, dtype=dtype))
+            for name in CATALOG_COLUMNS}
+
+
+
+
+################################################################################
+#  Binary cache of the parsed columns.
+#  The cache is a directory named after the catalog (e.g. Nemo_6670.dat.cache)
+#  containing one raw binary file per column and a  meta.json  file with the
+#  number of rows, the dtype and the size, mtime and SHA-256 hash of the
+#  catalog the columns were read from, and the SHA-256 hash of each column.
+################################################################################
+
+# Bump this when the layout of the cache changes, old caches are rebuilt.
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.cache'
+CACHE_META_FILENAME = 'meta.json'
+
+
+
+def default_cache_dir(data_filename):
+    return data_filename + CACHE_SUFFIX
+
+
+def file_sha256(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as data_file:
+        for raw in iter(lambda: data_file.read(chunk_size), b''):
+            hasher.update(raw)
+    return hasher.hexdigest()
+
+
+def read_cache_meta(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, CACHE_META_FILENAME)) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache_meta(cache_dir, meta):
+    # We write to a temporary file and rename it, so that an interrupted run
+    # never leaves a half written (but valid looking) cache.
+    meta_filename = os.path.join(cache_dir, CACHE_META_FILENAME)
+    with open(meta_filename + '.tmp', 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    os.replace(meta_filename + '.tmp', meta_filename)
+
+
+def _column_filename(cache_dir, name):
+    return os.path.join(cache_dir, name + '.bin')
+
+
+def is_cache_valid(data_filename, cache_dir=None, dtype=np.float64):
+    """Check the cache against the catalog's size, mtime and hash.
+
+    When size and mtime match the cache is used straight away. When only the
+    mtime changed (e.g. the file was downloaded again) we compare the hash,
+    and if the content is the same we keep the cache and update its mtime.
+    """
+    cache_dir = cache_dir or default_cache_dir(data_filename)
+    meta = read_cache_meta(cache_dir)
+    if (meta is None or meta.get('version') != CACHE_VERSION
+            or meta.get('dtype') != np.dtype(dtype).str):
+        return False
+
+    stat = os.stat(data_filename)
+    if stat.st_size != meta['size']:
+        return False
+    if stat.st_mtime_ns == meta['mtime_ns']:
+        return True
+
+    if file_sha256(data_filename) != meta['sha256']:
+        return False
+    meta['mtime_ns'] = stat.st_mtime_ns
+    _write_cache_meta(cache_dir, meta)
+    return True
+
+
+def build_cache(data_filename, cache_dir=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                dtype=np.float64, blocks=None):
+    """Parse the catalog once and write its columns to the binary cache.
+
+    If  blocks  is given, the catalog is parsed from them (see
+    iter_catalog_chunks() ) while it's being written, e.g. by a download:
+    data_filename  must hold the same bytes once  blocks  is exhausted.
+    """
+    cache_dir = cache_dir or default_cache_dir(data_filename)
+    new_cache_dir = not os.path.isdir(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # The old meta file is removed first: the cache is invalid until the new
+    # one is written at the very end.
+    try:
+        os.remove(os.path.join(cache_dir, CACHE_META_FILENAME))
+    except FileNotFoundError:
+        pass
+
+    # With  blocks  the file is complete only at the end.
+    stat = os.stat(data_filename) if blocks is None else None
+    hasher = hashlib.sha256()
+    column_hashers = {name: hashlib.sha256() for name in CATALOG_COLUMNS}
+    num_of_rows = 0
+
+    # The columns are streamed to disk chunk by chunk, so the memory used
+    # doesn't depend on the size of the catalog.
+    column_files = {name: open(_column_filename(cache_dir, name), 'wb')
+                    for name in CATALOG_COLUMNS}
+    try:
+        try:
+            for chunk in iter_catalog_chunks(data_filename, chunk_size, dtype,
+                                             hasher=hasher, blocks=blocks):
+                for name in CATALOG_COLUMNS:
+                    chunk[name].tofile(column_files[name])
+                    column_hashers[name].update(chunk[name].tobytes())
+                num_of_rows += chunk[CATALOG_COLUMNS[0]].size
+        finally:
+            for column_file in column_files.values():
+                column_file.close()
+    except BaseException:
+        # E.g. the download failed: we don't leave behind an empty cache
+        # directory which wasn't there before.
+        if new_cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        raise
+
+    if stat is None:
+        stat = os.stat(data_filename)
+    _write_cache_meta(cache_dir, {
+        'version': CACHE_VERSION,
+        'columns': list(CATALOG_COLUMNS),
+        'dtype': np.dtype(dtype).str,
+        'rows': num_of_rows,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': hasher.hexdigest(),
+        'column_sha256': {name: column_hashers[name].hexdigest()
+                          for name in CATALOG_COLUMNS},
+    })
+
+
+def open_cache(cache_dir):
+    """Memory-map the cached columns (read only, no copies)."""
+    meta = read_cache_meta(cache_dir)
+    dtype = np.dtype(meta['dtype'])
+
+    # np.memmap() can't map an empty file.
+    if meta['rows'] == 0:
+        return {name: np.empty(0, dtype=dtype) for name in meta['columns']}
+    return {name: np.memmap(_column_filename(cache_dir, name), dtype=dtype,
+                            mode='r', shape=(meta['rows'],))
+            for name in meta['columns']}
+
+
+def ensure_cache(data_filename, cache_dir=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 dtype=np.float64):
+    """Build the cache if it isn't valid, return its directory."""
+    cache_dir = cache_dir or default_cache_dir(data_filename)
+    if not is_cache_valid(data_filename, cache_dir, dtype):
+        build_cache(data_filename, cache_dir, chunk_size, dtype)
+    return cache_dir
+
+
+def column_hashes(data_filename, cache_dir=None):
+    """Return a dict {column name: SHA-256 hash of its values} of the catalog,
+    or None if there is no valid cache to read them from."""
+    cache_dir = cache_dir or default_cache_dir(data_filename)
+    if not is_cache_valid(data_filename, cache_dir):
+        return None
+    return read_cache_meta(cache_dir)['column_sha256']
+
+
+def load_catalog_cached(data_filename, cache_dir=None,
+                        chunk_size=DEFAULT_CHUNK_SIZE, dtype=np.float64):
+    """Like  load_catalog() , but going through the binary cache.
+
+    The first time the catalog is parsed and the cache is written, then (and
+    on every following run) the columns are memory-mapped from the cache.
+    """
+    return open_cache(ensure_cache(data_filename, cache_dir, chunk_size, dtype))
@@ -0,0 +1,117 @@
+################################################################################
+#  Here we compute confidence bands for the histograms of the figures, from
+#  their count cubes (see binning.py): for each bin, the range within which
+#  its count falls with a given probability (95% by default).
+#
+#  Instead of resampling the stars (which would mean binning all of them
+#  again for each resample) we resample the counts, all the resamples at
+#  once:
+#    * bootstrap - resampling with replacement the stars of an age group and
+#                  counting them again is the same as drawing the counts of
+#                  the group's bins from a multinomial distribution, with the
+#                  number of stars of the group and the observed frequencies
+#                  of the bins,
+#    * poisson   - each bin's count is drawn from a Poisson distribution with
+#                  the observed count as mean (the number of stars of the
+#                  group varies too).
+#  The band of a bin goes from the lower to the upper quantile of its
+#  resampled counts. The same goes for any quantity estimated from the
+#  counts (e.g. a density, see kde.py): it is estimated again from each
+#  resample. The resamples are drawn with a fixed seed, so the bands (and the
+#  figures) are the same every run.
+################################################################################
+
+
+
+import numpy as np
+
+
+
+METHODS = ('bootstrap', 'poisson')
+
+DEFAULT_NUM_OF_RESAMPLES = 1000
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_SEED = 0
+# Resamples estimated at once by  estimate_bands() .
+DEFAULT_BATCH_SIZE = 100
+
+
+
+def resample_counts(counts, num_of_resamples=DEFAULT_NUM_OF_RESAMPLES,
+                    method='bootstrap', rng=None):
+    """Return  num_of_resamples  resamples of a count cube, as an array of
+    shape  (num_of_resamples,) + counts.shape .
+
+    The first axis of  counts  is the age group: with the 'bootstrap' method
+    every resample of a group has the same number of stars as the group.
+    rng  is a NumPy Generator or a seed.
+    """
+    counts = np.asarray(counts)
+    rng = np.random.default_rng(rng)
+    # One row of bins per age group.
+    group_counts = counts.reshape(counts.shape[0], -1)
+
+    if method == 'bootstrap':
+        group_sizes = group_counts.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frequencies = group_counts / group_sizes[:, None]
+        # An empty group stays empty, whatever its frequencies.
+        frequencies[group_sizes == 0] = 1. / group_counts.shape[1]
+        resamples = rng.multinomial(group_sizes, frequencies,
+                                    size=(num_of_resamples, len(group_counts)))
+    elif method == 'poisson':
+        resamples = rng.poisson(group_counts,
+                                size=(num_of_resamples,) + group_counts.shape)
+    else:
+        raise ValueError('unknown resampling method {!r}, expected one of {}'.format(
+            method, METHODS))
+
+    return resamples.reshape((num_of_resamples,) + counts.shape)
+
+
+def count_bands(counts, method='bootstrap', num_of_resamples=DEFAULT_NUM_OF_RESAMPLES,
+                confidence=DEFAULT_CONFIDENCE, seed=DEFAULT_SEED):
+    """Return the confidence band of each bin of a count cube, a dict with:
+      'lower', 'upper' - arrays of the same shape as  counts , the quantiles
+                         (1 - confidence) / 2  and  (1 + confidence) / 2  of
+                         the resampled counts (see  resample_counts() ).
+    Divided by the number of stars of each group they are the band of the
+    relative frequencies.
+    """
+    resamples = resample_counts(counts, num_of_resamples, method, rng=seed)
+    lower, upper = np.quantile(resamples, [(1. - confidence) / 2.,
+                                           (1. + confidence) / 2.], axis=0)
+    return {'lower': lower, 'upper': upper}
+
+
+def estimate_bands(counts, estimate, method='bootstrap',
+                   num_of_resamples=DEFAULT_NUM_OF_RESAMPLES,
+                   confidence=DEFAULT_CONFIDENCE, seed=DEFAULT_SEED,
+                   batch_size=DEFAULT_BATCH_SIZE):
+    """Return the confidence band of a quantity estimated from a count cube,
+    a dict with 'lower' and 'upper' as in  count_bands() .
+
+    estimate(resamples, group)  returns the quantity for an array of resamples
+    of the counts of age group  group , of shape  (resamples, 1, bins...) ,
+    as an array of shape  (resamples, 1, ...) . The groups are resampled one
+    at a time and the resamples in batches of  batch_size , so that only the
+    estimates of one group are kept in memory (as float32).
+    """
+    counts = np.asarray(counts)
+    rng = np.random.default_rng(seed)
+    quantiles = [(1. - confidence) / 2., (1. + confidence) / 2.]
+    lower, upper = [], []
+    for group in range(len(counts)):
+        estimates = None
+        for start in range(0, num_of_resamples, batch_size):
+            size = min(batch_size, num_of_resamples - start)
+            batch = estimate(resample_counts(counts[group:group+1], size, method,
+                                             rng), group)
+            if estimates is None:
+                estimates = np.empty((num_of_resamples,) + batch.shape[1:],
+                                     dtype=np.float32)
+            estimates[start:start+size] = batch
+        group_lower, group_upper = np.quantile(estimates, quantiles, axis=0)
+        lower.append(group_lower[0])
+        upper.append(group_upper[0])
+    return {'lower': np.array(lower), 'upper': np.array(upper)}
@@ -0,0 +1,83 @@
+################################################################################
+#  Here we draw the colour-magnitude diagram as an image instead of a scatter
+#  plot. The stars are binned on a grid of pixels covering the axes and each
+#  pixel is coloured according to the age of its stars, either the mean age
+#  or the age bin with the most stars (the "majority" age bin). The image is
+#  drawn with a single artist, so the time needed to draw and save the
+#  figure depends on the number of pixels, not on the number of stars.
+################################################################################
+
+
+
+import numpy as np
+
+import binning
+
+
+
+RENDER_MODES = ('mean', 'majority')
+
+# Side of a grid cell in screen pixels. The default is about the size of the
+# dots in the scatter plot.
+DEFAULT_CELL_PIXELS = 3
+
+
+
+def grid_shape_for_axes(ax, cell_pixels=DEFAULT_CELL_PIXELS):
+    """Return the number of grid cells (along x, along y) covering the axes."""
+    extent = ax.get_window_extent()
+    return (max(int(extent.width // cell_pixels), 1),
+            max(int(extent.height // cell_pixels), 1))
+
+
+def rasterize_ages(x, y, age, xlim, ylim, shape, age_bins_edges, mode='mean'):
+    """Return a 2D array (rows along y, columns along x) with the age of each
+    grid cell, NaN for the cells without stars.
+
+    mode  is 'mean' for the mean age of the stars in the cell, or 'majority'
+    for the centre of the age bin (from  age_bins_edges ) with the most stars.
+    """
+    x_edges = binning.uniform_edges(min(xlim), max(xlim), shape[0])
+    y_edges = binning.uniform_edges(min(ylim), max(ylim), shape[1])
+    axes = [(x, x_edges), (y, y_edges)]
+
+    if mode == 'mean':
+        # A cube with a single group: the number of stars and the sum of their
+        # ages in each cell.
+        no_group = np.zeros(len(age), dtype=np.int8)
+        counts = binning.count_cube(no_group, 1, axes)['counts'][0]
+        age_sums = binning.count_cube(no_group, 1, axes, weights=age)['counts'][0]
+        with np.errstate(invalid='ignore'):
+            image = age_sums / counts
+
+    elif mode == 'majority':
+        # The age bins play the role of the groups of the count cube. As the
+        # colormap does, ages outside  age_bins_edges  go to the first or last
+        # age bin.
+        num_of_age_bins = len(age_bins_edges) - 1
+        age_bin_of_star = np.clip(
+            np.searchsorted(age_bins_edges, age, side='right') - 1,
+            0, num_of_age_bins - 1)
+        counts = binning.count_cube(age_bin_of_star, num_of_age_bins, axes)['counts']
+        age_bins_centres = binning.bin_centres(age_bins_edges)
+        image = np.where(counts.any(axis=0),
+                         age_bins_centres[counts.argmax(axis=0)], np.nan)
+
+    else:
+        raise ValueError('unknown render mode {!r}, expected one of {}'.format(
+            mode, RENDER_MODES))
+
+    return image.T
+
+
+def draw_ages(ax, image, xlim, ylim, cmap, norm):
+    """Draw the image returned by  rasterize_ages()  with  ax.imshow() .
+
+    The axes' limits (also if inverted) are left as they are.
+    """
+    image_artist = ax.imshow(image, origin='lower', aspect='auto',
+                             interpolation='nearest', cmap=cmap, norm=norm,
+                             extent=(min(xlim), max(xlim), min(ylim), max(ylim)))
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    return image_artist
@@ -0,0 +1,184 @@
+################################################################################
+#  Here we aggregate an ensemble of catalogs (e.g. many realisations of the
+#  same cluster) into a single set of figures 2, 4 and 5, as if the catalogs
+#  were one catalog with all their stars, one catalog after the other.
+#
+#  The stars are never all in memory. The columns of each catalog are
+#  memory-mapped from its binary cache (see catalog.py), and the stars of the
+#  whole ensemble are split in chunks of  plot_stars.CHUNK_ROWS  consecutive
+#  stars, a chunk can span the end of a catalog and the start of the next
+#  one. A pool of processes computes the partial results of the chunks (see
+#  plot_stars.ranges_partial()  and  plot_stars.counts_partial() ), which are
+#  merged in the order of the chunks. Since the chunks are the same as those
+#  of  plot_stars.compute_figures_data()  on the concatenated catalogs, the
+#  result is identical, to the last bit, to a single run on that catalog.
+#  The exact medians need a few more passes over the chunks, which are done
+#  by the main process (see streaming_stats.py).
+################################################################################
+
+
+
+import concurrent.futures
+import multiprocessing
+import os
+
+import numpy as np
+
+import age_groups
+import catalog
+import instrumentation
+import plot_stars
+import streaming_stats
+
+
+
+# The figures drawn from the ensemble: the others need every single star.
+ENSEMBLE_FIGURES = (2, 4, 5)
+# Tasks per process, each task is a run of consecutive chunks.
+TASKS_PER_JOB = 4
+
+
+
+def catalog_rows(data_filename):
+    """Build the catalog's cache if needed, return its number of stars."""
+    cache_dir = catalog.ensure_cache(data_filename)
+    return catalog.read_cache_meta(cache_dir)['rows']
+
+
+def plan_chunks(rows_by_catalog, chunk_rows=plot_stars.CHUNK_ROWS):
+    """Split the stars of the catalogs in chunks of  chunk_rows  stars.
+
+    Each chunk is a list of pieces  (catalog number, start, stop) , the rows
+    start:stop  of the catalog.
+    """
+    chunks = []
+    chunk, chunk_size = [], 0
+    for number, rows in enumerate(rows_by_catalog):
+        start = 0
+        while start < rows:
+            stop = min(start + chunk_rows - chunk_size, rows)
+            chunk.append((number, start, stop))
+            chunk_size += stop - start
+            start = stop
+            if chunk_size == chunk_rows:
+                chunks.append(chunk)
+                chunk, chunk_size = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class _Columns:
+    # The memory-mapped columns of the catalogs, opened the first time they
+    # are needed.
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+        self.opened = {}
+
+    def read_chunk(self, pieces, columns=plot_stars.FIGURES_DATA_COLUMNS):
+        """Return the chunk made of the given pieces, see  plan_chunks() ."""
+        for number, start, stop in pieces:
+            if number not in self.opened:
+                self.opened[number] = catalog.open_cache(
+                    catalog.default_cache_dir(self.catalogs[number]))
+        return {name: np.concatenate([self.opened[number][name][start:stop]
+                                      for number, start, stop in pieces])
+                for name in columns}
+
+
+def _ranges_task(catalogs, chunks, age_bins_separator):
+    columns = _Columns(catalogs)
+    return plot_stars.reduce_partials(
+        (plot_stars.ranges_partial(columns.read_chunk(pieces), age_bins_separator)
+         for pieces in chunks), plot_stars.merge_ranges)
+
+
+def _counts_task(catalogs, chunks, edges, age_bins_separator):
+    # The counts of the task's chunks are summed here, the moments are sent
+    # back one per chunk: they are merged by the main process, in order.
+    columns = _Columns(catalogs)
+    partials = [plot_stars.counts_partial(columns.read_chunk(pieces), edges,
+                                          age_bins_separator)
+                for pieces in chunks]
+    moments = [partial.pop('metallicity_moments') for partial in partials]
+    return plot_stars.reduce_partials(partials, plot_stars.merge_counts), moments
+
+
+def _split_tasks(chunks, jobs):
+    # Runs of consecutive chunks, in order.
+    num_of_tasks = max(1, min(len(chunks), jobs * TASKS_PER_JOB))
+    bounds = np.linspace(0, len(chunks), num_of_tasks + 1).astype(int)
+    return [chunks[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def aggregate_catalogs(catalogs, jobs=1,
+                       age_bins_separator=plot_stars.age_bins_separator,
+                       num_of_bins=plot_stars.num_of_bins,
+                       num_of_bins_2d=plot_stars.num_of_bins_2d,
+                       bands=plot_stars.bands):
+    """Return the data of figures 2, 4 and 5 (see
+    plot_stars.compute_figures_data() ) of the stars of all the catalogs,
+    computed by  jobs  processes."""
+    num_of_age_groups = len(age_bins_separator) + 1
+
+    # We use 'spawn' so that the workers don't inherit the parent's state.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, jobs),
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        with instrumentation.stage('caches'):
+            rows_by_catalog = list(executor.map(catalog_rows, catalogs))
+        chunks = plan_chunks(rows_by_catalog)
+        if not chunks:
+            raise ValueError('the catalogs have no stars')
+        tasks = _split_tasks(chunks, jobs)
+
+        with instrumentation.stage('ranges'):
+            ranges = plot_stars.reduce_partials(
+                executor.map(_ranges_task, *zip(*[(catalogs, task, age_bins_separator)
+                                                  for task in tasks])),
+                plot_stars.merge_ranges)
+            edges = plot_stars.figures_edges(ranges, num_of_bins, num_of_bins_2d)
+
+        with instrumentation.stage('counts'):
+            results = list(executor.map(_counts_task,
+                                        *zip(*[(catalogs, task, edges, age_bins_separator)
+                                               for task in tasks])))
+            counts = plot_stars.reduce_partials([task_counts for task_counts, _ in results],
+                                                plot_stars.merge_counts)
+            counts['metallicity_moments'] = plot_stars.reduce_partials(
+                [moments for _, task_moments in results for moments in task_moments],
+                streaming_stats.merge_moments)
+
+    # The exact medians, going through the chunks again.
+    columns = _Columns(catalogs)
+
+    def metallicity_chunks():
+        for pieces in chunks:
+            chunk = columns.read_chunk(pieces, ('age_parent', 'MsuH'))
+            yield chunk['MsuH'], age_groups.assign_age_groups(chunk['age_parent'],
+                                                              age_bins_separator)
+    with instrumentation.stage('statistics'):
+        metallicity_medians = streaming_stats.group_medians(
+            metallicity_chunks, num_of_age_groups, moments=counts['metallicity_moments'])
+
+    return plot_stars.figures_data_from_partials(ranges, edges, counts,
+                                                 metallicity_medians,
+                                                 age_bins_separator, bands)
+
+
+def process_ensemble(catalogs, output_dir, jobs=1, show=False,
+                     bands=plot_stars.bands):
+    """Aggregate the catalogs and draw figures 2, 4 and 5 in  output_dir ."""
+    with instrumentation.stage('figures_data'):
+        figures_data = aggregate_catalogs(catalogs, jobs=jobs,
+                                          age_bins_separator=plot_stars.age_bins_separator,
+                                          num_of_bins=plot_stars.num_of_bins,
+                                          num_of_bins_2d=plot_stars.num_of_bins_2d,
+                                          bands=bands)
+    os.makedirs(output_dir, exist_ok=True)
+    with instrumentation.stage('render'):
+        for number in ENSEMBLE_FIGURES:
+            plot_stars.render_figure(number, None, figures_data,
+                                     output_dir=output_dir, show=show)
+    return figures_data
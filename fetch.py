@@ -0,0 +1,270 @@
+################################################################################
+#  Here we fetch the stars' catalog (e.g. Nemo_6670.dat) from a URL, a local
+#  file or a local directory, parsing it while it is being downloaded.
+#
+#  The bytes are read by a background thread, which waits for the network
+#  while the main thread parses the rows received so far and writes the
+#  binary cache of the columns (see catalog.py), so that when the download
+#  ends the catalog is already parsed.
+#  The download goes to  <catalog>.part : if it is interrupted, the next run
+#  asks the server for the missing bytes only (HTTP Range request) and goes
+#  on from there; where the partial file comes from is noted in
+#  <catalog>.part.fetch.json . When it is complete it is renamed to
+#  <catalog>  and its source, size and SHA-256 hash are saved in
+#  <catalog>.fetch.json .
+#  Nothing is downloaded when a local copy with the expected hash exists: the
+#  hash given by the user or, if none is given, the one saved when the copy
+#  was fetched.
+################################################################################
+
+
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import catalog
+
+
+
+FETCH_META_SUFFIX = '.fetch.json'
+PART_SUFFIX = '.part'
+PART_META_SUFFIX = PART_SUFFIX + FETCH_META_SUFFIX
+
+# Size of the blocks read from the network (or the source file).
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+# Blocks read ahead by the download thread, waiting to be parsed.
+DOWNLOAD_QUEUE_BLOCKS = 64
+DOWNLOAD_TIMEOUT = 60
+
+
+
+def _is_url(source):
+    return urllib.parse.urlparse(source).scheme in ('http', 'https', 'ftp', 'file')
+
+
+def resolve_source(source, data_filename):
+    """Return the URL or the file the catalog is fetched from: a directory
+    stands for the file with the catalog's name in it."""
+    if not _is_url(source) and os.path.isdir(source):
+        return os.path.join(source, os.path.basename(data_filename))
+    return source
+
+
+def read_fetch_meta(data_filename, suffix=FETCH_META_SUFFIX):
+    try:
+        with open(data_filename + suffix) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_fetch_meta(data_filename, meta, suffix=FETCH_META_SUFFIX):
+    meta_filename = data_filename + suffix
+    with open(meta_filename + '.tmp', 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    os.replace(meta_filename + '.tmp', meta_filename)
+
+
+def _local_sha256(data_filename):
+    # The hash saved in the catalog's cache, if the cache is up to date, saves
+    # reading the whole file again.
+    if catalog.is_cache_valid(data_filename):
+        return catalog.read_cache_meta(catalog.default_cache_dir(data_filename))['sha256']
+    return catalog.file_sha256(data_filename)
+
+
+def is_up_to_date(source, data_filename, sha256=None):
+    """Check whether the local copy of the catalog doesn't need to be fetched.
+
+    With  sha256  the copy must have that hash. Without it, it must be the
+    complete copy of the same source saved by a previous fetch.
+    """
+    if not os.path.isfile(data_filename):
+        return False
+    if sha256 is None:
+        meta = read_fetch_meta(data_filename)
+        if (meta is None or meta.get('source') != source
+                or meta.get('size') != os.path.getsize(data_filename)):
+            return False
+        sha256 = meta['sha256']
+    return _local_sha256(data_filename) == sha256.lower()
+
+
+
+
+################################################################################
+#  Download.
+################################################################################
+
+def _open_source(source, offset, etag=None):
+    """Open the source at byte  offset , return (stream, offset, total size,
+    ETag): the offset is 0 if the source can't be resumed (or has changed)."""
+    if not _is_url(source):
+        stream = open(source, 'rb')
+        size = os.fstat(stream.fileno()).st_size
+        if offset > size:
+            offset = 0
+        stream.seek(offset)
+        return stream, offset, size, None
+
+    request = urllib.request.Request(source)
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+        # If the file changed since the partial download, the server sends
+        # all of it.
+        if etag:
+            request.add_header('If-Range', etag)
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as error:
+        # 416: the partial download already has all the bytes, or more.
+        if error.code != 416 or not offset:
+            raise
+        return _open_source(source, 0)
+
+    length = response.headers.get('Content-Length')
+    if offset and getattr(response, 'status', 200) == 206:
+        content_range = response.headers.get('Content-Range', '')
+        start = content_range.split(' ')[-1].split('-')[0]
+        total = content_range.rsplit('/', 1)[-1]
+        if start != str(offset):
+            response.close()
+            return _open_source(source, 0)
+        size = int(total) if total.isdigit() else None
+    else:
+        offset = 0
+        size = int(length) if length is not None else None
+    return response, offset, size, response.headers.get('ETag')
+
+
+def _read_ahead(stream, part_file, blocks, stop):
+    # Runs in the download thread: read the source, append to the partial
+    # file and hand the blocks to the parser, until the end or until  stop
+    # is set. The end is marked by None, or by the exception raised.
+    def hand(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        with stream:
+            for raw in iter(lambda: stream.read(DOWNLOAD_BLOCK_SIZE), b''):
+                part_file.write(raw)
+                if not hand(raw):
+                    return
+        part_file.flush()
+        hand(None)
+    except Exception as error:
+        hand(error)
+
+
+def download_blocks(source, data_filename, sha256=None):
+    """Download the catalog from  source  to  data_filename , yielding its
+    content (from the first byte) while it arrives.
+
+    An interrupted download is resumed from its partial file. When all the
+    blocks have been consumed the file is checked against  sha256  (if given)
+    and renamed to  data_filename .
+    """
+    part_filename = data_filename + PART_SUFFIX
+    part_meta = read_fetch_meta(data_filename, PART_META_SUFFIX) or {}
+    offset = 0
+    if os.path.isfile(part_filename) and part_meta.get('source') == source:
+        offset = os.path.getsize(part_filename)
+
+    stream, offset, size, etag = _open_source(source, offset, part_meta.get('etag'))
+    # We note where the partial file comes from, to resume it next time. The
+    # meta of a complete copy, if any, stays until this download succeeds.
+    _write_fetch_meta(data_filename, {'source': source, 'etag': etag},
+                      PART_META_SUFFIX)
+
+    hasher = hashlib.sha256()
+    blocks = queue.Queue(maxsize=DOWNLOAD_QUEUE_BLOCKS)
+    with open(part_filename, 'r+b' if offset else 'wb') as part_file:
+        part_file.truncate(offset)
+
+        # The bytes we already have come first, read from the partial file
+        # before the download thread appends to it.
+        with open(part_filename, 'rb') as previous:
+            for raw in iter(lambda: previous.read(DOWNLOAD_BLOCK_SIZE), b''):
+                hasher.update(raw)
+                yield raw
+        part_file.seek(offset)
+
+        stop = threading.Event()
+        reader = threading.Thread(target=_read_ahead, daemon=True,
+                                  args=(stream, part_file, blocks, stop))
+        reader.start()
+        received = offset
+        try:
+            while True:
+                raw = blocks.get()
+                if raw is None:
+                    break
+                if isinstance(raw, Exception):
+                    raise raw
+                received += len(raw)
+                hasher.update(raw)
+                yield raw
+        finally:
+            # If the parser stops early, so does the download: what was
+            # written to the partial file is kept, to be resumed.
+            stop.set()
+            reader.join()
+
+    if size is not None and received != size:
+        raise IOError('incomplete download of {}: {} of {} bytes'.format(
+            source, received, size))
+    digest = hasher.hexdigest()
+    if sha256 is not None and digest != sha256.lower():
+        # The partial file is useless, the next run starts from scratch.
+        os.remove(part_filename)
+        os.remove(data_filename + PART_META_SUFFIX)
+        raise ValueError('the SHA-256 hash of {} is {}, expected {}'.format(
+            source, digest, sha256))
+
+    os.replace(part_filename, data_filename)
+    _write_fetch_meta(data_filename, {'source': source, 'etag': etag,
+                                      'size': received, 'sha256': digest})
+    os.remove(data_filename + PART_META_SUFFIX)
+
+
+def fetch_catalog(source, data_filename, sha256=None, build_cache=True):
+    """Fetch the catalog from  source  (a URL, a file or a directory) to
+    data_filename , unless the local copy is up to date (see
+    is_up_to_date() ). Return True if the catalog was fetched.
+
+    With  build_cache  the catalog is parsed into its binary cache while it
+    is downloaded (see catalog.py).
+    """
+    source = resolve_source(source, data_filename)
+    if is_up_to_date(source, data_filename, sha256):
+        return False
+
+    # The catalog itself: just check it.
+    if (not _is_url(source) and os.path.isfile(data_filename)
+            and os.path.samefile(source, data_filename)):
+        if sha256 is not None and _local_sha256(data_filename) != sha256.lower():
+            raise ValueError('the SHA-256 hash of {} is not {}'.format(
+                data_filename, sha256))
+        return False
+
+    directory = os.path.dirname(os.path.abspath(data_filename))
+    os.makedirs(directory, exist_ok=True)
+    blocks = download_blocks(source, data_filename, sha256)
+    if build_cache:
+        catalog.build_cache(data_filename, blocks=blocks)
+    else:
+        for _ in blocks:
+            pass
+    return True
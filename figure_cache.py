@@ -0,0 +1,69 @@
+################################################################################
+#  Here we keep a content-addressed cache of the rendered figures.
+#  Each figure has a fingerprint, the hash of everything it depends on (the
+#  hashes of the columns it uses, the values of its parameters, the code
+#  drawing it). A rendered figure is stored in the cache directory under its
+#  fingerprint, so when a figure with the same fingerprint is requested again
+#  (also after other parameters were tried in between) it is copied from the
+#  cache instead of being rendered.
+################################################################################
+
+
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+
+# The cache directory, inside the directory of the figures.
+CACHE_DIRNAME = '.figures_cache'
+
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('cannot fingerprint {!r}'.format(value))
+
+
+def fingerprint(parts):
+    """Return the SHA-256 hash of a dict of JSON-like values."""
+    encoded = json.dumps(parts, sort_keys=True, default=_to_json)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def cache_dir_for(output_dir):
+    return os.path.join(output_dir, CACHE_DIRNAME)
+
+
+def _stored_filename(cache_dir, key, target):
+    return os.path.join(cache_dir, key + os.path.splitext(target)[1])
+
+
+def is_cached(cache_dir, key, target):
+    return os.path.isfile(_stored_filename(cache_dir, key, target))
+
+
+def restore(cache_dir, key, target):
+    """Copy the file stored under  key  to  target , return False if there is
+    no such file."""
+    stored = _stored_filename(cache_dir, key, target)
+    if not os.path.isfile(stored):
+        return False
+    shutil.copyfile(stored, target)
+    return True
+
+
+def store(cache_dir, key, target):
+    """Store a copy of the file  target  under  key ."""
+    os.makedirs(cache_dir, exist_ok=True)
+    stored = _stored_filename(cache_dir, key, target)
+    # Copy and rename, so that the cache never holds a partial file.
+    shutil.copyfile(target, stored + '.tmp')
+    os.replace(stored + '.tmp', stored)
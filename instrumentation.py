@@ -0,0 +1,255 @@
+################################################################################
+#  Here we measure the time and the memory used by the named stages of
+#  plot_stars.py (reading the catalog, counting the stars, drawing, saving...).
+#  A stage is a block of code wrapped in
+#      with instrumentation.stage('name'):
+#          ...
+#  Stages can be nested, a nested stage is reported as 'outer/inner'.
+#  For each stage we record the wall time, the CPU time, how much the stage
+#  raised the peak resident memory (RSS) of the process, the process's peak
+#  RSS so far and, optionally, the peak of the memory allocated during the
+#  stage (tracemalloc, which also sees the NumPy arrays). The peak RSS is a
+#  high-water mark of the whole process: a stage using less memory than an
+#  earlier one doesn't raise it, and only tracemalloc sees its memory.
+#  The stages run in the workers of a pool report the peak RSS of their
+#  worker, not of the main process, so it isn't comparable with the peak of
+#  the other stages; their increases are.
+#  A chosen stage can also be profiled with cProfile.
+#  While the instrumentation is disabled (the default)  stage()  returns a
+#  context manager which does nothing.
+################################################################################
+
+
+
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, we don't report the peak RSS there.
+    resource = None
+
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+# The active recorder, None while disabled.
+_recorder = None
+
+# Lines of the cProfile statistics printed in the report.
+PROFILE_LINES = 25
+
+
+
+def _peak_rss():
+    # The peak resident memory of the process, in bytes.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class _Recorder:
+
+    def __init__(self, trace_allocations=False, profile_stage=None):
+        self.trace_allocations = trace_allocations
+        self.profile_stage = profile_stage
+        self.records = []
+        self.profiles = {}
+        self._stack = []
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def path(self, name):
+        return '/'.join([frame['path'] for frame in self._stack[-1:]] + [name])
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        frame = {'path': self.path(name), 'peak': 0}
+        if self.trace_allocations:
+            current, peak = tracemalloc.get_traced_memory()
+            # tracemalloc has a single peak: we save the one of the outer
+            # stage before resetting it.
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['start_memory'] = current
+        profiler = None
+        if self.profile_stage in (name, frame['path']):
+            profiler = cProfile.Profile()
+
+        self._stack.append(frame)
+        start_peak_rss = _peak_rss()
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            self._stack.pop()
+
+            process_peak_rss = _peak_rss()
+            record = {'stage': frame['path'], 'depth': len(self._stack),
+                      'wall': wall, 'cpu': cpu,
+                      'peak_rss_increase': (None if process_peak_rss is None
+                                            else process_peak_rss - start_peak_rss),
+                      'process_peak_rss': process_peak_rss}
+            if self.trace_allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(frame['peak'], peak)
+                record['allocated_peak'] = peak - frame['start_memory']
+                record['allocated_net'] = current - frame['start_memory']
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            self.records.append(record)
+
+            if profiler is not None:
+                output = io.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats(
+                    'cumulative').print_stats(PROFILE_LINES)
+                self.profiles[frame['path']] = output.getvalue()
+
+
+
+def enable(trace_allocations=False, profile_stage=None):
+    """Start recording the stages.
+
+    With  trace_allocations  the memory allocated in each stage is traced
+    (this slows the allocations down).  profile_stage  is the name (or the
+    'outer/inner' path) of a stage to be profiled with cProfile.
+    """
+    global _recorder
+    _recorder = _Recorder(trace_allocations, profile_stage)
+
+
+def disable():
+    global _recorder
+    if _recorder is not None and _recorder.trace_allocations:
+        tracemalloc.stop()
+    _recorder = None
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def options():
+    """Return the keyword arguments of  enable()  in use, None if disabled.
+
+    Used to enable the same instrumentation in worker processes.
+    """
+    if _recorder is None:
+        return None
+    return {'trace_allocations': _recorder.trace_allocations,
+            'profile_stage': _recorder.profile_stage}
+
+
+def stage(name):
+    """Return a context manager recording the stage  name ."""
+    if _recorder is None:
+        return _NULL_STAGE
+    return _recorder.stage(name)
+
+
+def collected():
+    """Return the records and the profiles of the recorded stages."""
+    if _recorder is None:
+        return [], {}
+    return list(_recorder.records), dict(_recorder.profiles)
+
+
+def add_collected(records, profiles):
+    """Add the records and profiles collected by another process (see
+    collected() ), as nested in the current stage."""
+    if _recorder is None:
+        return
+    prefix = _recorder.path('')
+    depth = len(_recorder._stack)
+    for record in records:
+        _recorder.records.append(dict(record, stage=prefix + record['stage'],
+                                      depth=depth + record['depth']))
+    for path, profile in profiles.items():
+        _recorder.profiles[prefix + path] = profile
+
+
+
+
+################################################################################
+#  Report.
+################################################################################
+
+def report():
+    """Return the report of the recorded stages, a dict ready for JSON.
+
+    The stages which ran more than once (e.g. in a loop) are summed up.
+    """
+    records, profiles = collected()
+    stages = {}
+    for record in records:
+        summary = stages.setdefault(record['stage'], {
+            'depth': record['depth'], 'calls': 0, 'wall': 0., 'cpu': 0.,
+            'peak_rss_increase': None, 'process_peak_rss': None})
+        summary['calls'] += 1
+        summary['wall'] += record['wall']
+        summary['cpu'] += record['cpu']
+        if record['process_peak_rss'] is not None:
+            summary['peak_rss_increase'] = ((summary['peak_rss_increase'] or 0)
+                                            + record['peak_rss_increase'])
+            summary['process_peak_rss'] = max(summary['process_peak_rss'] or 0,
+                                              record['process_peak_rss'])
+        if 'allocated_peak' in record:
+            summary['allocated_peak'] = max(summary.get('allocated_peak', 0),
+                                            record['allocated_peak'])
+            summary['allocated_net'] = (summary.get('allocated_net', 0)
+                                        + record['allocated_net'])
+
+    # Outer stages end after their inner stages: we list them in order of
+    # first appearance of their path prefix, so that they come first.
+    order = []
+    for path in stages:
+        for i in range(1, path.count('/') + 2):
+            prefix = '/'.join(path.split('/')[:i])
+            if prefix in stages and prefix not in order:
+                order.append(prefix)
+    return {'stages': {path: stages[path] for path in order},
+            'profiles': profiles}
+
+
+def format_table(report):
+    """Return the report as a human readable table."""
+    def mib(value):
+        return '{:10.1f}'.format(value / 2**20) if value is not None else '{:>10}'.format('-')
+
+    # RSS+ is the increase of the process's peak RSS during the stage, peak
+    # the process's peak RSS at its end.
+    lines = ['{:<36}{:>6}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'stage', 'calls', 'wall s', 'cpu s', 'RSS+ MiB', 'peak MiB', 'alloc MiB')]
+    for path, summary in report['stages'].items():
+        name = '  ' * summary['depth'] + path.rsplit('/', 1)[-1]
+        lines.append('{:<36}{:>6}{:>10.3f}{:>10.3f}'.format(
+            name, summary['calls'], summary['wall'], summary['cpu'])
+            + mib(summary['peak_rss_increase']) + mib(summary['process_peak_rss'])
+            + mib(summary.get('allocated_peak')))
+    for path, profile in report['profiles'].items():
+        lines += ['', 'cProfile of the stage {}:'.format(path), profile]
+    return '\n'.join(lines)
+
+
+def write_report(filename, file=sys.stderr):
+    """Save the report as JSON in  filename  and print it as a table."""
+    stage_report = report()
+    with open(filename, 'w') as report_file:
+        json.dump(stage_report, report_file, indent=2)
+    print(format_table(stage_report), file=file)
@@ -0,0 +1,130 @@
+################################################################################
+#  Here we estimate the density of the stars in a plane (e.g. log10 of the
+#  initial mass vs. metallicity) with a Gaussian kernel density estimate
+#  (KDE) computed on a grid:
+#    1) the stars are counted once in a fine 2D histogram (see binning.py),
+#    2) the histogram is convolved with the Gaussian kernel, through the FFT.
+#  The cost of 2) depends on the size of the grid, not on the number of
+#  stars. The width of the kernel (bandwidth) along each axis is given by
+#  Scott's rule, from the standard deviation of the counts.
+#  The first axis of the count arrays is the age group: each group has its
+#  own kernel and its density integrates to 1 over the grid.
+#  The contour levels are given as enclosed probabilities: the level of
+#  e.g. 0.68 is the density above which lie 68% of the stars of the group.
+################################################################################
+
+
+
+import numpy as np
+
+import binning
+
+
+
+# Size (in bandwidths) of the kernel, beyond it the Gaussian is cut.
+KERNEL_TRUNCATE = 4.
+
+
+
+def scott_bandwidths(counts, x_edges, y_edges):
+    """Return the bandwidths (x, y) of the kernel of each group, an array of
+    shape (groups, 2), from the counts on the grid  x_edges  x  y_edges ."""
+    counts = np.asarray(counts, dtype=float)
+    num_of_stars = counts.sum(axis=(1, 2))
+    bandwidths = np.empty((len(counts), 2))
+    for axis, edges in enumerate((x_edges, y_edges)):
+        # The counts along one axis, summed over the other.
+        marginal = counts.sum(axis=2 - axis)
+        centres = binning.bin_centres(edges)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (marginal * centres).sum(axis=1) / num_of_stars
+            variance = (marginal * (centres - mean[:, None])**2).sum(axis=1) / num_of_stars
+            bandwidths[:, axis] = np.sqrt(variance) * num_of_stars**(-1. / 6.)
+    # At least one bin, e.g. for a group with stars all in the same bin.
+    widths = [np.diff(x_edges[:2])[0], np.diff(y_edges[:2])[0]]
+    return np.where(np.isfinite(bandwidths), np.maximum(bandwidths, widths), widths)
+
+
+def gaussian_kernels(bandwidths, x_edges, y_edges, truncate=KERNEL_TRUNCATE):
+    """Return the kernels of the groups on the grid's bins, an array of shape
+    (groups, kx, ky) with odd kx, ky. Each kernel sums to 1."""
+    bandwidths = np.asarray(bandwidths, dtype=float)
+    # The bandwidths in bins.
+    sigmas = bandwidths / [np.diff(x_edges[:2])[0], np.diff(y_edges[:2])[0]]
+    radii = np.minimum(np.ceil(truncate * sigmas.max(axis=0)).astype(int),
+                       [len(x_edges) - 2, len(y_edges) - 2])
+    x = np.arange(-radii[0], radii[0] + 1)
+    y = np.arange(-radii[1], radii[1] + 1)
+    kernels = (np.exp(-0.5 * (x / sigmas[:, 0:1])**2)[:, :, None]
+               * np.exp(-0.5 * (y / sigmas[:, 1:2])**2)[:, None, :])
+    return kernels / kernels.sum(axis=(1, 2), keepdims=True)
+
+
+def _fft_length(n):
+    # The smallest length >= n with no prime factors above 5, for which the
+    # FFT is fast.
+    length = n
+    while True:
+        factor = length
+        for prime in (2, 3, 5):
+            while factor % prime == 0:
+                factor //= prime
+        if factor == 1:
+            return length
+        length += 1
+
+
+def smooth(counts, kernels):
+    """Convolve the counts of each group with its kernel, return an array of
+    the same shape as  counts  ( (..., groups, nx, ny) ).
+
+    The convolution is done with the FFT, padding the grid with zeros so that
+    the stars near an edge don't wrap around to the other one. float32 counts
+    are smoothed in single precision (faster), any other in double.
+    """
+    counts = np.asarray(counts)
+    if counts.dtype != np.float32:
+        counts = counts.astype(np.float64)
+    nx, ny = counts.shape[-2:]
+    kx, ky = kernels.shape[-2:]
+    shape = (_fft_length(nx + kx - 1), _fft_length(ny + ky - 1))
+    smoothed = np.fft.irfft2(np.fft.rfft2(counts, shape)
+                             * np.fft.rfft2(kernels.astype(counts.dtype), shape),
+                             shape)
+    # The 'same' part of the full convolution.
+    return smoothed[..., kx//2:kx//2 + nx, ky//2:ky//2 + ny]
+
+
+def density_grid(counts, x_edges, y_edges, bandwidths=None):
+    """Return the KDE of the stars counted on the grid  x_edges  x  y_edges ,
+    a dict with:
+      'density'    - array of shape  counts.shape , the density at the centres
+                     of the bins, normalised to 1 over the grid for each group,
+      'bandwidths' - the bandwidths used (see  scott_bandwidths() ).
+    counts  has shape  (..., groups, nx, ny) , the leading axes (e.g. the
+    resamples of the counts) share the same  bandwidths .
+    """
+    if bandwidths is None:
+        bandwidths = scott_bandwidths(counts, x_edges, y_edges)
+    smoothed = smooth(counts, gaussian_kernels(bandwidths, x_edges, y_edges))
+    # Rounding of the FFT can give tiny negative values.
+    np.maximum(smoothed, 0., out=smoothed)
+    bin_area = np.diff(x_edges[:2])[0] * np.diff(y_edges[:2])[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        density = smoothed / (smoothed.sum(axis=(-2, -1), keepdims=True) * bin_area)
+    return {'density': density, 'bandwidths': bandwidths}
+
+
+def enclosed_probability_levels(density, probabilities):
+    """Return the density levels enclosing the given probabilities: the
+    region where  density >= level  holds the fraction  probabilities[g]  of
+    the stars of group  g . The result has shape  density.shape[:-2] .
+    """
+    density = np.asarray(density)
+    cells = np.sort(density.reshape(density.shape[:-2] + (-1,)), axis=-1)[..., ::-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        enclosed = np.cumsum(cells, axis=-1) / cells.sum(axis=-1, keepdims=True)
+    probabilities = np.asarray(probabilities, dtype=float)[..., None]
+    # The first cell which brings the enclosed probability to the wanted one.
+    first = np.minimum((enclosed < probabilities).sum(axis=-1), cells.shape[-1] - 1)
+    return np.take_along_axis(cells, first[..., None], axis=-1)[..., 0]
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+
+
+################################################################################
+#  Here we run the analysis of plot_stars.py over many catalogs (e.g. many
+#  simulated clusters). The catalogs are given as directories or glob
+#  patterns, each one is processed by a pool of processes and its figures are
+#  saved in its own output directory, named after the catalog:
+#      <output dir>/<catalog name>/image_N.png
+#  A catalog is skipped when all its figures are up to date, i.e. they are in
+#  the figures' cache with the same data and parameters (see figure_cache.py).
+#  With  --ensemble  the catalogs are instead aggregated into a single set of
+#  figures 2, 4 and 5, as if they were one catalog (see ensemble.py).
+################################################################################
+
+
+
+import argparse
+import concurrent.futures
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+import density
+import ensemble
+import instrumentation
+import plot_stars
+
+
+
+# The extension of the catalogs searched for in a directory.
+CATALOG_EXTENSION = '.dat'
+
+
+
+def find_catalogs(sources):
+    """Return the sorted list of catalogs given as files, directories or globs."""
+    catalogs = set()
+    for source in sources:
+        if os.path.isdir(source):
+            catalogs.update(os.path.join(source, name)
+                            for name in os.listdir(source)
+                            if name.endswith(CATALOG_EXTENSION))
+        elif os.path.isfile(source):
+            catalogs.add(source)
+        else:
+            catalogs.update(path for path in glob.glob(source)
+                            if os.path.isfile(path))
+    return sorted(catalogs)
+
+
+def catalog_output_dir(data_filename, output_root):
+    name = os.path.splitext(os.path.basename(data_filename))[0]
+    return os.path.join(output_root, name)
+
+
+def _process_catalog(data_filename, output_dir, cmd_render, force):
+    start = time.perf_counter()
+    rendered = plot_stars.process_catalog(data_filename, output_dir=output_dir,
+                                          cmd_render=cmd_render, force=force)
+    return time.perf_counter() - start, rendered
+
+
+def process_catalogs(catalogs, output_root, jobs=1, force=False,
+                     cmd_render='scatter', log=sys.stdout):
+    """Process the catalogs with  jobs  processes, return the list of the
+    catalogs which failed."""
+    to_process = []
+    for data_filename in catalogs:
+        output_dir = catalog_output_dir(data_filename, output_root)
+        if not force and not plot_stars.stale_figures(data_filename, output_dir,
+                                                      cmd_render=cmd_render):
+            print('{}: up to date, skipped'.format(data_filename), file=log)
+        else:
+            to_process.append((data_filename, output_dir))
+
+    failed = []
+    if not to_process:
+        return failed
+
+    # We use 'spawn' so that the workers don't inherit the parent's state.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, min(jobs, len(to_process))),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=plot_stars._init_batch_worker) as executor:
+        futures = {executor.submit(_process_catalog, data_filename, output_dir,
+                                   cmd_render, force): (data_filename, output_dir)
+                   for data_filename, output_dir in to_process}
+        for future in concurrent.futures.as_completed(futures):
+            data_filename, output_dir = futures[future]
+            try:
+                elapsed, rendered = future.result()
+            except Exception as error:
+                failed.append(data_filename)
+                print('{}: FAILED ({})'.format(data_filename, error), file=log)
+            else:
+                print('{}: figures {} rendered in {:.1f} s -> {}'.format(
+                    data_filename, rendered, elapsed, output_dir), file=log)
+    return failed
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run plot_stars.py over many catalogs in parallel.')
+    parser.add_argument('sources', nargs='+',
+                        help='catalogs, directories (all the *{} files in '
+                             'them) or glob patterns'.format(CATALOG_EXTENSION))
+    parser.add_argument('-o', '--output-dir', default='plots',
+                        help='the figures of each catalog are saved in '
+                             'OUTPUT_DIR/<catalog name>/ (default: plots)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of catalogs processed at the same time '
+                             '(default: number of CPUs)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='process the catalogs even if their figures are '
+                             'up to date')
+    parser.add_argument('--cmd-render', default='scatter',
+                        choices=('scatter',) + density.RENDER_MODES,
+                        help='see  plot_stars.py --help')
+    parser.add_argument('--ensemble', metavar='DIR',
+                        help='aggregate the stars of all the catalogs, as if '
+                             'they were a single catalog, into figures 2, 4 '
+                             'and 5 saved in DIR. The catalogs are read in '
+                             'chunks by JOBS processes, they need not fit in '
+                             'memory together. See ensemble.py')
+    parser.add_argument('--instrument', metavar='REPORT',
+                        help='with --ensemble, see  plot_stars.py --help')
+    args = parser.parse_args(argv)
+    if args.instrument and not args.ensemble:
+        parser.error('--instrument needs --ensemble')
+
+    catalogs = find_catalogs(args.sources)
+    if not catalogs:
+        parser.error('no catalogs found')
+
+    if args.ensemble:
+        plot_stars.use_batch_backend()
+        if args.instrument:
+            instrumentation.enable()
+        try:
+            ensemble.process_ensemble(catalogs, args.ensemble, jobs=args.jobs)
+        finally:
+            if args.instrument:
+                instrumentation.write_report(args.instrument)
+        print('{} catalogs aggregated -> {}'.format(len(catalogs), args.ensemble))
+        return
+
+    # Catalogs with the same name would write to the same output directory.
+    output_dirs = [catalog_output_dir(path, args.output_dir) for path in catalogs]
+    if len(set(output_dirs)) != len(output_dirs):
+        parser.error('two or more catalogs have the same name')
+
+    failed = process_catalogs(catalogs, args.output_dir, jobs=args.jobs,
+                              force=args.force, cmd_render=args.cmd_render)
+    if failed:
+        sys.exit('{} of {} catalogs failed'.format(len(failed), len(catalogs)))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -3,365 +3,950 @@
 
 
 ################################################################################
-#  After downloading the file   
+#  After downloading the file
 #      https://github.com/MilenaValentini/TRM_Dati/blob/main/Nemo_6670.dat
 #  we scatter plot the stars' colour vs magnitude. Then, we colour code the
-#  scatter plot by assigning a colour to stars in each age group. 
+#  scatter plot by assigning a colour to stars in each age group.
+#  The other figures show the metallicity and the initial mass of the stars,
+#  grouped by age.
+#
+#  Each figure is drawn by its own function  plot_image_N() . In batch mode
+#  (see  --batch ) the figures are not shown on screen, and they are rendered
+#  at the same time by a pool of processes which read the stars' data from
+#  shared memory. Only the figures whose data or parameters changed since the
+#  last run are rendered again, the others are taken from a cache.
+#  With  --source  the catalog is first downloaded (see fetch.py), and parsed
+#  while the download is in progress.
+#
+#  The script can also be imported as a module, e.g.
+#      import plot_stars
+#      data = plot_stars.load_catalog('Nemo_6670.dat')
+#      figures_data = plot_stars.compute_figures_data(data)
+#      plot_stars.render_figure(2, data, figures_data, output_dir='plots')
+#  Matplotlib is only imported when a figure is rendered, so computing the
+#  histograms and the statistics doesn't pay for its start-up.
 ################################################################################
 
 
 
 
 
+import argparse
+import concurrent.futures
+import hashlib
+import inspect
+import multiprocessing
+import os
 import sys
-from matplotlib import pyplot as plt
-from matplotlib import colors as mcolors
-from matplotlib import lines as mlines
+
 import numpy as np
 
+import age_groups
+import binning
+import catalog
+import confidence_bands
+import density
+import fetch
+import figure_cache
+import instrumentation
+import kde
+import shared_arrays
+import spatial_index
+import stats_export
+import streaming_stats
+import tile_pyramid
 
 
-# First we read the file name of the downloaded file given as an argument to 
-# launch this script
-data_filename = sys.argv[1]
 
+# We create the arrays age_bins_edges to colormap the plot. Each dot in the
+# scatter plot will be coloured according to its age. We have 35 age bins.
+# Note: since there are 35 bins, then the bins delimiters have to be
+# 35 + 1, thus the array has a  len()  equal to 36.
+age_bins_edges = [0, 0.05, 0.11, 0.18, 0.25, 0.33,
+                  0.41, 0.51, 0.61, 0.73, 0.85, 0.99,
+                  1.14, 1.3, 1.48, 1.68, 1.89, 2.13,
+                  2.39, 2.67, 2.99, 3.33, 3.7, 4.12,
+                  4.57, 5.06, 5.60, 6.20, 6.85, 7.57,
+                  8.35, 9.21, 10.15, 11.19, 12.32, 13.56]
 
+# We used MS Paint's "color picker" tool to read the RGB values of the 35 colors
+# in the legend of the image. We saved the 35 RGB values in a file, which is
+# kept next to this script (not looked for in the current directory):
+rgb_colors_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'colors.txt')
+
+# The limits of the axes of the colour-magnitude diagram (image_1.png), the
+# magnitudes axis is inverted. The tile pyramid of the zoomed views covers
+# this region.
+cmd_xlim = (-0.1, 1.0)
+cmd_ylim = (8.5, -4.1)
+
+# We split the stars in age groups. The delimiters of the groups (in Gyr) are
+# stored in the array below: with two delimiters we get three groups,
+# i.e.  t < 1,  1 <= t < 3  and  t >= 3 .
+age_bins_separator = [1, 3]
 
-# We read the file and use columns 5, 9, 13, 1, 2, then assign the columns to 5 
-# arrays named after the columns (each col in the file has a #header label).
-data = np.loadtxt(data_filename, delimiter=' ', usecols=(4, 8, 12, 0, 1), unpack=True)
-M_ass = data[0]
-b_y = data[1]
-age_parent = data[2]
-MsuH = data[3]
-m_ini = data[4]
+# We set the number of bins.
+# Experimentation showed that starting from 100 bins, and halfing down the value
+# twice we don't lose detail. In fact, some of the bins had 0 frequencies.
+# The histogram somehow shows that metallicities values are close to 27 distinct
+# values.
+num_of_bins = 27
 
+# Number of bins (along each axis) of the 2D histograms.
+num_of_bins_2d = 22
 
+# The contours of image_5.png are drawn from a kernel density estimate of
+# the stars of each age group, in the plane log10(initial mass)-metallicity,
+# on a grid of  kde_grid_size  bins along each axis (see kde.py).
+kde_grid_size = 100
 
-# We create the arrays age_bins_edges to colormap the plot. Each dot in the 
-# scatter plot will be coloured according to its age. We have 35 age bins.
-# Note: since there are 35 bins, then the bins delimiters have to be 
-# 35 + 1, thus the array has a  len()  equal to 36.
-age_bins_edges = [0, 0.05, 0.11, 0.18, 0.25, 0.33, 
-                  0.41, 0.51, 0.61, 0.73, 0.85, 0.99, 
-                  1.14, 1.3, 1.48, 1.68, 1.89, 2.13, 
-                  2.39, 2.67, 2.99, 3.33, 3.7, 4.12, 
-                  4.57, 5.06, 5.60, 6.20, 6.85, 7.57, 
-                  8.35, 9.21, 10.15, 11.19, 12.32, 13.56]
+# The contour of each age group encloses this fraction of its stars.
+# Groups beyond the third one use the last value.
+contour_probabilities = [0.68, 0.68, 0.68]
 
+# The confidence bands drawn around the histograms of image_2.png and the
+# contours of image_5.png: 'bootstrap' or 'poisson' resampling of the counts
+# (see confidence_bands.py), or None for no bands.
+bands = 'bootstrap'
+bands_resamples = 1000
+bands_confidence = 0.95
 
+# Colours and markers of the age groups. If there are more than three age
+# groups we continue with Matplotlib's default colours.
+age_groups_colors = ['red', 'green', 'blue',
+                     'tab:orange', 'tab:purple', 'tab:brown', 'tab:pink',
+                     'tab:gray', 'tab:olive', 'tab:cyan']
+age_groups_markers = ['s', 'o', '^', 'D', 'v', 'P', '*', 'X', '<', '>']
 
-# We used MS Paint's "color picker" tool to read the RGB values of the 35 colors
-# in the legend of the image. We saved the 35 RGB values in a file:
-rgb_colors_filename = 'colors.txt'
+# The figures, numbered as the files they are saved to (image_N.png).
+FIGURES = (1, 2, 3, 4, 5)
 
-# We read the file and use columns 1, 2, 3, which contain RGB values of the 35 
-# colors, stored as int values ranging from 0 to 255.
-colors_from_paint = np.loadtxt(rgb_colors_filename, delimiter=',', 
-                               usecols=(0, 1, 2), unpack=True)
 
-# Here we create a 2D array which will have the shape 35 x 3.
-col_rgb = np.vstack((colors_from_paint)).T
 
-# Here we divide all the RGB values by 255 to create Matplotlib RGB values in 
-# the interval [0, 1] .
-col_rgb = col_rgb/255.
+def read_colormap(rgb_colors_filename=rgb_colors_filename,
+                  age_bins_edges=age_bins_edges):
+    """Return the colormap and the norm of the colour-magnitude diagram."""
+    from matplotlib import colors as mcolors
 
-# We use the helper routine  from_levels_and_colors()  to:
-#  * to convert data values (floats) from the interval [0, 1] to the RGB color 
-#    that the Colormap represents,
-#  * linearly normalize data into the [0.0, 1.0] interval.
-custom_colormap, norm = mcolors.from_levels_and_colors(age_bins_edges, col_rgb)
+    # We read the file and use columns 1, 2, 3, which contain RGB values of the
+    # 35 colors, stored as int values ranging from 0 to 255.
+    colors_from_paint = np.loadtxt(rgb_colors_filename, delimiter=',',
+                                   usecols=(0, 1, 2), unpack=True)
 
+    # Here we create a 2D array which will have the shape 35 x 3.
+    col_rgb = np.vstack((colors_from_paint)).T
 
+    # Here we divide all the RGB values by 255 to create Matplotlib RGB values
+    # in the interval [0, 1] .
+    col_rgb = col_rgb/255.
 
-# We initialise the subplots
-fig1, ax1 = plt.subplots(figsize=(14,11))
+    # We use the helper routine  from_levels_and_colors()  to:
+    #  * to convert data values (floats) from the interval [0, 1] to the RGB
+    #    color that the Colormap represents,
+    #  * linearly normalize data into the [0.0, 1.0] interval.
+    return mcolors.from_levels_and_colors(age_bins_edges, col_rgb)
 
-# set axes' limits
-plt.ylim(8.5, -4.1)
-plt.xlim(-0.1, 1.0)
 
-# set axes' labels
-fig1.subplots_adjust(top=0.935)
-fig1.suptitle("Colour coded scatter plot: stars' Colour vs. Magnitude.", fontsize=16)
-ax1.set_title('Colours codify the age of the stars.')
-ax1.set_xlabel(r'$b-y$')
-ax1.set_ylabel(r'$M_V$')
 
-# set ticks parameters along the edges (axes)
-ax1.tick_params(direction='in', 
-                labelbottom=True, labeltop=False, 
-                labelleft=True, labelright=False, 
-                bottom=True, top=True, left=True, right=True)
+def load_catalog(data_filename):
+    """Return the catalog's columns as a dict of arrays (see catalog.py)."""
+    # We read the file in chunks and use columns 5, 9, 13, 1, 2, saving them in
+    # a dict of 5 arrays named after the columns (each col in the file has a
+    # #header label). The columns are saved in a binary cache the first time,
+    # the following runs memory-map the cache instead of parsing the file.
+    return catalog.load_catalog_cached(data_filename)
 
 
+################################################################################
+#  The histograms and the statistics of figures 2, 4 and 5 are computed from
+#  partial results of chunks of  CHUNK_ROWS  consecutive stars, which are then
+#  merged. We go through the chunks twice:
+#    1) for the range (min and max) of the values, which gives the edges of
+#       the bins,
+#    2) for the counts per bin and the moments of the metallicity (see
+#       streaming_stats.py).
+#  The ranges and the counts give the same result whatever the order they
+#  are merged in. The moments are merged in the order of the chunks: so the
+#  result is exactly the same when the chunks are computed in different
+#  processes, or come from different files (see ensemble.py).
+################################################################################
+
+# The columns the figures' data is computed from.
+FIGURES_DATA_COLUMNS = ('age_parent', 'MsuH', 'm_ini')
+CHUNK_ROWS = streaming_stats.DEFAULT_CHUNK_ROWS
+
+
+def iter_chunks(data, chunk_rows=CHUNK_ROWS, columns=FIGURES_DATA_COLUMNS):
+    """Yield the chunks of the catalog's columns, dicts {name: slice}."""
+    for start in range(0, len(data[columns[0]]), chunk_rows):
+        yield {name: data[name][start:start+chunk_rows] for name in columns}
+
+
+def _chunk_age_groups(chunk, age_bins_separator):
+    # The age group of each star of the chunk, unless already known.
+    if 'age_group' in chunk:
+        return chunk['age_group']
+    return age_groups.assign_age_groups(chunk['age_parent'], age_bins_separator)
+
+
+def reduce_partials(partials, merge):
+    """Merge the partial results, in order, with  merge(a, b) ."""
+    result = None
+    for partial in partials:
+        result = partial if result is None else merge(result, partial)
+    return result
+
+
+def ranges_partial(chunk, age_bins_separator=age_bins_separator):
+    """Return the ranges of the values of a chunk (see  iter_chunks() )."""
+    num_of_age_groups = len(age_bins_separator) + 1
+    age_group_of_star = _chunk_age_groups(chunk, age_bins_separator)
+    MsuH = np.asarray(chunk['MsuH'])
+    m_ini = np.asarray(chunk['m_ini'])
+    return {
+        'age_groups_sizes': np.bincount(age_group_of_star, minlength=num_of_age_groups),
+        'metallicity_min': np.min(MsuH, initial=np.inf),
+        'metallicity_max': np.max(MsuH, initial=-np.inf),
+        'mass_min': np.min(m_ini, initial=np.inf),
+        'mass_max': np.max(m_ini, initial=-np.inf),
+        # The smallest mass with a logarithm.
+        'positive_mass_min': np.min(m_ini[m_ini > 0], initial=np.inf),
+        'mass_min_by_age': np.array([np.min(m_ini[age_group_of_star == i], initial=np.inf)
+                                     for i in range(num_of_age_groups)]),
+        'mass_max_by_age': np.array([np.max(m_ini[age_group_of_star == i], initial=-np.inf)
+                                     for i in range(num_of_age_groups)]),
+    }
+
+
+def merge_ranges(a, b):
+    """Return the ranges of the union of two chunks."""
+    merged = {name: (np.maximum if '_max' in name else np.minimum)(a[name], b[name])
+              for name in a if name != 'age_groups_sizes'}
+    merged['age_groups_sizes'] = a['age_groups_sizes'] + b['age_groups_sizes']
+    return merged
+
+
+def figures_edges(ranges, num_of_bins=num_of_bins, num_of_bins_2d=num_of_bins_2d):
+    """Return the edges of the bins of the figures' histograms, from the
+    ranges of the values (see  ranges_partial() )."""
+    num_of_age_groups = len(ranges['age_groups_sizes'])
+
+    # We find metallicity min and max values first, and round them
+    stars_metallicity_min = np.floor(ranges['metallicity_min']*10)/10.
+    stars_metallicity_max = np.ceil(ranges['metallicity_max']*10)/10.
+    stars_metallicity_histogram_bins = np.linspace(stars_metallicity_min,
+                                                   stars_metallicity_max,
+                                                   num_of_bins+1)
+
+    stars_mass_min = np.floor(ranges['mass_min']*10)/10.
+    stars_mass_max = np.ceil(ranges['mass_max']*10)/10.
+
+    # We compute the boundaries of the masses in each age group. An age group
+    # without stars (e.g. beyond the oldest star) has no range of its own, it
+    # gets the range of all the stars.
+    dict_stars_mass_by_age_min = {}
+    dict_stars_mass_by_age_max = {}
+    for i in range(num_of_age_groups):
+        if (np.isfinite(ranges['mass_min_by_age'][i])
+                and np.isfinite(ranges['mass_max_by_age'][i])):
+            dict_stars_mass_by_age_min[i] = np.floor(ranges['mass_min_by_age'][i]*10)/10.
+            dict_stars_mass_by_age_max[i] = np.ceil(ranges['mass_max_by_age'][i]*10)/10.
+        else:
+            dict_stars_mass_by_age_min[i] = stars_mass_min
+            dict_stars_mass_by_age_max[i] = stars_mass_max
+
+    # We count the stars per age group, initial mass bin and metallicity bin
+    # once, the 2D histograms and the contours are drawn from these counts.
+    # We need two count cubes:
+    #  * for the 2D histograms of each age group, where the mass range depends
+    #    on the age group,
+    #  * for the histogram of all stars and the contours, where all the age
+    #    groups share the same mass range.
+    metallicity_edges_2d = binning.uniform_edges(stars_metallicity_min-0.1,
+                                                 stars_metallicity_max+0.1,
+                                                 num_of_bins_2d)
+    mass_edges_by_age = np.array([
+        binning.uniform_edges(dict_stars_mass_by_age_min[i]-0.1,
+                              dict_stars_mass_by_age_max[i]+0.1, num_of_bins_2d)
+        for i in range(num_of_age_groups)
+    ])
+    mass_edges_2d = binning.uniform_edges(stars_mass_min-0.1, stars_mass_max+0.1,
+                                          num_of_bins_2d)
+
+    # For the contours we count the stars on a finer grid, uniform in
+    # log10(initial mass). The grid extends a bit beyond the stars, so that
+    # the density goes to zero before its edges.
+    log_mass_min = np.log10(ranges['positive_mass_min'])
+    log_mass_max = np.log10(ranges['mass_max'])
+    log_mass_pad = 0.15 * (log_mass_max - log_mass_min)
+    metallicity_pad = 0.15 * (ranges['metallicity_max'] - ranges['metallicity_min'])
+    log_mass_edges_kde = binning.uniform_edges(log_mass_min - log_mass_pad,
+                                               log_mass_max + log_mass_pad,
+                                               kde_grid_size)
+    metallicity_edges_kde = binning.uniform_edges(ranges['metallicity_min'] - metallicity_pad,
+                                                  ranges['metallicity_max'] + metallicity_pad,
+                                                  kde_grid_size)
+
+    return {
+        'stars_metallicity_min': stars_metallicity_min,
+        'stars_metallicity_max': stars_metallicity_max,
+        'stars_metallicity_histogram_bins': stars_metallicity_histogram_bins,
+        'stars_mass_min': stars_mass_min,
+        'stars_mass_max': stars_mass_max,
+        'metallicity_edges_2d': metallicity_edges_2d,
+        'mass_edges_by_age': mass_edges_by_age,
+        'mass_edges_2d': mass_edges_2d,
+        'log_mass_edges_kde': log_mass_edges_kde,
+        'metallicity_edges_kde': metallicity_edges_kde,
+    }
+
+
+# The count cubes whose first axis is the fine age bin (see
+# age_groups.fine_age_separators() ) instead of the age group: the cube of
+# any grouping of the fine bins is the sum of its slices (see
+# regroup_cube() ), the stars are not needed again. The 2D histograms of
+# figure 4 are counted by age group, since their mass bins depend on the
+# mass range of each group.
+FINE_AGE_COUNTS = ('metallicity_counts', 'mass_metallicity_counts', 'kde_counts')
+
+
+def fine_age_separators(age_bins_separator=age_bins_separator):
+    """Return the delimiters of the fine age bins of the count cubes: those
+    of the colour bins of image_1.png and of the age groups."""
+    return age_groups.fine_age_separators(age_bins_separator, age_bins_edges)
+
+
+def _chunk_age_bins(chunk, age_bins_separator):
+    # The age group and the fine age bin of each star of the chunk.
+    return (_chunk_age_groups(chunk, age_bins_separator),
+            age_groups.assign_age_groups(chunk['age_parent'],
+                                         fine_age_separators(age_bins_separator)))
+
+
+def _count(age_bin_of_star, num_of_age_bins, axes):
+    return binning.count_cube(age_bin_of_star, num_of_age_bins, axes,
+                              chunk_rows=max(len(age_bin_of_star), 1))['counts']
+
+
+def counts_1d_partial(chunk, edges, age_bins_separator=age_bins_separator,
+                      age_bins=None):
+    """Return the metallicity counts per fine age bin and the metallicity
+    moments per age group of a chunk (figure 2), see  counts_partial() .
+    age_bins  are the age groups and fine age bins of its stars, if known."""
+    num_of_age_groups = len(age_bins_separator) + 1
+    age_group_of_star, age_bin_of_star = (age_bins if age_bins is not None
+                                          else _chunk_age_bins(chunk, age_bins_separator))
+    MsuH = np.asarray(chunk['MsuH'])
+    return {
+        'metallicity_counts': _count(age_bin_of_star,
+                                     len(fine_age_separators(age_bins_separator)) + 1,
+                                     [(MsuH, edges['stars_metallicity_histogram_bins'])]),
+        'metallicity_moments': streaming_stats.chunk_moments(MsuH, age_group_of_star,
+                                                             num_of_age_groups),
+    }
+
+
+def counts_2d_partial(chunk, edges, age_bins_separator=age_bins_separator,
+                      age_bins=None):
+    """Return the mass-metallicity counts of a chunk (figures 4 and 5, and the
+    density estimate of figure 5), see  counts_partial() .  age_bins  are the
+    age groups and fine age bins of its stars, if known."""
+    num_of_age_groups = len(age_bins_separator) + 1
+    num_of_age_bins = len(fine_age_separators(age_bins_separator)) + 1
+    age_group_of_star, age_bin_of_star = (age_bins if age_bins is not None
+                                          else _chunk_age_bins(chunk, age_bins_separator))
+    MsuH = np.asarray(chunk['MsuH'])
+    m_ini = np.asarray(chunk['m_ini'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_mass = np.log10(m_ini)
+    return {
+        'mass_metallicity_counts_by_age': _count(
+            age_group_of_star, num_of_age_groups,
+            [(m_ini, edges['mass_edges_by_age']), (MsuH, edges['metallicity_edges_2d'])]),
+        'mass_metallicity_counts': _count(
+            age_bin_of_star, num_of_age_bins,
+            [(m_ini, edges['mass_edges_2d']), (MsuH, edges['metallicity_edges_2d'])]),
+        'kde_counts': _count(
+            age_bin_of_star, num_of_age_bins,
+            [(log_mass, edges['log_mass_edges_kde']), (MsuH, edges['metallicity_edges_kde'])]),
+    }
+
+
+def counts_partial(chunk, edges, age_bins_separator=age_bins_separator):
+    """Return the counts per bin and the metallicity moments of a chunk (see
+    iter_chunks() ),  edges  are the edges of the bins (see  figures_edges() ).
+    The first axis of the cubes  FINE_AGE_COUNTS  is the fine age bin."""
+    # We count the stars per age bin (or group) and bin once, the histograms
+    # are drawn from these counts. See binning.py.
+    age_bins = _chunk_age_bins(chunk, age_bins_separator)
+    counts = counts_1d_partial(chunk, edges, age_bins_separator, age_bins)
+    counts.update(counts_2d_partial(chunk, edges, age_bins_separator, age_bins))
+    return counts
+
+
+def merge_counts(a, b):
+    """Return the counts (and moments) of two chunks, the chunk of  a  comes
+    first."""
+    return {name: (streaming_stats.merge_moments(a[name], b[name])
+                   if name == 'metallicity_moments' else a[name] + b[name])
+            for name in a}
+
+
+def regroup_cube(fine_counts, fine_separators, age_bins_separator=age_bins_separator):
+    """Return the count cube by age group of a cube by fine age bin (see
+    FINE_AGE_COUNTS  and the 'fine_age_counts' of  compute_figures_data() ),
+    for any age groups delimited by some of the  fine_separators ."""
+    return binning.regroup_counts(
+        fine_counts, age_groups.groups_of_fine_bins(fine_separators, age_bins_separator),
+        len(age_bins_separator) + 1)
+
+
+def figures_data_from_partials(ranges, edges, counts, metallicity_medians,
+                               age_bins_separator=age_bins_separator, bands=bands,
+                               with_contour_bands=True):
+    """Return the data of figures 2, 4 and 5 from the merged ranges and
+    counts of all the chunks and the medians of the metallicity (see
+    compute_figures_data() , which also adds the arrays with one value per
+    star)."""
+    num_of_age_groups = len(age_bins_separator) + 1
+    # The counts by fine age bin, summed by age group.
+    fine_separators = fine_age_separators(age_bins_separator)
+    fine_age_counts = {name: counts[name] for name in FINE_AGE_COUNTS}
+    counts = dict(counts, **{name: regroup_cube(fine_age_counts[name], fine_separators,
+                                                age_bins_separator)
+                             for name in FINE_AGE_COUNTS})
+
+    # The empty age groups have no histogram and no contour, their label
+    # says so.
+    labels = age_groups.age_group_labels(age_bins_separator)
+    for i in range(num_of_age_groups):
+        if ranges['age_groups_sizes'][i] == 0:
+            labels[i] += '(no stars) '
+
+    def cube(name, *axes):
+        return {'counts': counts[name],
+                'edges': [np.asarray(edges[axis], dtype=float) for axis in axes]}
+
+    metallicity_cube = cube('metallicity_counts', 'stars_metallicity_histogram_bins')
+    mass_metallicity_cube = cube('mass_metallicity_counts', 'mass_edges_2d',
+                                 'metallicity_edges_2d')
+    log_mass_edges_kde = edges['log_mass_edges_kde']
+    metallicity_edges_kde = edges['metallicity_edges_kde']
+
+    # We smooth the fine counts of each age group with a Gaussian kernel.
+    with instrumentation.stage('density'):
+        mass_metallicity_kde = kde.density_grid(counts['kde_counts'],
+                                                log_mass_edges_kde, metallicity_edges_kde)
+        probabilities = [contour_probability(i) for i in range(num_of_age_groups)]
+        contour_density_levels = kde.enclosed_probability_levels(
+            mass_metallicity_kde['density'], probabilities)
+
+    # The confidence bands of the metallicity histograms and of the mass-
+    # metallicity counts the contours are drawn from, from resampled counts.
+    # The band of a contour is where the density minus the contour level,
+    # both estimated again from each resample, can be zero.
+    metallicity_bands = mass_metallicity_bands = contour_bands = None
+    if bands is not None:
+        def density_above_level(resamples, group):
+            density = kde.density_grid(
+                resamples.astype(np.float32), log_mass_edges_kde, metallicity_edges_kde,
+                mass_metallicity_kde['bandwidths'][group:group+1])['density']
+            levels = kde.enclosed_probability_levels(density, probabilities[group])
+            return density - levels[..., None, None]
+
+        with instrumentation.stage('confidence_bands'):
+            metallicity_bands = confidence_bands.count_bands(
+                metallicity_cube['counts'], bands, bands_resamples, bands_confidence)
+            mass_metallicity_bands = confidence_bands.count_bands(
+                mass_metallicity_cube['counts'], bands, bands_resamples,
+                bands_confidence)
+            # The band of the contours is the slow one (a density estimate
+            # for each resample), and only figure 5 draws it.
+            if with_contour_bands:
+                contour_bands = confidence_bands.estimate_bands(
+                    counts['kde_counts'], density_above_level, bands,
+                    bands_resamples, bands_confidence)
+
+    return dict(edges, **{
+        'num_of_age_groups': num_of_age_groups,
+        'age_groups_sizes': ranges['age_groups_sizes'],
+        'metallicity_cube': metallicity_cube,
+        'metallicity_moments': counts['metallicity_moments'],
+        'metallicity_medians': metallicity_medians,
+        'mass_metallicity_cube_by_age': cube('mass_metallicity_counts_by_age',
+                                             'mass_edges_by_age', 'metallicity_edges_2d'),
+        'mass_metallicity_cube': mass_metallicity_cube,
+        'mass_metallicity_density': mass_metallicity_kde['density'],
+        'kde_bandwidths': mass_metallicity_kde['bandwidths'],
+        'contour_density_levels': contour_density_levels,
+        'bands': bands,
+        'metallicity_bands': metallicity_bands,
+        'mass_metallicity_bands': mass_metallicity_bands,
+        'contour_bands': contour_bands,
+        'fine_age_separators': fine_separators,
+        'fine_age_counts': fine_age_counts,
+        # We create dictionaries of labels and colors for iteration purposes
+        'dict_stars_metallicity_by_age_labels': labels,
+        'dict_stars_metallicity_by_age_colors': {
+            i: age_groups_colors[i % len(age_groups_colors)]
+            for i in range(num_of_age_groups)
+        },
+    })
+
+
+def compute_figures_data(data, age_bins_separator=age_bins_separator,
+                         num_of_bins=num_of_bins, num_of_bins_2d=num_of_bins_2d,
+                         bands=bands, with_contour_bands=True):
+    """Compute everything figures 2 to 5 need, except the stars' columns.
+
+    bands  is the method of the confidence bands of the histograms (see
+    confidence_bands.py), None for no bands. Without  with_contour_bands  the
+    band of the contours of figure 5 (the slowest to compute) is left out.
+
+    data  is the dict of the catalog's columns (see catalog.py). The result is
+    a dict, its arrays with one value per star are 'age_group_of_star' and
+    'age_groups_order'. Its 'fine_age_counts' are the count cubes by fine age
+    bin, from which  regroup_cube()  gives the histograms of other age groups
+    without the stars (not the 2D histograms of figure 4, nor the mean and
+    the median of figure 2).
+    """
+    MsuH = data['MsuH']
+    num_of_age_groups = len(age_bins_separator) + 1
+
+    # The stars are split with a single pass over their ages: for each star we
+    # get its age group and for each group we get the row indices of its stars,
+    # which we can use with every column. See age_groups.py.
+    with instrumentation.stage('partition'):
+        age_group_of_star = age_groups.assign_age_groups(data['age_parent'],
+                                                         age_bins_separator)
+        age_groups_order, age_groups_sizes = age_groups.sort_by_group(age_group_of_star,
+                                                                      num_of_age_groups)
+
+    def chunks():
+        for start, chunk in zip(range(0, len(MsuH), CHUNK_ROWS), iter_chunks(data)):
+            chunk['age_group'] = age_group_of_star[start:start+CHUNK_ROWS]
+            yield chunk
+
+    with instrumentation.stage('ranges'):
+        ranges = reduce_partials((ranges_partial(chunk, age_bins_separator)
+                                  for chunk in chunks()), merge_ranges)
+        edges = figures_edges(ranges, num_of_bins, num_of_bins_2d)
+    with instrumentation.stage('counts'):
+        counts = reduce_partials((counts_partial(chunk, edges, age_bins_separator)
+                                  for chunk in chunks()), merge_counts)
+
+    # We compute the exact median of the metallicity of each age group going
+    # through the stars in chunks. See streaming_stats.py.
+    def metallicity_chunks():
+        return streaming_stats.iter_group_chunks(MsuH, age_group_of_star)
+    with instrumentation.stage('statistics'):
+        metallicity_medians = streaming_stats.group_medians(
+            metallicity_chunks, num_of_age_groups, moments=counts['metallicity_moments'])
+
+    figures_data = figures_data_from_partials(ranges, edges, counts, metallicity_medians,
+                                              age_bins_separator, bands,
+                                              with_contour_bands)
+    figures_data.update({'age_group_of_star': age_group_of_star,
+                         'age_groups_order': age_groups_order})
+    return figures_data
+
+
+def stars_by_age(column, figures_data):
+    """Return a dict {age group: values of  column  for the stars in group}."""
+    return age_groups.split_column(
+        column, age_groups.split_order(figures_data['age_groups_order'],
+                                       figures_data['age_groups_sizes']))
+
+
+
+def figure_filename(number, output_dir='.'):
+    return os.path.join(output_dir, 'image_{}.png'.format(number))
+
+
+def _save_figure(fig, number, output_dir, show):
+    _save_figure_as(fig, figure_filename(number, output_dir), show)
+
+
+def _save_figure_as(fig, filename, show):
+    from matplotlib import pyplot as plt
+
+    with instrumentation.stage('savefig'):
+        plt.savefig(filename, bbox_inches='tight')
+    if show:
+        plt.show()
+    plt.close(fig)
+
+
+def _cmd_figure(xlim=cmd_xlim, ylim=cmd_ylim):
+    # The figure and the axes of the colour-magnitude diagram, without the
+    # stars.
+    from matplotlib import pyplot as plt
+
+    # We initialise the subplots
+    fig1, ax1 = plt.subplots(figsize=(14,11))
+
+    # set axes' limits
+    plt.ylim(*ylim)
+    plt.xlim(*xlim)
+
+    # set axes' labels
+    fig1.subplots_adjust(top=0.935)
+    fig1.suptitle("Colour coded scatter plot: stars' Colour vs. Magnitude.", fontsize=16)
+    ax1.set_title('Colours codify the age of the stars.')
+    ax1.set_xlabel(r'$b-y$')
+    ax1.set_ylabel(r'$M_V$')
+
+    # set ticks parameters along the edges (axes)
+    ax1.tick_params(direction='in',
+                    labelbottom=True, labeltop=False,
+                    labelleft=True, labelright=False,
+                    bottom=True, top=True, left=True, right=True)
+
+    return fig1, ax1
+
+
+def _cmd_legend(ax1, custom_colormap):
+    from matplotlib import lines as mlines
+
+    # Here we add the elements to the legend of the plot.
+    # Firste we create an array to store legend handles to be used in  legend() .
+    legend_dots = []
+
+    # Here we append the legend handles to the array.
+    # Each handle contains a Line2D Artist, where only the markers will be used
+    # to represent the colors in the plot, and a legend string.
+    for i in range( len(age_bins_edges) -1 ):
+        legend_label_text = "{} Gyr - {} Gyr".format(
+            str( f'{age_bins_edges[i]:.2f}' ), str( f'{age_bins_edges[i+1]:.2f}' )
+        )
+        legend_dots.append(
+            mlines.Line2D( [0], [0], marker='o', markersize=7, color='w',
+                          markerfacecolor=custom_colormap.colors[i],
+                          label=legend_label_text
+                         )
+        )
 
-# Scatter plot. We set: 
-# c - color each dot according to the star's age and the color mapping, 
-# ec - edge color (white), 
-# lw - line width of each dot's edge, 
-# s - size of the dots, 
-# cmap and norm - parameters for the color mapping
-ax1.scatter(b_y, M_ass, c=age_parent, ec='k', lw=0, s=10, 
-            cmap=custom_colormap, norm=norm)
+    # We call legend()
+    ax1.legend(loc='upper right', handles=legend_dots)
 
 
+def plot_image_1(data, figures_data, output_dir='.', show=False,
+                 cmd_render='scatter'):
+    """Colour coded scatter plot: stars' colour vs. magnitude (image_1.png)."""
+    M_ass = data['M_ass']
+    b_y = data['b_y']
+    age_parent = data['age_parent']
+    custom_colormap, norm = read_colormap()
 
-# Here we add the elements to the legend of the plot. 
-# Firste we create an array to store legend handles to be used in  legend() . 
-legend_dots = []
+    fig1, ax1 = _cmd_figure()
 
-# Here we append the legend handles to the array. 
-# Each handle contains a Line2D Artist, where only the markers will be used to 
-# represent the colors in the plot, and a legend string. 
-for i in range( len(age_bins_edges) -1 ):
-    legend_label_text = "{} Gyr - {} Gyr".format( 
-        str( f'{age_bins_edges[i]:.2f}' ), str( f'{age_bins_edges[i+1]:.2f}' ) 
-    )
-    legend_dots.append( 
-        mlines.Line2D( [0], [0], marker='o', markersize=7, color='w', 
-                      markerfacecolor=custom_colormap.colors[i], 
-                      label=legend_label_text 
-                     ) 
-    )
+    # Scatter plot. We set:
+    # c - color each dot according to the star's age and the color mapping,
+    # ec - edge color (white),
+    # lw - line width of each dot's edge,
+    # s - size of the dots,
+    # cmap and norm - parameters for the color mapping
+    if cmd_render == 'scatter':
+        ax1.scatter(b_y, M_ass, c=age_parent, ec='k', lw=0, s=10,
+                    cmap=custom_colormap, norm=norm)
 
-# We call legend()
-ax1.legend(loc='upper right', handles=legend_dots)
+    # Otherwise we bin the stars on a grid of pixels and colour each pixel by
+    # the age of its stars, using the same color mapping. See density.py.
+    else:
+        cmd_xlim, cmd_ylim = ax1.get_xlim(), ax1.get_ylim()
+        cmd_image = density.rasterize_ages(b_y, M_ass, age_parent, cmd_xlim, cmd_ylim,
+                                           density.grid_shape_for_axes(ax1),
+                                           age_bins_edges, mode=cmd_render)
+        density.draw_ages(ax1, cmd_image, cmd_xlim, cmd_ylim, custom_colormap, norm)
 
-plt.savefig('image_1.png', bbox_inches='tight')
-plt.show()
+    _cmd_legend(ax1, custom_colormap)
 
+    _save_figure(fig1, 1, output_dir, show)
 
 
 
 ################################################################################
-#  Here we're going to plot three overlapping histograms showing the number of
-#  stars per metallicity value, each histogram refers to stars in an age group.
-#  The age groups delimiters can be modified in the array defined below, see:
-#     age_bins_separator
+#  Zoomed views of the colour-magnitude diagram, drawn from the tile pyramid
+#  of the catalog (see tile_pyramid.py) instead of the stars. The pyramid is
+#  built the first time and saved next to the catalog.
 ################################################################################
 
-import matplotlib.patheffects as pe
-from matplotlib.patches import Rectangle
+def load_tiles(data_filename, data=None):
+    """Return the tile pyramid of the catalog's colour-magnitude diagram,
+    building it if it's missing or out of date."""
+    tiles_dir = tile_pyramid.default_tiles_dir(data_filename)
+    if data is None:
+        data = load_catalog(data_filename)
+    column_hashes = catalog.column_hashes(data_filename)
+    source = {name: column_hashes[name] for name in ('b_y', 'M_ass', 'age_parent')}
 
-fig2, ax2 = plt.subplots(figsize=(14,9))
+    if not tile_pyramid.is_pyramid_valid(tiles_dir, cmd_xlim, cmd_ylim,
+                                         age_bins_edges, source=source):
+        tile_pyramid.build_pyramid(tiles_dir, data['b_y'], data['M_ass'],
+                                   data['age_parent'], cmd_xlim, cmd_ylim,
+                                   age_bins_edges, source=source)
+    return tile_pyramid.open_pyramid(tiles_dir)
 
-# We create a 2D array containing both metallicities and ages of all the stars
-stars_metallicity_age = np.vstack((MsuH, age_parent)).T
 
-# We find metallicity min and max values first, and round them
-stars_metallicity_min = np.floor(np.min(stars_metallicity_age[:,0])*10)/10.
-stars_metallicity_max = np.ceil(np.max(stars_metallicity_age[:,0])*10)/10.
+def zoom_filename(output_dir='.'):
+    return os.path.join(output_dir, 'image_1_zoom.png')
 
-# We create three 1D arrays containing metallicity values for stars grouped 
-# together by age.
-age_bins_separator = [1, 3]
-#  1) We create a 1D array containing the metallicities of the stars younger 
-#     than 1 Gyr
-array_stars_metallicity_young = stars_metallicity_age[:,0][stars_metallicity_age[:,1]<age_bins_separator[0]]
-
-#  2) We create a temproary 2D array containing the metallicities of the stars 
-#     older than or equal to 1 Gyr...
-temp_array_metallicity_by_age = stars_metallicity_age[:][stars_metallicity_age[:,1]>=age_bins_separator[0]]
-
-#    ...then we create a 1D array from the array above, containing the 
-#       metallicities of stars both older than 1 Gyr and younger than 3 Gyr
-array_stars_metallicity_middleaged = temp_array_metallicity_by_age[:,0][temp_array_metallicity_by_age[:,1]<age_bins_separator[1]]
-
-#  3) We create a 1D array containing the metallicities of the stars older than 
-#     or equal to 3 Gyr
-array_stars_metallicity_old = stars_metallicity_age[:,0][stars_metallicity_age[:,1]>=age_bins_separator[1]]
-
-# We collect the three arrays above in one dictionary for iteration purposes
-dict_stars_metallicity_by_age = {
-  0: array_stars_metallicity_young,
-  1: array_stars_metallicity_middleaged,
-  2: array_stars_metallicity_old
-}
 
-# We create a dictionary of labels for iteration purposes
-dict_stars_metallicity_by_age_labels = {
-    0: ' $ t < {} $ '.format(age_bins_separator[0]),
-    1: ' $ {} \leq t < {} $ '.format(age_bins_separator[0],age_bins_separator[1]),
-    2: ' $ t \geq {} $ '.format(age_bins_separator[1])
-}
+def plot_image_1_zoom(tiles, xlim, ylim, output_dir='.', show=False,
+                      cmd_render='mean'):
+    """Zoomed view of the colour-magnitude diagram (image_1_zoom.png), drawn
+    from the tile pyramid  tiles  (see  load_tiles() ).
 
-# We create a dictionary of colors for iteration purposes
-dict_stars_metallicity_by_age_colors = {
-    0: 'red',
-    1: 'green',
-    2: 'blue'
-}
+    xlim  and  ylim  are the limits of the view, give  ylim  in decreasing
+    order to keep the magnitudes axis inverted as in image_1.png.
+    """
+    custom_colormap, norm = read_colormap()
 
-# We set the number of bins.
-# Experimentation showed that starting from 100 bins, and halfing down the value
-# twice we don't lose detail. In fact, some of the bins had 0 frequencies.
-# The histogram somehow shows that metallicities values are close to 27 distinct 
-# values.
-num_of_bins = 27
-stars_metallicity_histogram_bins = np.linspace(stars_metallicity_min, 
-                                               stars_metallicity_max, 
-                                               num_of_bins+1)
-
-# We set the ticks on the x axis to match the number of bins
-ax2.set_xticks(np.linspace(stars_metallicity_min, 
-                           stars_metallicity_max, 
-                           num_of_bins+1))
-
-# We set the histogram title and labels
-fig2.subplots_adjust(top=0.935)
-fig2.suptitle("Histograms: Number of stars (relative freq.) vs Metallicity of stars, grouped by age $t$.", fontsize=16)
-ax2.set_xlabel(r'$M / H$')
-ax2.tick_params(axis='x', labelsize=9)
-ax2.set_ylabel(r'$f$')
-
-# We set the grid and the ylim
-plt.grid(ls=':', lw=0.5, c='gray')
-#ax5.set_ylim(0., 1.)
-ax2.set_xlim(-2.1, 0.8)
-
-
-
-# We loop over the three age categories to plot three overlapping histograms.
-stars_histogram = []
-for i in range(3):
-    stars_histogram.append( 
-        ax2.hist(dict_stars_metallicity_by_age[i], 
-                 stars_metallicity_histogram_bins, 
-                 weights=np.zeros_like(dict_stars_metallicity_by_age[i]) + 1. / dict_stars_metallicity_by_age[i].size, 
-                 color=dict_stars_metallicity_by_age_colors[i], 
-                 alpha=0.25, fill=True, histtype='step',linewidth=1.5 )
-    )
-
-
-
-# We compute the mean and the median values for each of the three subpopulations 
-# and plot them.
-mean_lines = []
-median_lines = []
-mean_labels = []
-median_labels = []
-
-for i in range(3):
-    mean = np.mean(dict_stars_metallicity_by_age[i])
-    median = np.median(dict_stars_metallicity_by_age[i])
-    mean_lines.append( ax2.vlines(mean, 0, 1, transform=ax2.get_xaxis_transform(), 
-                                  linestyles='solid', lw=3, 
-                                  colors=dict_stars_metallicity_by_age_colors[i] ) )
-    median_lines.append( ax2.vlines(median, 0, 1, transform=ax2.get_xaxis_transform(), 
-                                    linestyles='dashed', lw=3, 
-                                    colors=dict_stars_metallicity_by_age_colors[i] ) )
-    ax2.text(mean, 0.2-i*0.0175, '{:0.2f} '.format(mean), 
-             c=dict_stars_metallicity_by_age_colors[i], fontsize='x-large', 
-             horizontalalignment='right', 
-             path_effects=[pe.withStroke(linewidth=2.5, foreground='w' )])
-    ax2.text(median, 0.2-i*0.0175, ' {:0.2f}'.format(median), 
-             c=dict_stars_metallicity_by_age_colors[i], fontsize='x-large', 
-             horizontalalignment='left', 
-             path_effects=[pe.withStroke(linewidth=2.5, foreground='w' )])
-
-
-# Mean and median lines legend
-title_proxy_1 = Rectangle((0,0), 0, 0, color='w')
-legend_hndl_1 = [Rectangle((0,0),1,1,color=c,alpha=0.33,ec="k") for c in 
-            [dict_stars_metallicity_by_age_colors[0], 
-             dict_stars_metallicity_by_age_colors[1], 
-             dict_stars_metallicity_by_age_colors[2]]]
-
-mean_line = ax2.vlines(0, 0, 0, linestyles='solid', lw=3, colors='k' )
-median_line = ax2.vlines(0, 0, 0, linestyles='dashed', lw=3, colors='k' )
-
-# Final legend
-legend_handle_1 = ax2.legend([legend_hndl_1[0], legend_hndl_1[1], legend_hndl_1[2], 
-                              title_proxy_1, mean_line, median_line], 
-                             [dict_stars_metallicity_by_age_labels[0], 
-                              dict_stars_metallicity_by_age_labels[1], 
-                              dict_stars_metallicity_by_age_labels[2], 
-                              ' ', 'mean valule', 'median value'], 
-                             title='Metallicity frequency \n by stars age $t$ (Gyr):', 
-                             handlelength=4, fancybox=True, shadow=True, loc='upper left' )
-
-plt.savefig('image_2.png', bbox_inches='tight')
-plt.show()
+    fig1, ax1 = _cmd_figure(xlim, ylim)
 
+    # Each pixel is coloured by the age of the stars of the cells of the
+    # pyramid falling in it, using the same color mapping as image_1.png.
+    with instrumentation.stage('tiles_query'):
+        cmd_image = tile_pyramid.render_view(tiles, xlim, ylim,
+                                             density.grid_shape_for_axes(ax1),
+                                             mode=cmd_render)
+    density.draw_ages(ax1, cmd_image, ax1.get_xlim(), ax1.get_ylim(),
+                      custom_colormap, norm)
+
+    _cmd_legend(ax1, custom_colormap)
+
+    _save_figure_as(fig1, zoom_filename(output_dir), show)
 
 
 
 ################################################################################
-#  Here we scatter plot mmetallicity vs initial mass of stars. Also, we use
-#  three colours and markers with different shapes to differentiate stars 
-#  belonging to each age group.
+#  Selection of the stars in a region of the colour-magnitude diagram or of
+#  the initial mass-metallicity plane, through a grid index of the stars built
+#  once and saved next to the catalog (see spatial_index.py). E.g.
+#      index = plot_stars.load_spatial_index('Nemo_6670.dat', 'cmd', data)
+#      rows = spatial_index.query_box(index, data['b_y'], data['M_ass'],
+#                                     (0.2, 0.3), (3., 4.))
+#  The rows can be used with every column, e.g.  data['age_parent'][rows] .
 ################################################################################
 
-stars_mass_metallicity_age = np.vstack((m_ini, MsuH, age_parent)).T
+# The planes which can be indexed, and their columns (x, y).
+INDEX_PLANES = {'cmd': ('b_y', 'M_ass'),
+                'mass_metallicity': ('m_ini', 'MsuH')}
+
+
+def load_spatial_index(data_filename, plane, data=None):
+    """Return the index of the stars in  plane  (see INDEX_PLANES), building
+    it if it's missing or out of date."""
+    index_dir = spatial_index.default_index_dir(data_filename, plane)
+    if data is None:
+        data = load_catalog(data_filename)
+    column_hashes = catalog.column_hashes(data_filename)
+    source = {name: column_hashes[name] for name in INDEX_PLANES[plane]}
+
+    if not spatial_index.is_index_valid(index_dir, source=source):
+        x_name, y_name = INDEX_PLANES[plane]
+        spatial_index.save_index(index_dir,
+                                 spatial_index.build_index(data[x_name], data[y_name]),
+                                 source=source)
+    return spatial_index.load_index(index_dir)
+
+
+def contour_polygons(figures_data, group, level=None):
+    """Return the polygons (a list of rings of vertices, see
+    spatial_index.points_in_polygon() ) of the region inside the contour of
+    an age group in image_5.png, i.e. where the interpolated density of the
+    group's stars is above  level  (by default the level of the group)."""
+    import contourpy
+
+    if level is None:
+        level = contour_level(figures_data, group)
+    # Same algorithm and masking of the invalid values as Matplotlib's
+    # contour() , so that the polygons match the lines in the figure.
+    x, y, z = contour_grid(figures_data, group)
+    generator = contourpy.contour_generator(x, y, np.ma.masked_invalid(z),
+                                            name='mpl2014', corner_mask=True,
+                                            fill_type=contourpy.FillType.OuterCode)
+    # Each ring starts with a MOVETO (1) code.
+    rings = []
+    for points, codes in zip(*generator.filled(level, np.inf)):
+        starts = np.flatnonzero(codes == 1)
+        rings += np.split(points, starts[1:])
+    return rings
+
+
+def stars_inside_contour(data, figures_data, index, group, level=None):
+    """Return the rows of the stars of an age group inside its contour in
+    image_5.png (see  contour_polygons() ).  index  is the 'mass_metallicity'
+    spatial index of the catalog."""
+    rows = spatial_index.query_polygon(index, data['m_ini'], data['MsuH'],
+                                       contour_polygons(figures_data, group, level))
+    return rows[figures_data['age_group_of_star'][rows] == group]
 
-stars_mass_min = np.floor(np.min(stars_mass_metallicity_age[:,0])*10)/10.
-stars_mass_max = np.ceil(np.max(stars_mass_metallicity_age[:,0])*10)/10.
 
-# We create three 1D arrays containing metallicity values for stars grouped 
-# together by age.
-#  1) We create a 1D array containing the metallicities of the stars younger 
-#     than 1 Gyr
-array_stars_mass_young = stars_mass_metallicity_age[:,0][stars_mass_metallicity_age[:,2]<age_bins_separator[0]]
 
-#  2) We create a temproary 2D array containing the metallicities of the stars 
-#     older than or equal to 1 Gyr...
-temp_array_mass_by_age = stars_mass_metallicity_age[:][stars_mass_metallicity_age[:,2]>=age_bins_separator[0]]
 
-#    ...then we create a 1D array from the array above by slicing, containing  
-#       the metallicities of stars both older than 1 Gyr and younger than 3 Gyr
-array_stars_mass_middleaged = temp_array_mass_by_age[:,0][temp_array_mass_by_age[:,2]<age_bins_separator[1]]
+################################################################################
+#  Here we're going to plot three overlapping histograms showing the number of
+#  stars per metallicity value, each histogram refers to stars in an age group.
+#  The age groups delimiters can be modified in the array defined above, see:
+#     age_bins_separator
+################################################################################
 
-#  3) We create a 1D array containing the metallicities of the stars older than 
-#     or equal to 3 Gyr
-array_stars_mass_old = stars_mass_metallicity_age[:,0][stars_mass_metallicity_age[:,2]>=age_bins_separator[1]]
+def plot_image_2(data, figures_data, output_dir='.', show=False):
+    """Histograms of the metallicity of the stars by age group (image_2.png)."""
+    from matplotlib import pyplot as plt
+    import matplotlib.patheffects as pe
+    from matplotlib.patches import Rectangle
+
+    num_of_age_groups = figures_data['num_of_age_groups']
+    stars_metallicity_histogram_bins = figures_data['stars_metallicity_histogram_bins']
+    metallicity_cube = figures_data['metallicity_cube']
+    metallicity_moments = figures_data['metallicity_moments']
+    metallicity_medians = figures_data['metallicity_medians']
+    metallicity_bands = figures_data['metallicity_bands']
+    dict_stars_metallicity_by_age_labels = figures_data['dict_stars_metallicity_by_age_labels']
+    dict_stars_metallicity_by_age_colors = figures_data['dict_stars_metallicity_by_age_colors']
+
+    fig2, ax2 = plt.subplots(figsize=(14,9))
+
+    # We set the ticks on the x axis to match the number of bins
+    ax2.set_xticks(stars_metallicity_histogram_bins)
+
+    # We set the histogram title and labels
+    fig2.subplots_adjust(top=0.935)
+    fig2.suptitle("Histograms: Number of stars (relative freq.) vs Metallicity of stars, grouped by age $t$.", fontsize=16)
+    ax2.set_xlabel(r'$M / H$')
+    ax2.tick_params(axis='x', labelsize=9)
+    ax2.set_ylabel(r'$f$')
+
+    # We set the grid and the ylim
+    plt.grid(ls=':', lw=0.5, c='gray')
+    #ax5.set_ylim(0., 1.)
+    ax2.set_xlim(-2.1, 0.8)
+
+
+
+    # The age groups without stars have nothing to draw.
+    non_empty_groups = [i for i in range(num_of_age_groups)
+                        if metallicity_moments['count'][i] > 0]
+
+    # We loop over the age groups to plot overlapping histograms.
+    stars_histogram = []
+    for i in non_empty_groups:
+        stars_histogram.append(
+            binning.hist_from_counts(ax2,
+                     metallicity_cube['counts'][i] / metallicity_moments['count'][i],
+                     stars_metallicity_histogram_bins,
+                     color=dict_stars_metallicity_by_age_colors[i],
+                     alpha=0.25, fill=True, histtype='step',linewidth=1.5 )
+        )
+
+    # We shade the confidence band of each histogram, a step for each bin as
+    # the histogram.
+    if metallicity_bands is not None:
+        for i in non_empty_groups:
+            band_lower = metallicity_bands['lower'][i] / metallicity_moments['count'][i]
+            band_upper = metallicity_bands['upper'][i] / metallicity_moments['count'][i]
+            ax2.fill_between(stars_metallicity_histogram_bins,
+                             np.append(band_lower, band_lower[-1]),
+                             np.append(band_upper, band_upper[-1]), step='post',
+                             color=dict_stars_metallicity_by_age_colors[i],
+                             alpha=0.35, linewidth=0)
+
+
+
+    # We plot the mean and the median values for each of the subpopulations,
+    # computed in  compute_figures_data() .
+    mean_lines = []
+    median_lines = []
+
+    for i in non_empty_groups:
+        mean = metallicity_moments['mean'][i]
+        median = metallicity_medians[i]
+        mean_lines.append( ax2.vlines(mean, 0, 1, transform=ax2.get_xaxis_transform(),
+                                      linestyles='solid', lw=3,
+                                      colors=dict_stars_metallicity_by_age_colors[i] ) )
+        median_lines.append( ax2.vlines(median, 0, 1, transform=ax2.get_xaxis_transform(),
+                                        linestyles='dashed', lw=3,
+                                        colors=dict_stars_metallicity_by_age_colors[i] ) )
+        ax2.text(mean, 0.2-i*0.0175, '{:0.2f} '.format(mean),
+                 c=dict_stars_metallicity_by_age_colors[i], fontsize='x-large',
+                 horizontalalignment='right',
+                 path_effects=[pe.withStroke(linewidth=2.5, foreground='w' )])
+        ax2.text(median, 0.2-i*0.0175, ' {:0.2f}'.format(median),
+                 c=dict_stars_metallicity_by_age_colors[i], fontsize='x-large',
+                 horizontalalignment='left',
+                 path_effects=[pe.withStroke(linewidth=2.5, foreground='w' )])
+
+
+    # Mean and median lines legend
+    title_proxy_1 = Rectangle((0,0), 0, 0, color='w')
+    legend_hndl_1 = [Rectangle((0,0),1,1,color=dict_stars_metallicity_by_age_colors[i],
+                               alpha=0.33,ec="k")
+                     for i in range(num_of_age_groups)]
+
+    mean_line = ax2.vlines(0, 0, 0, linestyles='solid', lw=3, colors='k' )
+    median_line = ax2.vlines(0, 0, 0, linestyles='dashed', lw=3, colors='k' )
+    band_hndl, band_label = [], []
+    if metallicity_bands is not None:
+        band_hndl = [Rectangle((0,0),1,1,color='k',alpha=0.35,lw=0)]
+        band_label = ['{:.0%} {} band'.format(bands_confidence, figures_data['bands'])]
+
+    # Final legend
+    ax2.legend(legend_hndl_1 + [title_proxy_1, mean_line, median_line] + band_hndl,
+               [dict_stars_metallicity_by_age_labels[i]
+                for i in range(num_of_age_groups)] +
+               [' ', 'mean valule', 'median value'] + band_label,
+               title='Metallicity frequency \n by stars age $t$ (Gyr):',
+               handlelength=4, fancybox=True, shadow=True, loc='upper left' )
+
+    _save_figure(fig2, 2, output_dir, show)
 
-# We collect the three arrays above in one dictionary for possible iteration 
-# purposes
-dict_stars_mass_by_age = {
-  0: array_stars_mass_young,
-  1: array_stars_mass_middleaged,
-  2: array_stars_mass_old
-}
 
-# We compute the boundaries for all the subsequent plots
-stars_mass_young_min = np.floor(np.min(array_stars_mass_young)*10)/10.
-stars_mass_young_max = np.ceil(np.max(array_stars_mass_young)*10)/10.
-stars_mass_middleaged_min = np.floor(np.min(array_stars_mass_middleaged)*10)/10.
-stars_mass_middleaged_max = np.ceil(np.max(array_stars_mass_middleaged)*10)/10.
-stars_mass_old_min = np.floor(np.min(array_stars_mass_old)*10)/10.
-stars_mass_old_max = np.ceil(np.max(array_stars_mass_old)*10)/10.
 
 
+################################################################################
+#  Here we scatter plot mmetallicity vs initial mass of stars. Also, we use
+#  three colours and markers with different shapes to differentiate stars
+#  belonging to each age group.
+################################################################################
+
+def plot_image_3(data, figures_data, output_dir='.', show=False):
+    """Scatter plot of metallicity vs. initial mass by age group (image_3.png)."""
+    from matplotlib import pyplot as plt
 
-# We initialise the plot.
-fig3, ax3 = plt.subplots(figsize=(10,10))
+    num_of_age_groups = figures_data['num_of_age_groups']
+    dict_stars_metallicity_by_age_labels = figures_data['dict_stars_metallicity_by_age_labels']
+    dict_stars_metallicity_by_age_colors = figures_data['dict_stars_metallicity_by_age_colors']
 
-# We plot stars in the three age groups.
-ax3.scatter(array_stars_mass_young, array_stars_metallicity_young, 
-            s=45, c='r', alpha=0.15, marker='s',
-            label=dict_stars_metallicity_by_age_labels[0])
+    # We create dictionaries of 1D arrays containing the metallicities and the
+    # initial masses of the stars in each age group.
+    dict_stars_metallicity_by_age = stars_by_age(data['MsuH'], figures_data)
+    dict_stars_mass_by_age = stars_by_age(data['m_ini'], figures_data)
 
-ax3.scatter(array_stars_mass_middleaged, array_stars_metallicity_middleaged, 
-            s=30, c='g', alpha=0.20, marker='o',
-            label=dict_stars_metallicity_by_age_labels[1])
+    # We initialise the plot.
+    fig3, ax3 = plt.subplots(figsize=(10,10))
 
-ax3.scatter(array_stars_mass_old, array_stars_metallicity_old, 
-            s=15, c='b', alpha=0.25, marker='^',
-            label=dict_stars_metallicity_by_age_labels[2])
+    # We plot stars in the age groups, each group with its own marker, size and
+    # transparency (younger stars are drawn first, with bigger markers).
+    for i in range(num_of_age_groups):
+        ax3.scatter(dict_stars_mass_by_age[i], dict_stars_metallicity_by_age[i],
+                    s=max(45-15*i, 5), c=dict_stars_metallicity_by_age_colors[i],
+                    alpha=min(0.15+0.05*i, 1.),
+                    marker=age_groups_markers[i % len(age_groups_markers)],
+                    label=dict_stars_metallicity_by_age_labels[i])
 
-fig3.subplots_adjust(top=0.925)
-fig3.suptitle('Scatter plot: Metallicity vs. Initial Mass of stars, grouped by age $t$.', fontsize=16)
-ax3.set_xlabel('$m_{ini}$')
-ax3.set_ylabel('$M / H$')
+    fig3.subplots_adjust(top=0.925)
+    fig3.suptitle('Scatter plot: Metallicity vs. Initial Mass of stars, grouped by age $t$.', fontsize=16)
+    ax3.set_xlabel('$m_{ini}$')
+    ax3.set_ylabel('$M / H$')
 
-ax3.legend(loc="lower right", title="Stars by age $t$ (Gyr):")
+    ax3.legend(loc="lower right", title="Stars by age $t$ (Gyr):")
 
-plt.xscale('log')
+    plt.xscale('log')
 
-plt.savefig('image_3.png', bbox_inches='tight')
-plt.show()
+    _save_figure(fig3, 3, output_dir, show)
 
 
 
@@ -371,124 +956,591 @@ plt.show()
 #  Each hist2d shows mmetallicity vs initial mass of stars in an age group.
 ###############################################################################
 
-fig4, ax4 = plt.subplots(1,3, figsize=(14,4))
-
-hist_1 = ax4[0].hist2d(array_stars_mass_young, array_stars_metallicity_young, 
-                    range=[[stars_mass_young_min-0.1, stars_mass_young_max+0.1], 
-                           [stars_metallicity_min-0.1, stars_metallicity_max+0.1]], 
-                    bins=22, cmin=0.5, cmap='Wistia', alpha=0.7)
-
-hist_2 = ax4[1].hist2d(array_stars_mass_middleaged, array_stars_metallicity_middleaged, 
-                    range=[[stars_mass_middleaged_min-0.1, stars_mass_middleaged_max+0.1], 
-                           [stars_metallicity_min-0.1, stars_metallicity_max+0.1]], 
-                    bins=22, cmin=0.5, cmap='Wistia', alpha=0.7)
+def plot_image_4(data, figures_data, output_dir='.', show=False):
+    """2D histograms of metallicity vs. initial mass by age group (image_4.png)."""
+    from matplotlib import pyplot as plt
 
-hist_3 = ax4[2].hist2d(array_stars_mass_old, array_stars_metallicity_old, 
-                    range=[[stars_mass_old_min-0.1, stars_mass_old_max+0.1], 
-                           [stars_metallicity_min-0.1, stars_metallicity_max+0.1]], 
-                    bins=22, cmin=0.5, cmap='Wistia', alpha=0.7)
+    num_of_age_groups = figures_data['num_of_age_groups']
+    mass_metallicity_cube_by_age = figures_data['mass_metallicity_cube_by_age']
+    mass_edges_by_age = figures_data['mass_edges_by_age']
+    metallicity_edges_2d = figures_data['metallicity_edges_2d']
+    dict_stars_metallicity_by_age_labels = figures_data['dict_stars_metallicity_by_age_labels']
 
+    fig4, ax4 = plt.subplots(1, num_of_age_groups, figsize=(14,4), squeeze=False)
+    ax4 = ax4[0]
 
-fig4.colorbar(hist_1[3])
-fig4.colorbar(hist_2[3])
-fig4.colorbar(hist_3[3])
+    # One 2D histogram (with its colorbar) for each age group, the panels of
+    # the age groups without stars are left blank.
+    for i in range(num_of_age_groups):
+        if figures_data['age_groups_sizes'][i] == 0:
+            ax4[i].set_xlim(mass_edges_by_age[i][0], mass_edges_by_age[i][-1])
+            ax4[i].set_ylim(metallicity_edges_2d[0], metallicity_edges_2d[-1])
+            ax4[i].text(0.5, 0.5, 'no stars', transform=ax4[i].transAxes,
+                        horizontalalignment='center', verticalalignment='center')
+            continue
+        hist_i = binning.hist2d_from_counts(ax4[i],
+                                            mass_metallicity_cube_by_age['counts'][i],
+                                            mass_edges_by_age[i], metallicity_edges_2d,
+                                            cmin=0.5, cmap='Wistia', alpha=0.7)
+        fig4.colorbar(hist_i[3])
 
-fig4.subplots_adjust(top=0.825)
-fig4.suptitle('2D histogram comparison: Metallicity vs. Initial Mass of stars, grouped by age $t$ (Gyr)', fontsize=16)
+    fig4.subplots_adjust(top=0.825)
+    fig4.suptitle('2D histogram comparison: Metallicity vs. Initial Mass of stars, grouped by age $t$ (Gyr)', fontsize=16)
 
-ax4[0].set_title(dict_stars_metallicity_by_age_labels[0])
-ax4[0].set_xlabel('$m_{ini}$')
-ax4[0].set_ylabel('$M / H$')
+    for i in range(num_of_age_groups):
+        ax4[i].set_title(dict_stars_metallicity_by_age_labels[i])
+        ax4[i].set_xlabel('$m_{ini}$')
+    ax4[0].set_ylabel('$M / H$')
 
-ax4[1].set_title(dict_stars_metallicity_by_age_labels[1])
-ax4[1].set_xlabel('$m_{ini}$')
-
-ax4[2].set_title(dict_stars_metallicity_by_age_labels[2])
-ax4[2].set_xlabel('$m_{ini}$')
-
-plt.savefig('image_4.png', bbox_inches='tight')
-plt.show()
+    _save_figure(fig4, 4, output_dir, show)
 
 
 
 
 ################################################################################
-#  Here we iterate the plot above in a different fashion. 
-#  We plot three contour plots over a 2D histogram to show how stars' 
+#  Here we iterate the plot above in a different fashion.
+#  We plot three contour plots over a 2D histogram to show how stars'
 #  metallicities are related to their initial mass for the three different
 #  age groups.
 ################################################################################
 
-fig5, ax5 = plt.subplots(figsize=(8,7))
+def contour_probability(group):
+    """Return the fraction of the stars of an age group enclosed by its
+    contour (see  contour_probabilities )."""
+    return contour_probabilities[min(group, len(contour_probabilities)-1)]
+
+
+def contour_level(figures_data, group):
+    """Return the density level of the contour of an age group, the level
+    enclosing  contour_probability(group)  of its stars (see kde.py)."""
+    return figures_data['contour_density_levels'][group]
+
+
+def contour_grid(figures_data, group, values=None):
+    """Return the coordinates (initial mass, metallicity) and the values of
+    the grid the contour of an age group is drawn from in image_5.png.
+
+    The grid points are the centres of the bins of the density estimate, the
+    values are the group's density or the given  values  on the same bins.
+    """
+    if values is None:
+        values = figures_data['mass_metallicity_density'][group]
+    return (10**binning.bin_centres(figures_data['log_mass_edges_kde']),
+            binning.bin_centres(figures_data['metallicity_edges_kde']),
+            np.asarray(values).T)
+
 
-plt.xscale('log')
+def contour_band_grid(figures_data, group):
+    """Return the grid (see  contour_grid() ) whose positive values are the
+    confidence band of the contour of an age group: the bins where the
+    density can be at the contour level, i.e. where the band of the density
+    minus the level (see  compute_figures_data() ) includes zero."""
+    band = figures_data['contour_bands']
+    return contour_grid(figures_data, group,
+                        np.minimum(band['upper'][group], -band['lower'][group]))
 
-hist_all = ax5.hist2d(stars_mass_metallicity_age[:,0], stars_mass_metallicity_age[:,1], 
-                      range=[[stars_mass_min-0.1, stars_mass_max+0.1], 
-                             [stars_metallicity_min-0.1, stars_metallicity_max+0.1]], 
-                      bins=22, cmin=0.5, cmap='Wistia', alpha=0.7)
 
-hist_young_1 = np.histogram2d(array_stars_mass_young, array_stars_metallicity_young, 
-                            range=[[stars_mass_min-0.1, stars_mass_max+0.1], 
-                                   [stars_metallicity_min-0.1, stars_metallicity_max+0.1]], 
-                            bins=22)
+def plot_image_5(data, figures_data, output_dir='.', show=False):
+    """2D histogram of all stars with one contour per age group (image_5.png)."""
+    from matplotlib import pyplot as plt
+    from matplotlib.patches import Rectangle
 
-hist_mid_1 = np.histogram2d(array_stars_mass_middleaged, array_stars_metallicity_middleaged, 
-                          range=[[stars_mass_min-0.1, stars_mass_max+0.1], 
-                                 [stars_metallicity_min-0.1, stars_metallicity_max+0.1]], 
-                          bins=22)
+    num_of_age_groups = figures_data['num_of_age_groups']
+    mass_metallicity_cube = figures_data['mass_metallicity_cube']
+    mass_edges_2d = figures_data['mass_edges_2d']
+    metallicity_edges_2d = figures_data['metallicity_edges_2d']
+    dict_stars_metallicity_by_age_labels = figures_data['dict_stars_metallicity_by_age_labels']
+    dict_stars_metallicity_by_age_colors = figures_data['dict_stars_metallicity_by_age_colors']
 
-hist_old_1 = np.histogram2d(array_stars_mass_old, array_stars_metallicity_old, 
-                          range=[[stars_mass_min-0.1, stars_mass_max+0.1], 
-                                 [stars_metallicity_min-0.1, stars_metallicity_max+0.1]], 
-                          bins=22)
+    fig5, ax5 = plt.subplots(figsize=(8,7))
 
-hist_young_2 = np.where(hist_young_1[0] > 0, hist_young_1[0], np.nan)
-hist_mid_2 = np.where(hist_mid_1[0] > 0, hist_mid_1[0], np.nan)
-ist_old_2 = np.where(hist_old_1[0] > 0, hist_old_1[0], np.nan)
+    plt.xscale('log')
 
+    # The histogram of all stars is the sum over the age groups.
+    hist_all = binning.hist2d_from_counts(ax5,
+                                          mass_metallicity_cube['counts'].sum(axis=0),
+                                          mass_edges_2d, metallicity_edges_2d,
+                                          cmin=0.5, cmap='Wistia', alpha=0.7)
 
-conts=[None]*3
+    # The density grid extends beyond the histogram, we keep the histogram's
+    # limits.
+    xlim, ylim = ax5.get_xlim(), ax5.get_ylim()
 
-conts[0] = ax5.contour(np.linspace(stars_mass_min-0.1, stars_mass_max+0.1, num=22), 
-                       np.linspace(stars_metallicity_min-0.1, stars_metallicity_max+0.1, num=22), 
-                       hist_young_2.T, [70], colors='r', alpha=0.6)
+    conts = [None]*num_of_age_groups
+    # The age groups without stars have no contour.
+    non_empty_groups = [i for i in range(num_of_age_groups)
+                        if figures_data['age_groups_sizes'][i] > 0]
 
-conts[1] = ax5.contour(np.linspace(stars_mass_min-0.1, stars_mass_max+0.1, num=22), 
-                       np.linspace(stars_metallicity_min-0.1, stars_metallicity_max+0.1, num=22), 
-                       hist_mid_2.T, [100], colors='g', alpha=0.6)
+    with instrumentation.stage('contours'):
+        # We shade the confidence band of each contour first, below the
+        # contours.
+        if figures_data['contour_bands'] is not None:
+            for i in non_empty_groups:
+                x, y, band = contour_band_grid(figures_data, i)
+                if np.nanmax(band, initial=-1.) > 0:
+                    ax5.contourf(x, y, band, [0, np.nanmax(band)],
+                                 colors=dict_stars_metallicity_by_age_colors[i],
+                                 alpha=0.2)
 
-conts[2] = ax5.contour(np.linspace(stars_mass_min-0.1, stars_mass_max+0.1, num=22), 
-                       np.linspace(stars_metallicity_min-0.1, stars_metallicity_max+0.1, num=22), 
-                       ist_old_2.T, [100], colors='b', alpha=0.6)
+        for i in non_empty_groups:
+            conts[i] = ax5.contour(*contour_grid(figures_data, i),
+                                   [contour_level(figures_data, i)],
+                                   colors=dict_stars_metallicity_by_age_colors[i], alpha=0.6)
 
 
-for i in range(3):
-    ax5.clabel(conts[i], inline=True, fontsize=10)
+        # Each contour is labelled with the fraction of stars it encloses.
+        for i in non_empty_groups:
+            ax5.clabel(conts[i], inline=True, fontsize=10,
+                       fmt=lambda level, i=i: '{:.0%}'.format(contour_probability(i)))
 
-fig5.colorbar(hist_all[3])
+    ax5.set_xlim(xlim)
+    ax5.set_ylim(ylim)
 
-fig5.subplots_adjust(top=0.85)
-fig5.suptitle('Metallicity vs. Initial Mass of stars', fontsize=16, x=0.45)
-ax5.set_title('The histogram refers to all stars. Each contour refers to an age group.\n A contour contains only bins with at least the indicated number\n of stars. Bins outside the contours have less stars than indicated.')
-ax5.set_xlabel('$m_{ini}$')
-ax5.set_ylabel('$M / H$')
+    fig5.colorbar(hist_all[3])
 
+    fig5.subplots_adjust(top=0.85)
+    fig5.suptitle('Metallicity vs. Initial Mass of stars', fontsize=16, x=0.45)
+    ax5.set_title('The histogram refers to all stars. Each contour refers to an age group.\n A contour encloses the indicated fraction of the stars of its group\n (Gaussian kernel density estimate).')
+    ax5.set_xlabel('$m_{ini}$')
+    ax5.set_ylabel('$M / H$')
 
-# Mean and median lines legend
-title_proxy2 = Rectangle((0,0), 0, 0, color='w')
-handless2 = [Rectangle((0,0),1,1,color=c,alpha=0.6,ec="w") for c in 
-            [dict_stars_metallicity_by_age_colors[0], 
-             dict_stars_metallicity_by_age_colors[1], 
-             dict_stars_metallicity_by_age_colors[2]]]
 
-# Legend
-legend_handle_2 = ax5.legend([handless2[0], handless2[1], handless2[2], title_proxy2], 
-                             [dict_stars_metallicity_by_age_labels[0], 
-                              dict_stars_metallicity_by_age_labels[1], 
-                              dict_stars_metallicity_by_age_labels[2]], 
-                             title='Age group colour:', 
-                             handlelength=4, fancybox=True, shadow=True, loc='lower right' )
+    # Mean and median lines legend
+    handless2 = [Rectangle((0,0),1,1,color=dict_stars_metallicity_by_age_colors[i],
+                           alpha=0.6,ec="w")
+                 for i in range(num_of_age_groups)]
+
+    legend_title = 'Age group colour:'
+    if figures_data['contour_bands'] is not None:
+        legend_title = 'Age group colour\n(shaded: {:.0%} {} band\nof the contour):'.format(
+            bands_confidence, figures_data['bands'])
+
+    # Legend
+    ax5.legend(handless2,
+               [dict_stars_metallicity_by_age_labels[i]
+                for i in range(num_of_age_groups)],
+               title=legend_title,
+               handlelength=4, fancybox=True, shadow=True, loc='lower right' )
+
+    _save_figure(fig5, 5, output_dir, show)
+
+
+
+################################################################################
+#  Figure stages. For each figure we declare the function drawing it, the
+#  columns of the catalog and the parameters it depends on. From these we
+#  compute the fingerprint of the figure (see figure_cache.py): a figure is
+#  rendered again only when its fingerprint changes, e.g. changing
+#  num_of_bins  only renders image_2.png again. 'figures_data' tells whether
+#  the figure needs  compute_figures_data() .
+################################################################################
+
+FIGURE_STAGES = {
+    1: {'name': 'colour_magnitude',
+        'function': plot_image_1,
+        'figures_data': False,
+        'columns': ('M_ass', 'b_y', 'age_parent'),
+        'parameters': ('age_bins_edges', 'colors.txt', 'cmd_render',
+                       'cmd_xlim', 'cmd_ylim')},
+    2: {'name': 'metallicity_histograms',
+        'function': plot_image_2,
+        'figures_data': True,
+        'columns': ('MsuH', 'age_parent'),
+        'parameters': ('age_bins_separator', 'num_of_bins', 'age_groups_colors',
+                       'bands', 'bands_resamples', 'bands_confidence')},
+    3: {'name': 'mass_metallicity_scatter',
+        'function': plot_image_3,
+        'figures_data': True,
+        'columns': ('MsuH', 'm_ini', 'age_parent'),
+        'parameters': ('age_bins_separator', 'age_groups_colors',
+                       'age_groups_markers')},
+    4: {'name': 'mass_metallicity_histograms',
+        'function': plot_image_4,
+        'figures_data': True,
+        'columns': ('MsuH', 'm_ini', 'age_parent'),
+        'parameters': ('age_bins_separator', 'num_of_bins_2d')},
+    5: {'name': 'mass_metallicity_contours',
+        'function': plot_image_5,
+        'figures_data': True,
+        'columns': ('MsuH', 'm_ini', 'age_parent'),
+        'parameters': ('age_bins_separator', 'num_of_bins_2d', 'kde_grid_size',
+                       'contour_probabilities', 'age_groups_colors', 'bands',
+                       'bands_resamples', 'bands_confidence')},
+}
+
+
+def render_figure(number, data, figures_data, output_dir='.', show=False,
+                  **options):
+    """Draw and save figure  number  (image_N.png), see  plot_image_N() ."""
+    with instrumentation.stage('figure_{}'.format(number)):
+        FIGURE_STAGES[number]['function'](data, figures_data,
+                                          output_dir=output_dir, show=show,
+                                          **options)
+
+
+def figure_parameters(cmd_render='scatter', bands=bands):
+    """Return the current value of every parameter a figure can depend on."""
+    return {
+        'age_bins_edges': age_bins_edges,
+        'colors.txt': catalog.file_sha256(rgb_colors_filename),
+        'cmd_render': cmd_render,
+        'cmd_xlim': cmd_xlim,
+        'cmd_ylim': cmd_ylim,
+        'age_bins_separator': age_bins_separator,
+        'num_of_bins': num_of_bins,
+        'num_of_bins_2d': num_of_bins_2d,
+        'kde_grid_size': kde_grid_size,
+        'contour_probabilities': contour_probabilities,
+        'age_groups_colors': age_groups_colors,
+        'age_groups_markers': age_groups_markers,
+        'bands': bands,
+        'bands_resamples': bands_resamples,
+        'bands_confidence': bands_confidence,
+    }
+
+
+def _project_modules(module):
+    # The module and the modules of this project (the ones next to it) which
+    # it imports, directly or through one another, by file name.
+    directory = os.path.dirname(os.path.abspath(module.__file__))
+    modules = {}
+
+    def visit(module):
+        filename = os.path.abspath(module.__file__)
+        if filename in modules:
+            return
+        modules[filename] = module
+        for value in vars(module).values():
+            if (inspect.ismodule(value) and getattr(value, '__file__', None)
+                    and os.path.dirname(os.path.abspath(value.__file__))
+                    == directory):
+                visit(value)
+
+    visit(module)
+    return [modules[filename] for filename in sorted(modules)]
+
+
+_code_hash_value = None
+
+
+def _code_hash():
+    # The hash of the source of this module and of every project module it
+    # imports: whichever function a figure goes through, a change in it
+    # invalidates the cached figures. Computed once, the code doesn't change
+    # while we run.
+    global _code_hash_value
+    if _code_hash_value is None:
+        digest = hashlib.sha256()
+        for module in _project_modules(sys.modules[__name__]):
+            digest.update(os.path.basename(module.__file__).encode())
+            digest.update(inspect.getsource(module).encode())
+        _code_hash_value = digest.hexdigest()
+    return _code_hash_value
+
+
+def figure_fingerprint(number, column_hashes, parameters):
+    """Return the fingerprint of figure  number , given the hashes of the
+    catalog's columns (see  catalog.column_hashes() ) and the parameters
+    (see  figure_parameters() )."""
+    stage = FIGURE_STAGES[number]
+    return figure_cache.fingerprint({
+        'figure': number,
+        'code': _code_hash(),
+        'columns': {name: column_hashes[name] for name in stage['columns']},
+        'parameters': {name: parameters[name] for name in stage['parameters']},
+    })
+
+
+def stale_figures(data_filename, output_dir='.', figures=FIGURES,
+                  cmd_render='scatter', bands=bands):
+    """Return the figures which have to be rendered (not in the cache).
+
+    All of them if the catalog hasn't been read yet, see catalog.py.
+    """
+    column_hashes = catalog.column_hashes(data_filename)
+    if column_hashes is None:
+        return list(figures)
+
+    parameters = figure_parameters(cmd_render, bands)
+    cache_dir = figure_cache.cache_dir_for(output_dir)
+    return [number for number in figures
+            if not os.path.isfile(figure_filename(number, output_dir))
+            or not figure_cache.is_cached(
+                cache_dir, figure_fingerprint(number, column_hashes, parameters),
+                figure_filename(number, output_dir))]
+
+
+
+
+################################################################################
+#  Batch mode. The figures are rendered with a non interactive backend by a
+#  pool of processes, one figure per task. The big arrays (the columns of the
+#  catalog and the age groups) are put in shared memory once, the workers
+#  attach to them instead of receiving a pickled copy.
+################################################################################
 
-plt.savefig('image_5.png', bbox_inches='tight')
-plt.show()
\ No newline at end of file
+def use_batch_backend():
+    """Draw the figures with Matplotlib's non interactive backend (Agg)."""
+    import matplotlib
+
+    matplotlib.use('Agg')
+
+
+def _init_batch_worker():
+    use_batch_backend()
+
+
+def _render_figure_in_worker(number, data_descriptors, figures_data,
+                             figures_data_descriptors, output_dir, plot_options,
+                             instrumentation_options=None):
+    # The stages of the workers are recorded by the workers and sent back to
+    # the parent process with the result.
+    if instrumentation_options is not None:
+        instrumentation.enable(**instrumentation_options)
+    data_blocks, data = shared_arrays.attach_arrays(data_descriptors)
+    figures_data_blocks, shared_figures_data = shared_arrays.attach_arrays(
+        figures_data_descriptors)
+    try:
+        render_figure(number, data, dict(figures_data, **shared_figures_data),
+                      output_dir=output_dir, show=False,
+                      **plot_options.get(number, {}))
+    finally:
+        # The views must be gone before the blocks are closed.
+        del data, shared_figures_data
+        shared_arrays.release_blocks(data_blocks + figures_data_blocks)
+    return number, instrumentation.collected()
+
+
+def render_figures(data, figures_data, figures=FIGURES, output_dir='.',
+                   show=False, jobs=1, plot_options=None):
+    """Draw and save the given figures.
+
+    With  jobs > 1  the figures are rendered in parallel by  jobs  processes,
+    which is only possible when they are not shown on screen.  plot_options  is
+    a dict {figure number: dict of keyword arguments of  plot_image_N()}.
+    """
+    plot_options = plot_options or {}
+
+    if jobs <= 1 or show or len(figures) <= 1:
+        for number in figures:
+            render_figure(number, data, figures_data, output_dir=output_dir,
+                          show=show, **plot_options.get(number, {}))
+        return
+
+    # We share every array with one value per star, the rest is small and it
+    # is sent to the workers as it is.
+    num_of_stars = len(data['age_parent'])
+    shared_figures_data = {key: value for key, value in figures_data.items()
+                           if isinstance(value, np.ndarray) and value.shape[:1] == (num_of_stars,)}
+    small_figures_data = {key: value for key, value in figures_data.items()
+                          if key not in shared_figures_data}
+
+    data_blocks, data_descriptors = shared_arrays.share_arrays(data)
+    figures_data_blocks, figures_data_descriptors = shared_arrays.share_arrays(
+        shared_figures_data)
+    try:
+        # We use 'spawn' so that the workers don't inherit the parent's
+        # Matplotlib state (and its memory).
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(jobs, len(figures)),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_batch_worker) as executor:
+            futures = [executor.submit(_render_figure_in_worker, number,
+                                       data_descriptors, small_figures_data,
+                                       figures_data_descriptors, output_dir,
+                                       plot_options, instrumentation.options())
+                       for number in figures]
+            for future in concurrent.futures.as_completed(futures):
+                number, collected = future.result()
+                instrumentation.add_collected(*collected)
+    finally:
+        shared_arrays.release_blocks(data_blocks + figures_data_blocks, unlink=True)
+
+
+
+
+def process_catalog(data_filename, output_dir='.', show=False, jobs=1,
+                    cmd_render='scatter', force=False, bands=bands):
+    """Read a catalog and draw the figures in  output_dir .
+
+    The figures found in the cache are copied from it (unless  force ), the
+    others are rendered and stored in the cache. Figures shown on screen are
+    always rendered. Returns the list of the rendered figures.
+    """
+    with instrumentation.stage('load'):
+        data = load_catalog(data_filename)
+
+    os.makedirs(output_dir, exist_ok=True)
+    cache_dir = figure_cache.cache_dir_for(output_dir)
+    column_hashes = catalog.column_hashes(data_filename)
+    parameters = figure_parameters(cmd_render, bands)
+    fingerprints = {number: figure_fingerprint(number, column_hashes, parameters)
+                    for number in FIGURES}
+
+    to_render = [number for number in FIGURES
+                 if show or force or not figure_cache.restore(
+                     cache_dir, fingerprints[number],
+                     figure_filename(number, output_dir))]
+    if not to_render:
+        return to_render
+
+    # Figure 1 is drawn from the stars' columns only: when it is the only one
+    # to render we don't compute the histograms (and their bands).
+    figures_data = {}
+    if any(FIGURE_STAGES[number]['figures_data'] for number in to_render):
+        with instrumentation.stage('figures_data'):
+            figures_data = compute_figures_data(data, age_bins_separator=age_bins_separator,
+                                                num_of_bins=num_of_bins,
+                                                num_of_bins_2d=num_of_bins_2d, bands=bands,
+                                                with_contour_bands=5 in to_render)
+    with instrumentation.stage('render'):
+        render_figures(data, figures_data, figures=to_render, output_dir=output_dir,
+                       show=show, jobs=jobs, plot_options={1: {'cmd_render': cmd_render}})
+
+    for number in to_render:
+        figure_cache.store(cache_dir, fingerprints[number],
+                           figure_filename(number, output_dir))
+    return to_render
+
+
+def export_statistics(data_filename, stats_filename, bands=bands):
+    """Read a catalog and save the numbers behind the figures in the .npz
+    file  stats_filename , without drawing anything. See stats_export.py.
+
+    The band of the contours of figure 5 is not exported, nor computed.
+    """
+    with instrumentation.stage('load'):
+        data = load_catalog(data_filename)
+    with instrumentation.stage('figures_data'):
+        figures_data = compute_figures_data(data, age_bins_separator=age_bins_separator,
+                                            num_of_bins=num_of_bins,
+                                            num_of_bins_2d=num_of_bins_2d, bands=bands,
+                                            with_contour_bands=False)
+    with instrumentation.stage('export'):
+        stats_export.write_statistics(
+            stats_filename, stats_export.figures_statistics(figures_data),
+            age_bins_separator=age_bins_separator,
+            contour_probabilities=contour_probabilities,
+            bands='none' if bands is None else bands,
+            bands_resamples=bands_resamples, bands_confidence=bands_confidence)
+
+
+def zoom_catalog(data_filename, xlim, ylim, output_dir='.', show=False,
+                 cmd_render='mean'):
+    """Draw a zoomed view of the catalog's colour-magnitude diagram in
+    output_dir , see  plot_image_1_zoom() ."""
+    with instrumentation.stage('tiles'):
+        tiles = load_tiles(data_filename)
+    os.makedirs(output_dir, exist_ok=True)
+    with instrumentation.stage('zoom'):
+        plot_image_1_zoom(tiles, xlim, ylim, output_dir=output_dir, show=show,
+                          cmd_render=cmd_render)
+
+
+
+def main(argv=None):
+    # First we read the file name of the downloaded file given as an argument
+    # to launch this script, and the options.
+    parser = argparse.ArgumentParser(
+        description="Plot the stars' colour vs. magnitude, metallicity and "
+                    "initial mass, grouped by age.")
+    parser.add_argument('data_filename',
+                        help='the catalog of the stars, e.g. Nemo_6670.dat')
+    parser.add_argument('--cmd-render', choices=('scatter',) + density.RENDER_MODES,
+                        default='scatter',
+                        help='how to draw the colour vs. magnitude diagram '
+                             '(image_1.png): one dot per star (scatter, the '
+                             'default), or an image coloured by the mean age or '
+                             'by the majority age bin of the stars in each pixel '
+                             '(faster for large catalogs)')
+    parser.add_argument('--batch', action='store_true',
+                        help="don't show the figures on screen, only save them "
+                             "(non interactive backend), rendering them in "
+                             "parallel")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of processes rendering the figures in '
+                             'batch mode (default: number of CPUs)')
+    parser.add_argument('-o', '--output-dir', default='.',
+                        help='directory where the figures are saved (default: '
+                             'the current directory)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='render all the figures, also those whose data and '
+                             'parameters did not change since the last run')
+    parser.add_argument('--bands', choices=confidence_bands.METHODS + ('none',),
+                        default=bands,
+                        help='confidence bands of the histograms of image_2.png '
+                             'and of the contours of image_5.png: bootstrap '
+                             '(default) or poisson resampling of the counts, or '
+                             'none. See confidence_bands.py')
+    parser.add_argument('--export-stats', metavar='FILE',
+                        help="don't draw the figures, save the histograms and "
+                             "the statistics behind them in the NumPy file FILE "
+                             "(.npz). See stats_export.py")
+    parser.add_argument('--zoom', type=float, nargs=4,
+                        metavar=('XMIN', 'XMAX', 'YMIN', 'YMAX'),
+                        help="don't draw the figures, draw the region XMIN < b-y "
+                             "< XMAX, YMIN < M_V < YMAX of the colour vs. "
+                             "magnitude diagram in image_1_zoom.png, from a tile "
+                             "pyramid built the first time next to the catalog "
+                             "(see tile_pyramid.py). The pixels are coloured as "
+                             "with --cmd-render (mean if scatter)")
+    parser.add_argument('--source', metavar='URL',
+                        help='fetch the catalog from URL (or from a file or a '
+                             'directory) before using it, unless the local copy '
+                             'is up to date. The catalog is parsed while it is '
+                             'downloaded, and an interrupted download is '
+                             'resumed. See fetch.py')
+    parser.add_argument('--sha256', metavar='HASH',
+                        help='with --source, the expected SHA-256 hash of the '
+                             'catalog')
+    parser.add_argument('--instrument', metavar='REPORT',
+                        help='record the time and the memory used by each stage '
+                             '(reading, counting, drawing, saving...), save them '
+                             'as JSON in the file REPORT and print a summary '
+                             'table at the end. See instrumentation.py')
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='with --instrument, also record the memory '
+                             'allocated in each stage (slower)')
+    parser.add_argument('--profile-stage', metavar='STAGE',
+                        help='with --instrument, profile the stage STAGE (e.g. '
+                             'figure_5 or figure_5/contours) with cProfile')
+    args = parser.parse_args(argv)
+    if (args.trace_allocations or args.profile_stage) and not args.instrument:
+        parser.error('--trace-allocations and --profile-stage need --instrument')
+    if args.sha256 and not args.source:
+        parser.error('--sha256 needs --source')
+
+    if args.batch:
+        use_batch_backend()
+
+    if args.instrument:
+        instrumentation.enable(trace_allocations=args.trace_allocations,
+                               profile_stage=args.profile_stage)
+    figure_bands = None if args.bands == 'none' else args.bands
+    try:
+        if args.source:
+            with instrumentation.stage('fetch'):
+                fetch.fetch_catalog(args.source, args.data_filename, args.sha256)
+        if args.export_stats:
+            export_statistics(args.data_filename, args.export_stats,
+                              bands=figure_bands)
+        elif args.zoom:
+            xmin, xmax, ymin, ymax = args.zoom
+            zoom_catalog(args.data_filename, (xmin, xmax), (ymax, ymin),
+                         output_dir=args.output_dir, show=not args.batch,
+                         cmd_render='mean' if args.cmd_render == 'scatter'
+                                    else args.cmd_render)
+        else:
+            process_catalog(args.data_filename, output_dir=args.output_dir,
+                            show=not args.batch, jobs=args.jobs if args.batch else 1,
+                            cmd_render=args.cmd_render, force=args.force,
+                            bands=figure_bands)
+    finally:
+        # We write the report also when a stage fails.
+        if args.instrument:
+            instrumentation.write_report(args.instrument)
+
+
+
+if __name__ == '__main__':
+    main()
@@ -13,19 +13,36 @@ Questo script:
   * e sposta al suo interno i seguenti file
     start_script.sh 
     plot_stars.py
+    plot_catalogs.py
+    catalog.py
+    ensemble.py
+    fetch.py
+    age_groups.py
+    binning.py
+    density.py
+    shared_arrays.py
+    figure_cache.py
+    streaming_stats.py
+    confidence_bands.py
+    kde.py
+    instrumentation.py
+    stats_export.py
+    tile_pyramid.py
+    spatial_index.py
+    benchmark.py
     colors.txt
 
 Questo script inoltre: 
-  * modifica i permessi di esecuzione dei file  start_script.sh  e  plot_stars.py  in modo da renderli eseguibili dall'utente,
+  * modifica i permessi di esecuzione dei file  start_script.sh, plot_stars.py, plot_catalogs.py  e  benchmark.py  in modo da renderli eseguibili dall'utente,
   * modifica il PYTHONPATH ed il PATH di sistema in modo da rendere eseguibile l'applicazione nel suo complesso con un comando (solo in questo terminale).
 
 Premere un tasto qualsiasi per continuare, oppure ^C per uscire: \n"
 
 read -rsn1
 
-chmod u+x start_script.sh plot_stars.py
+chmod u+x start_script.sh plot_stars.py plot_catalogs.py benchmark.py
 mkdir $VAR
-mv start_script.sh plot_stars.py colors.txt $VAR
+mv start_script.sh plot_stars.py plot_catalogs.py catalog.py ensemble.py fetch.py age_groups.py binning.py density.py shared_arrays.py figure_cache.py streaming_stats.py confidence_bands.py kde.py instrumentation.py stats_export.py tile_pyramid.py spatial_index.py benchmark.py colors.txt $VAR
 export PYTHONPATH="${PYTHONPATH:+${PYTHONPATH}:}$PWD/$VAR"
 PATH=$PATH:$PWD/$VAR
 
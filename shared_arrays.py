@@ -0,0 +1,65 @@
+################################################################################
+#  Here we put NumPy arrays in shared memory, so that worker processes can
+#  use them without receiving a pickled copy of the data.
+#  The parent process calls  share_arrays() , sends the (small) descriptors
+#  to the workers, which call  attach_arrays()  to get views of the same
+#  memory. Whoever created the blocks closes and unlinks them at the end with
+#  release_blocks() .
+################################################################################
+
+
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+
+def share_arrays(arrays):
+    """Copy the arrays of the dict  arrays  in shared memory blocks.
+
+    Returns the list of the blocks (keep it until the workers are done) and a
+    dict {name: (block name, dtype, shape)} to be sent to the workers.
+    """
+    blocks = []
+    descriptors = {}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        # A block can't be empty.
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        descriptors[name] = (block.name, array.dtype.str, array.shape)
+    return blocks, descriptors
+
+
+def attach_arrays(descriptors):
+    """Return the blocks and a dict {name: array} viewing the shared memory."""
+    blocks = []
+    arrays = {}
+    for name, (block_name, dtype, shape) in descriptors.items():
+        block = _attach_block(block_name)
+        blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return blocks, arrays
+
+
+def _attach_block(block_name):
+    # Since Python 3.13 we can tell the resource tracker to leave the block
+    # alone. Before, the registration made here goes to the tracker of the
+    # parent process (our workers are its children), which already tracks the
+    # block, so it makes no difference.
+    try:
+        return shared_memory.SharedMemory(name=block_name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=block_name)
+
+
+def release_blocks(blocks, unlink=False):
+    """Close the blocks, and free the memory if  unlink  (creator only)."""
+    for block in blocks:
+        block.close()
+        if unlink:
+            block.unlink()
@@ -0,0 +1,295 @@
+################################################################################
+#  Here we index the stars by their position in a plane (e.g. the colour-
+#  magnitude diagram b_y, M_ass or the initial mass-metallicity plane m_ini,
+#  MsuH), to find the stars inside a box or a polygon without checking every
+#  star.
+#  The index is a uniform grid of cells over the stars: the row indices of
+#  the stars are sorted by cell, and for each cell we keep where its stars
+#  start in the sorted rows. A query only looks at the cells overlapping the
+#  region: the stars of the cells completely inside it are taken as they are,
+#  only the stars of the cells on its border are checked one by one.
+#  The queries return row indices, which can be used with every column.
+#  The index can be saved in a directory next to the catalog and memory-
+#  mapped when read back.
+################################################################################
+
+
+
+import json
+import os
+
+import numpy as np
+
+import age_groups
+import binning
+
+
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index'
+INDEX_META_FILENAME = 'meta.json'
+
+# Average number of stars per cell, when the size of the grid isn't given.
+DEFAULT_STARS_PER_CELL = 16
+MAX_CELLS_PER_AXIS = 4096
+
+
+
+def build_index(x, y, cells_per_axis=None):
+    """Return the grid index of the points (x, y), a dict with:
+      'xlim', 'ylim'   - the region covered by the grid (the points' range),
+      'cells_per_axis' - number of cells along each axis,
+      'order'          - the row indices sorted by cell,
+      'cell_starts'    - where the rows of each cell start in 'order' (one
+                         more value than the cells, the last is the number
+                         of points).
+    Points with NaN coordinates are not indexed.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if cells_per_axis is None:
+        cells_per_axis = int(np.clip(np.sqrt(finite.sum() / DEFAULT_STARS_PER_CELL),
+                                     1, MAX_CELLS_PER_AXIS))
+
+    if finite.any():
+        xlim = (float(x[finite].min()), float(x[finite].max()))
+        ylim = (float(y[finite].min()), float(y[finite].max()))
+    else:
+        xlim = ylim = (0., 1.)
+    # A grid needs a non empty range.
+    xlim = xlim if xlim[1] > xlim[0] else (xlim[0], xlim[0] + 1.)
+    ylim = ylim if ylim[1] > ylim[0] else (ylim[0], ylim[0] + 1.)
+
+    x_edges, y_edges = _cell_edges({'xlim': xlim, 'ylim': ylim,
+                                    'cells_per_axis': cells_per_axis})
+    column = binning.bin_index(x, x_edges)
+    row = binning.bin_index(y, y_edges)
+    num_of_cells = cells_per_axis * cells_per_axis
+    # The non indexed points go to an extra "cell" at the end.
+    cell = np.where(finite, row.astype(np.int64) * cells_per_axis + column,
+                    num_of_cells)
+
+    # Sorting the rows by cell is the same as splitting the stars in groups,
+    # see age_groups.py.
+    order, sizes = age_groups.sort_by_group(cell, num_of_cells + 1)
+    cell_starts = np.concatenate(([0], np.cumsum(sizes[:num_of_cells])))
+
+    return {'xlim': xlim, 'ylim': ylim, 'cells_per_axis': cells_per_axis,
+            'order': order, 'cell_starts': cell_starts}
+
+
+
+
+################################################################################
+#  Saving and loading.
+################################################################################
+
+def default_index_dir(data_filename, plane):
+    return os.path.join(data_filename + INDEX_SUFFIX, plane)
+
+
+def read_meta(index_dir):
+    try:
+        with open(os.path.join(index_dir, INDEX_META_FILENAME)) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_index(index_dir, index, source=None):
+    """Save the index in  index_dir .  source  is anything JSON-like
+    identifying the data (e.g. the hashes of the columns)."""
+    os.makedirs(index_dir, exist_ok=True)
+    meta_filename = os.path.join(index_dir, INDEX_META_FILENAME)
+    # The index is invalid until the new meta file is written at the end.
+    try:
+        os.remove(meta_filename)
+    except FileNotFoundError:
+        pass
+    for name in ('order', 'cell_starts'):
+        np.save(os.path.join(index_dir, name + '.npy'), index[name])
+    with open(meta_filename + '.tmp', 'w') as meta_file:
+        json.dump({'version': INDEX_VERSION,
+                   'xlim': list(index['xlim']), 'ylim': list(index['ylim']),
+                   'cells_per_axis': index['cells_per_axis'],
+                   'source': source}, meta_file, indent=2)
+    os.replace(meta_filename + '.tmp', meta_filename)
+
+
+def is_index_valid(index_dir, source=None):
+    meta = read_meta(index_dir)
+    return (meta is not None and meta['version'] == INDEX_VERSION
+            and meta['source'] == source)
+
+
+def load_index(index_dir):
+    """Return the index saved in  index_dir , memory-mapped."""
+    meta = read_meta(index_dir)
+    index = {'xlim': tuple(meta['xlim']), 'ylim': tuple(meta['ylim']),
+             'cells_per_axis': meta['cells_per_axis']}
+    for name in ('order', 'cell_starts'):
+        index[name] = np.load(os.path.join(index_dir, name + '.npy'),
+                              mmap_mode='r')
+    return index
+
+
+
+
+################################################################################
+#  Queries.
+################################################################################
+
+def _cell_edges(index):
+    # The edges of the columns and rows of the grid: the same ones the stars
+    # were put in the cells with, so that the queries agree with them to the
+    # last bit.
+    cells_per_axis = index['cells_per_axis']
+    return (binning.uniform_edges(*index['xlim'], cells_per_axis),
+            binning.uniform_edges(*index['ylim'], cells_per_axis))
+
+
+def _cell_range(index, xlim, ylim):
+    # The first and last column and row of the cells overlapping the region,
+    # None if the region is outside the grid.
+    cells_per_axis = index['cells_per_axis']
+
+    def cell_range(lo, hi, edges):
+        if hi < edges[0] or lo > edges[-1]:
+            return None
+        # The cell of a value  v  is the one with  edges[c] <= v < edges[c+1] ,
+        # the last one includes its right edge (see  binning.bin_index() ).
+        first, last = np.searchsorted(edges, (lo, hi), side='right') - 1
+        return (int(np.clip(first, 0, cells_per_axis - 1)),
+                int(np.clip(last, 0, cells_per_axis - 1)))
+
+    x_edges, y_edges = _cell_edges(index)
+    columns = cell_range(min(xlim), max(xlim), x_edges)
+    rows = cell_range(min(ylim), max(ylim), y_edges)
+    if columns is None or rows is None:
+        return None
+    return columns, rows
+
+
+def _cells_rows(index, cells):
+    # The rows of the stars in the given cells, concatenated.
+    cell_starts = index['cell_starts']
+    starts = np.asarray(cell_starts[cells])
+    lengths = np.asarray(cell_starts[cells + 1]) - starts
+    positions = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+                 + np.arange(lengths.sum()))
+    return np.asarray(index['order'][positions])
+
+
+def _cell_boxes(index, columns, rows):
+    # The corners of the cells (columns, rows).
+    x_edges, y_edges = _cell_edges(index)
+    return x_edges[columns], x_edges[columns + 1], y_edges[rows], y_edges[rows + 1]
+
+
+def query_box(index, x, y, xlim, ylim):
+    """Return the sorted rows of the stars with  xlim[0] <= x <= xlim[1]  and
+    ylim[0] <= y <= ylim[1] .  x  and  y  are the columns the index was built
+    from."""
+    cell_range = _cell_range(index, xlim, ylim)
+    if cell_range is None:
+        return np.empty(0, dtype=np.intp)
+    (first_column, last_column), (first_row, last_row) = cell_range
+    columns, rows = np.meshgrid(np.arange(first_column, last_column + 1),
+                                np.arange(first_row, last_row + 1))
+    columns, rows = columns.ravel(), rows.ravel()
+
+    left, right, bottom, top = _cell_boxes(index, columns, rows)
+    inside = ((left >= min(xlim)) & (right <= max(xlim))
+              & (bottom >= min(ylim)) & (top <= max(ylim)))
+    cells = rows * index['cells_per_axis'] + columns
+
+    border_rows = _cells_rows(index, cells[~inside])
+    x_border, y_border = np.asarray(x)[border_rows], np.asarray(y)[border_rows]
+    border_rows = border_rows[(x_border >= min(xlim)) & (x_border <= max(xlim))
+                              & (y_border >= min(ylim)) & (y_border <= max(ylim))]
+    return np.sort(np.concatenate((_cells_rows(index, cells[inside]), border_rows)))
+
+
+def points_in_polygon(px, py, rings):
+    """Return a boolean array, True for the points inside the polygon.
+
+    rings  is a list of (n, 2) arrays of vertices: the outer boundary and the
+    holes, or several polygons. A point is inside if it's inside an odd
+    number of rings (even-odd rule).
+    """
+    px = np.asarray(px, dtype=float)
+    py = np.asarray(py, dtype=float)
+    inside = np.zeros(px.shape, dtype=bool)
+    for ring in rings:
+        ring = np.asarray(ring, dtype=float)
+        xa, ya = ring[:, 0], ring[:, 1]
+        xb, yb = np.roll(xa, -1), np.roll(ya, -1)
+        # We cast a ray from each point towards +x and count the edges it
+        # crosses.
+        for x_a, y_a, x_b, y_b in zip(xa, ya, xb, yb):
+            if y_a == y_b:
+                continue
+            crosses = (y_a > py) != (y_b > py)
+            x_cross = x_a + (py - y_a) * (x_b - x_a) / (y_b - y_a)
+            inside ^= crosses & (px < x_cross)
+    return inside
+
+
+def _cells_on_boundary(index, rings, column_range, row_range):
+    # A 2D array (rows x columns) over the block of cells  column_range x
+    # row_range , True for the cells crossed by an edge of the polygon.
+    (first_column, last_column), (first_row, last_row) = column_range, row_range
+    on_boundary = np.zeros((last_row - first_row + 1,
+                            last_column - first_column + 1), dtype=bool)
+    for ring in rings:
+        for (x_a, y_a), (x_b, y_b) in zip(ring, np.roll(ring, -1, axis=0)):
+            # The cells overlapping the edge's bounding box...
+            edge_range = _cell_range(index, (x_a, x_b), (y_a, y_b))
+            if edge_range is None:
+                continue
+            (c0, c1), (r0, r1) = edge_range
+            c0, c1 = max(c0, first_column), min(c1, last_column)
+            r0, r1 = max(r0, first_row), min(r1, last_row)
+            columns, rows = np.meshgrid(np.arange(c0, c1 + 1), np.arange(r0, r1 + 1))
+            left, right, bottom, top = _cell_boxes(index, columns, rows)
+            # ...whose corners are not all on the same side of the edge's line.
+            sides = [(x_b - x_a) * (corner_y - y_a) - (y_b - y_a) * (corner_x - x_a)
+                     for corner_x, corner_y in ((left, bottom), (left, top),
+                                                (right, bottom), (right, top))]
+            on_boundary[r0-first_row:r1-first_row+1, c0-first_column:c1-first_column+1] |= (
+                (np.minimum.reduce(sides) <= 0) & (np.maximum.reduce(sides) >= 0))
+    return on_boundary
+
+
+def query_polygon(index, x, y, rings):
+    """Return the sorted rows of the stars inside the polygon (see
+    points_in_polygon() ).  x  and  y  are the columns the index was built
+    from."""
+    rings = [np.asarray(ring, dtype=float) for ring in rings if len(ring) >= 3]
+    if not rings:
+        return np.empty(0, dtype=np.intp)
+    vertices = np.concatenate(rings)
+    cell_range = _cell_range(index, (vertices[:, 0].min(), vertices[:, 0].max()),
+                             (vertices[:, 1].min(), vertices[:, 1].max()))
+    if cell_range is None:
+        return np.empty(0, dtype=np.intp)
+    (first_column, last_column), (first_row, last_row) = cell_range
+    columns, rows = np.meshgrid(np.arange(first_column, last_column + 1),
+                                np.arange(first_row, last_row + 1))
+    columns, rows = columns.ravel(), rows.ravel()
+    cells = rows * index['cells_per_axis'] + columns
+
+    # A cell not crossed by the polygon's edges is either completely inside
+    # or completely outside: its centre tells which.
+    on_boundary = _cells_on_boundary(index, rings, (first_column, last_column),
+                                     (first_row, last_row)).ravel()
+    left, right, bottom, top = _cell_boxes(index, columns[~on_boundary],
+                                           rows[~on_boundary])
+    inside = points_in_polygon((left + right) / 2, (bottom + top) / 2, rings)
+
+    border_rows = _cells_rows(index, cells[on_boundary])
+    border_rows = border_rows[points_in_polygon(np.asarray(x)[border_rows],
+                                                np.asarray(y)[border_rows], rings)]
+    return np.sort(np.concatenate((_cells_rows(index, cells[~on_boundary][inside]),
+                                   border_rows)))
@@ -17,12 +17,8 @@ Premere un tasto qualsiasi per continuare, oppure ^C per uscire: \n"
 
 read -rsn1
 
-echo -e "Sto scaricando il file:\n"
+echo -e "Scarico il file (se non è già presente) e avvio lo script python:\n"
 
-wget -nv  $VAR
-
-echo -e "\nOra avvio lo script python."
-
-python plot_stars.py Nemo_6670.dat
+python plot_stars.py Nemo_6670.dat --source $VAR
 
 echo -e "\nTutti i plot sono stati salvati in file separati in questa directory.\n\nLo script ha terminato tutte le operazioni."
@@ -0,0 +1,94 @@
+################################################################################
+#  Here we save the numbers behind the figures, instead of the figures: the
+#  metallicity histograms of figure 2 (counts, relative frequencies, mean and
+#  median of each age group) and the mass-metallicity 2D histograms of figures
+#  4 and 5, with their bin edges and, if computed, their confidence bands,
+#  and the density estimate the contours of figure 5 are drawn from.
+#  They are saved in a compressed NumPy file (.npz), one named array each,
+#  which can be read back with  np.load()  or  read_statistics() .
+#  The first axis of the arrays with one row per age group is the age group.
+#  With them we save the parameters they depend on, e.g. the age groups
+#  delimiters and the method of the bands ('none' if they weren't computed)
+#  with their confidence level.
+################################################################################
+
+
+
+import os
+
+import numpy as np
+
+import streaming_stats
+
+
+
+def figures_statistics(figures_data):
+    """Return a dict {name: array} of the statistics behind the figures, from
+    the result of  plot_stars.compute_figures_data() ."""
+    metallicity_counts = figures_data['metallicity_cube']['counts']
+    metallicity_moments = figures_data['metallicity_moments']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metallicity_frequencies = (metallicity_counts
+                                   / metallicity_moments['count'][:, None])
+
+    statistics = {
+        'age_groups_sizes': np.asarray(figures_data['age_groups_sizes']),
+        # Figure 2.
+        'metallicity_edges': figures_data['stars_metallicity_histogram_bins'],
+        'metallicity_counts': metallicity_counts,
+        'metallicity_frequencies': metallicity_frequencies,
+        'metallicity_mean': metallicity_moments['mean'],
+        'metallicity_median': figures_data['metallicity_medians'],
+        'metallicity_variance': streaming_stats.variance(metallicity_moments),
+        # Figure 5: the same mass bins for all the age groups.
+        'mass_edges_2d': figures_data['mass_edges_2d'],
+        'metallicity_edges_2d': figures_data['metallicity_edges_2d'],
+        'mass_metallicity_counts': figures_data['mass_metallicity_cube']['counts'],
+        # Figure 4: the mass bins of each age group.
+        'mass_edges_by_age': figures_data['mass_edges_by_age'],
+        'mass_metallicity_counts_by_age':
+            figures_data['mass_metallicity_cube_by_age']['counts'],
+        # The density estimate the contours of figure 5 are drawn from, and
+        # the density level of each contour.
+        'log_mass_edges_kde': figures_data['log_mass_edges_kde'],
+        'metallicity_edges_kde': figures_data['metallicity_edges_kde'],
+        'mass_metallicity_density': figures_data['mass_metallicity_density'],
+        'kde_bandwidths': figures_data['kde_bandwidths'],
+        'contour_density_levels': figures_data['contour_density_levels'],
+    }
+
+    # The confidence bands, if they were computed (see confidence_bands.py).
+    metallicity_bands = figures_data.get('metallicity_bands')
+    if metallicity_bands is not None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for bound in ('lower', 'upper'):
+                statistics['metallicity_frequencies_' + bound] = (
+                    metallicity_bands[bound] / metallicity_moments['count'][:, None])
+    mass_metallicity_bands = figures_data.get('mass_metallicity_bands')
+    if mass_metallicity_bands is not None:
+        for bound in ('lower', 'upper'):
+            statistics['mass_metallicity_counts_' + bound] = mass_metallicity_bands[bound]
+    return statistics
+
+
+def write_statistics(filename, statistics, **parameters):
+    """Save the statistics (and the given parameters, e.g. the age groups
+    delimiters) in the .npz file  filename ."""
+    arrays = dict(statistics)
+    arrays.update({name: np.asarray(value) for name, value in parameters.items()})
+    # Write and rename, so that the readers never see a partial file.
+    with open(filename + '.tmp', 'wb') as stats_file:
+        np.savez_compressed(stats_file, **arrays)
+    os.replace(filename + '.tmp', filename)
+
+
+def read_statistics(filename):
+    """Return the statistics saved by  write_statistics()  as a dict. The
+    strings among the parameters (e.g. the bands' method) are returned as
+    str."""
+    with np.load(filename) as stats_file:
+        statistics = {name: stats_file[name] for name in stats_file.files}
+    for name, value in statistics.items():
+        if value.ndim == 0 and value.dtype.kind == 'U':
+            statistics[name] = str(value)
+    return statistics
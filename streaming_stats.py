@@ -0,0 +1,254 @@
+################################################################################
+#  Here we compute statistics of the stars in each age group (count, mean,
+#  variance, min, max, median and quantiles) going through the data in
+#  chunks, so that the stars don't have to be all in memory at once.
+#
+#  The data is given as a "chunk source": a function which, each time it is
+#  called, returns an iterator over  (values, group_of_star)  pairs of arrays
+#  (see  iter_group_chunks() ). The moments need a single pass over the
+#  chunks. The median and the quantiles are exact (the same values as
+#  np.median()  and  np.quantile() ), we find them with a few passes:
+#    1) we count the stars in a grid of bins between the min and max value and
+#       find the bin holding the wanted rank,
+#    2) we repeat 1) inside that bin, until it holds at most  max_candidates
+#       stars (or a single distinct value),
+#    3) we collect those stars and pick the value with the wanted rank.
+#  With the default 4096 bins, two or three passes are usually enough.
+################################################################################
+
+
+
+import numpy as np
+
+import binning
+
+
+
+DEFAULT_CHUNK_ROWS = binning.DEFAULT_CHUNK_ROWS
+DEFAULT_NUM_OF_BINS = 4096
+DEFAULT_MAX_CANDIDATES = 1 << 20
+
+
+
+def iter_group_chunks(values, group_of_star, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Yield  (values, group_of_star)  chunks of two arrays held in memory."""
+    for start in range(0, len(values), chunk_rows):
+        yield (np.asarray(values[start:start+chunk_rows]),
+               np.asarray(group_of_star[start:start+chunk_rows]))
+
+
+
+################################################################################
+#  Moments. For each group we keep the number of stars, their mean, the sum of
+#  the squared deviations from the mean (M2), min and max. Two sets of
+#  moments can be merged (Chan et al. parallel algorithm), so they can be
+#  computed on chunks, files or processes separately.
+################################################################################
+
+def empty_moments(num_of_groups):
+    return {'count': np.zeros(num_of_groups, dtype=np.int64),
+            'mean': np.zeros(num_of_groups),
+            'm2': np.zeros(num_of_groups),
+            'min': np.full(num_of_groups, np.inf),
+            'max': np.full(num_of_groups, -np.inf)}
+
+
+def chunk_moments(values, group_of_star, num_of_groups):
+    """Return the moments of the stars of one chunk."""
+    group_of_star = np.asarray(group_of_star).astype(np.intp)
+    count = np.bincount(group_of_star, minlength=num_of_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(group_of_star, weights=values,
+                           minlength=num_of_groups) / count
+    mean[count == 0] = 0.
+    deviation = values - mean[group_of_star]
+    m2 = np.bincount(group_of_star, weights=deviation*deviation,
+                     minlength=num_of_groups)
+
+    min_values = np.full(num_of_groups, np.inf)
+    max_values = np.full(num_of_groups, -np.inf)
+    np.minimum.at(min_values, group_of_star, values)
+    np.maximum.at(max_values, group_of_star, values)
+
+    return {'count': count, 'mean': mean, 'm2': m2,
+            'min': min_values, 'max': max_values}
+
+
+def merge_moments(a, b):
+    """Return the moments of the union of the stars of  a  and  b ."""
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight_b = np.where(count > 0, b['count'] / count, 0.)
+    return {'count': count,
+            'mean': a['mean'] + delta * weight_b,
+            'm2': a['m2'] + b['m2'] + delta*delta * a['count'] * weight_b,
+            'min': np.minimum(a['min'], b['min']),
+            'max': np.maximum(a['max'], b['max'])}
+
+
+def group_moments(chunks, num_of_groups):
+    """Return the moments of each group from an iterable of chunks."""
+    moments = empty_moments(num_of_groups)
+    for values, group_of_star in chunks:
+        moments = merge_moments(moments, chunk_moments(values, group_of_star,
+                                                       num_of_groups))
+    return moments
+
+
+def variance(moments, ddof=0):
+    """Return the variance of each group, as  np.var(..., ddof=ddof) ."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return moments['m2'] / (moments['count'] - ddof)
+
+
+
+################################################################################
+#  Exact order statistics, median and quantiles.
+################################################################################
+
+def group_order_statistics(chunk_source, ranks_by_group, moments,
+                           num_of_bins=DEFAULT_NUM_OF_BINS,
+                           max_candidates=DEFAULT_MAX_CANDIDATES):
+    """Return the values with the given ranks (0 = smallest) in each group.
+
+    ranks_by_group  is a dict {group: list of ranks}, the result is a dict
+    {group: {rank: value}}.  moments  are the moments of the same data (see
+    group_moments() ), they give the range of values of each group.
+    """
+    # A target is a rank we are looking for. We keep the range of values
+    # [lo, hi] (hi excluded unless  hi_closed ) known to contain it and the
+    # number of stars of its group below  lo .
+    targets = [{'group': group, 'rank': rank,
+                'lo': moments['min'][group], 'hi': moments['max'][group],
+                'hi_closed': True, 'below': 0}
+               for group, ranks in ranks_by_group.items() for rank in ranks]
+    results = {group: {} for group in ranks_by_group}
+
+    def in_range(target, values, group_of_star):
+        selected = group_of_star == target['group']
+        selected &= values >= target['lo']
+        if target['hi_closed']:
+            selected &= values <= target['hi']
+        else:
+            selected &= values < target['hi']
+        return values[selected]
+
+    while targets:
+        # One pass over the data: for each target we count the stars in its
+        # range, in  num_of_bins  bins, and the min and max value found.
+        for target in targets:
+            target['counts'] = np.zeros(num_of_bins, dtype=np.int64)
+            target['found_min'], target['found_max'] = np.inf, -np.inf
+            target['edges'] = binning.uniform_edges(target['lo'], target['hi'],
+                                                    num_of_bins)
+        for values, group_of_star in chunk_source():
+            for target in targets:
+                selected = in_range(target, values, group_of_star)
+                if selected.size == 0:
+                    continue
+                index = binning.bin_index(selected, target['edges'])
+                target['counts'] += np.bincount(index, minlength=num_of_bins)
+                target['found_min'] = min(target['found_min'], selected.min())
+                target['found_max'] = max(target['found_max'], selected.max())
+
+        # We narrow the range of each target to the bin holding its rank.
+        to_collect = []
+        for target in targets:
+            rank_in_range = target['rank'] - target['below']
+            if target['found_min'] == target['found_max']:
+                results[target['group']][target['rank']] = target['found_min']
+                continue
+
+            cumulative = np.cumsum(target['counts'])
+            b = int(np.searchsorted(cumulative, rank_in_range, side='right'))
+            target['below'] += int(cumulative[b-1]) if b > 0 else 0
+            target['lo'] = target['edges'][b]
+            if b < num_of_bins - 1:
+                target['hi'], target['hi_closed'] = target['edges'][b+1], False
+            if target['counts'][b] <= max_candidates:
+                to_collect.append(target)
+
+        # The targets with few candidates left: one more pass to collect the
+        # candidates, then we pick the value with the wanted rank.
+        if to_collect:
+            candidates = [[] for target in to_collect]
+            for values, group_of_star in chunk_source():
+                for target, target_candidates in zip(to_collect, candidates):
+                    target_candidates.append(in_range(target, values,
+                                                      group_of_star))
+            for target, target_candidates in zip(to_collect, candidates):
+                target_candidates = np.concatenate(target_candidates)
+                k = target['rank'] - target['below']
+                results[target['group']][target['rank']] = np.partition(
+                    target_candidates, k)[k]
+
+        targets = [target for target in targets
+                   if target['rank'] not in results[target['group']]]
+
+    return results
+
+
+def _lerp(a, b, t):
+    # Linear interpolation as done by  np.quantile() .
+    diff_b_a = b - a
+    if t >= 0.5:
+        return b - diff_b_a * (1 - t)
+    return a + diff_b_a * t
+
+
+def group_quantiles(chunk_source, num_of_groups, quantiles, moments=None,
+                    **kwargs):
+    """Return an array (groups x quantiles) with the exact quantiles of each
+    group, computed as  np.quantile()  does (linear interpolation).
+
+    Groups without stars get NaN.
+    """
+    if moments is None:
+        moments = group_moments(chunk_source(), num_of_groups)
+
+    positions = {}
+    ranks_by_group = {}
+    for group in range(num_of_groups):
+        count = int(moments['count'][group])
+        if count == 0:
+            continue
+        ranks_by_group[group] = set()
+        for q in quantiles:
+            position = (count - 1) * q
+            below = int(np.floor(position))
+            above = min(below + 1, count - 1)
+            positions[group, q] = (below, above, position - below)
+            ranks_by_group[group].update((below, above))
+
+    values = group_order_statistics(chunk_source, ranks_by_group, moments,
+                                    **kwargs)
+
+    result = np.full((num_of_groups, len(quantiles)), np.nan)
+    for (group, q), (below, above, t) in positions.items():
+        result[group, list(quantiles).index(q)] = _lerp(values[group][below],
+                                                        values[group][above], t)
+    return result
+
+
+def group_medians(chunk_source, num_of_groups, moments=None, **kwargs):
+    """Return the exact median of each group, as  np.median()  does (the mean
+    of the two middle values when the number of stars is even)."""
+    if moments is None:
+        moments = group_moments(chunk_source(), num_of_groups)
+
+    ranks_by_group = {}
+    for group in range(num_of_groups):
+        count = int(moments['count'][group])
+        if count:
+            ranks_by_group[group] = {(count - 1) // 2, count // 2}
+
+    values = group_order_statistics(chunk_source, ranks_by_group, moments,
+                                    **kwargs)
+
+    medians = np.full(num_of_groups, np.nan)
+    for group, ranks in ranks_by_group.items():
+        middle = sorted(ranks)
+        medians[group] = np.mean([values[group][rank] for rank in
+                                  (middle[0], middle[-1])])
+    return medians
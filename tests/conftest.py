@@ -0,0 +1,9 @@
+################################################################################
+#  The modules are flat files in the repository's root (see setup.sh): we
+#  make them importable from the tests.
+################################################################################
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
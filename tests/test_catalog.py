@@ -0,0 +1,72 @@
+################################################################################
+#  The binary cache of the catalog's columns (see catalog.py): it is rebuilt
+#  when the catalog changes, and kept when only its mtime does.
+################################################################################
+
+import os
+
+import numpy as np
+import pytest
+
+import benchmark
+import catalog
+
+
+
+@pytest.fixture
+def data_filename(tmp_path):
+    data_filename = str(tmp_path / 'catalog.dat')
+    benchmark.generate_catalog(data_filename, 2000)
+    catalog.ensure_cache(data_filename)
+    return data_filename
+
+
+def _assert_cache_matches(data_filename):
+    cached = catalog.load_catalog_cached(data_filename)
+    parsed = catalog.load_catalog(data_filename)
+    for name in catalog.CATALOG_COLUMNS:
+        np.testing.assert_array_equal(cached[name], parsed[name], err_msg=name)
+
+
+def _set_mtime_later(data_filename):
+    stat = os.stat(data_filename)
+    os.utime(data_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_cache_rebuilt_after_size_change(data_filename):
+    with open(data_filename) as data_file:
+        first_row = data_file.readlines()[1]
+    with open(data_filename, 'a') as data_file:
+        data_file.write(first_row)
+    _set_mtime_later(data_filename)
+
+    assert not catalog.is_cache_valid(data_filename)
+    _assert_cache_matches(data_filename)
+    assert catalog.read_cache_meta(catalog.default_cache_dir(data_filename))['rows'] == 2001
+
+
+def test_cache_rebuilt_after_content_change(data_filename):
+    # Same size, another value, later mtime: the hash tells them apart.
+    with open(data_filename) as data_file:
+        lines = data_file.readlines()
+    values = lines[1].split()
+    values[0] = values[0][:-1] + ('9' if values[0][-1] != '9' else '8')
+    lines[1] = ' '.join(values) + '\n'
+    with open(data_filename, 'w') as data_file:
+        data_file.writelines(lines)
+    _set_mtime_later(data_filename)
+
+    assert not catalog.is_cache_valid(data_filename)
+    _assert_cache_matches(data_filename)
+
+
+def test_cache_kept_after_mtime_change(data_filename):
+    cache_dir = catalog.default_cache_dir(data_filename)
+    column_filename = os.path.join(cache_dir, catalog.CATALOG_COLUMNS[0] + '.bin')
+    column_mtime = os.stat(column_filename).st_mtime_ns
+    _set_mtime_later(data_filename)
+
+    assert catalog.is_cache_valid(data_filename)
+    assert catalog.read_cache_meta(cache_dir)['mtime_ns'] == os.stat(data_filename).st_mtime_ns
+    _assert_cache_matches(data_filename)
+    assert os.stat(column_filename).st_mtime_ns == column_mtime
@@ -0,0 +1,47 @@
+################################################################################
+#  The figures' data of an ensemble of catalogs, aggregated chunk by chunk by
+#  a pool of processes (see ensemble.py), against a single pass on one
+#  catalog holding all their stars.
+################################################################################
+
+import numpy as np
+import pytest
+
+import benchmark
+import ensemble
+import plot_stars
+
+
+
+def _assert_same(ensemble_value, single_value, name):
+    if isinstance(ensemble_value, dict):
+        assert ensemble_value.keys() <= single_value.keys(), name
+        for key, value in ensemble_value.items():
+            _assert_same(value, single_value[key], '{}[{!r}]'.format(name, key))
+    elif isinstance(ensemble_value, (list, tuple)):
+        assert len(ensemble_value) == len(single_value), name
+        for i, value in enumerate(ensemble_value):
+            _assert_same(value, single_value[i], '{}[{}]'.format(name, i))
+    elif ensemble_value is None or isinstance(ensemble_value, str):
+        assert ensemble_value == single_value, name
+    else:
+        np.testing.assert_array_equal(ensemble_value, single_value, err_msg=name)
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_ensemble_matches_single_pass(jobs, tmp_path):
+    catalogs = [str(tmp_path / 'catalog_{}.dat'.format(seed)) for seed in range(3)]
+    for seed, data_filename in enumerate(catalogs):
+        benchmark.generate_catalog(data_filename, 3000 + 1000 * seed, seed=seed)
+    # All the stars in one catalog, with the header of the first one only.
+    single_filename = str(tmp_path / 'single.dat')
+    with open(single_filename, 'w') as single_file:
+        for i, data_filename in enumerate(catalogs):
+            with open(data_filename) as data_file:
+                lines = data_file.readlines()
+            single_file.writelines(lines if i == 0 else lines[1:])
+
+    ensemble_data = ensemble.aggregate_catalogs(catalogs, jobs=jobs, bands='poisson')
+    single_data = plot_stars.compute_figures_data(plot_stars.load_catalog(single_filename),
+                                                  bands='poisson')
+    _assert_same(ensemble_data, single_data, 'figures_data')
@@ -0,0 +1,80 @@
+################################################################################
+#  Fetching a catalog from a local source (see fetch.py): resuming an
+#  interrupted fetch, and the files a failed or interrupted fetch leaves
+#  behind.
+################################################################################
+
+import os
+
+import numpy as np
+import pytest
+
+import benchmark
+import catalog
+import fetch
+
+
+
+@pytest.fixture
+def source(tmp_path):
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    source = str(source_dir / 'catalog.dat')
+    benchmark.generate_catalog(source, 5000)
+    return source
+
+
+def test_failed_fetch_leaves_no_cache(tmp_path):
+    data_filename = str(tmp_path / 'catalog.dat')
+    with pytest.raises(OSError):
+        fetch.fetch_catalog(str(tmp_path / 'missing.dat'), data_filename)
+    assert not os.path.exists(catalog.default_cache_dir(data_filename))
+
+
+def test_interrupted_fetch_keeps_complete_meta(source, tmp_path):
+    data_filename = str(tmp_path / 'catalog.dat')
+    assert fetch.fetch_catalog(source, data_filename)
+    meta = fetch.read_fetch_meta(data_filename)
+    assert meta['source'] == source
+
+    # A download from another source, stopped after its first block.
+    other_source = str(tmp_path / 'other.dat')
+    benchmark.generate_catalog(other_source, 5000, seed=1)
+    blocks = fetch.download_blocks(other_source, data_filename)
+    next(blocks)
+    blocks.close()
+
+    assert fetch.read_fetch_meta(data_filename) == meta
+    assert fetch.is_up_to_date(source, data_filename)
+    assert not fetch.fetch_catalog(source, data_filename)
+
+
+def test_interrupted_fetch_resumes(source, tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch, 'DOWNLOAD_BLOCK_SIZE', 4096)
+    data_filename = str(tmp_path / 'catalog.dat')
+    blocks = fetch.download_blocks(source, data_filename)
+    for _ in range(3):
+        next(blocks)
+    blocks.close()
+    part_size = os.path.getsize(data_filename + fetch.PART_SUFFIX)
+    assert part_size >= 3 * 4096
+
+    offsets = []
+    open_source = fetch._open_source
+
+    def recording_open_source(source, offset, etag=None):
+        result = open_source(source, offset, etag)
+        offsets.append(result[1])
+        return result
+    monkeypatch.setattr(fetch, '_open_source', recording_open_source)
+    assert fetch.fetch_catalog(source, data_filename)
+
+    assert offsets == [part_size]
+    assert not os.path.exists(data_filename + fetch.PART_SUFFIX)
+    assert not os.path.exists(data_filename + fetch.PART_META_SUFFIX)
+    with open(source, 'rb') as source_file, open(data_filename, 'rb') as data_file:
+        assert data_file.read() == source_file.read()
+    parsed = catalog.load_catalog(data_filename)
+    cached = catalog.load_catalog_cached(data_filename)
+    for name in catalog.CATALOG_COLUMNS:
+        np.testing.assert_array_equal(cached[name], parsed[name], err_msg=name)
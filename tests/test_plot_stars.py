@@ -0,0 +1,85 @@
+################################################################################
+#  The figures' data (see  plot_stars.compute_figures_data() ) and the
+#  figures drawn from it, on a small synthetic catalog.
+################################################################################
+
+import numpy as np
+import pytest
+
+import benchmark
+import plot_stars
+import stats_export
+
+
+
+def _synthetic_data(num_of_stars=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'age_parent': rng.uniform(0., 10., num_of_stars),
+        'MsuH': rng.normal(-0.5, 0.4, num_of_stars),
+        'm_ini': rng.lognormal(0., 0.5, num_of_stars),
+        'b_y': rng.uniform(0., 1., num_of_stars),
+        'M_ass': rng.uniform(-4., 8., num_of_stars),
+    }
+
+
+@pytest.fixture(scope='module')
+def empty_group_data():
+    # No star is older than 10 Gyr: the last age group is empty.
+    data = _synthetic_data()
+    figures_data = plot_stars.compute_figures_data(data, age_bins_separator=[1, 3, 20],
+                                                   bands='bootstrap')
+    return data, figures_data
+
+
+def test_empty_age_group_edges(empty_group_data):
+    data, figures_data = empty_group_data
+    assert figures_data['age_groups_sizes'].tolist()[-1] == 0
+    # The empty group gets the mass range of all the stars.
+    np.testing.assert_array_equal(figures_data['mass_edges_by_age'][3],
+                                  figures_data['mass_edges_2d'])
+    assert np.all(np.isfinite(figures_data['mass_edges_by_age']))
+    assert np.all(np.isfinite(figures_data['contour_density_levels'][:3]))
+    assert '(no stars)' in figures_data['dict_stars_metallicity_by_age_labels'][3]
+
+
+@pytest.mark.parametrize('number', [2, 3, 4, 5])
+def test_empty_age_group_figures(empty_group_data, number, tmp_path):
+    plot_stars.use_batch_backend()
+    data, figures_data = empty_group_data
+    with np.errstate(all='raise'):
+        plot_stars.render_figure(number, data, figures_data, output_dir=str(tmp_path))
+    assert (tmp_path / 'image_{}.png'.format(number)).is_file()
+
+
+def test_regroup_fine_age_counts():
+    # The counts of other age groups, summed from the fine age bins, are those
+    # counted from the stars.
+    data = _synthetic_data()
+    figures_data = plot_stars.compute_figures_data(data, bands=None)
+    age_bins_separator = [0.99, 3.33, 8.35]
+    regrouped_data = plot_stars.compute_figures_data(data, age_bins_separator,
+                                                     bands=None)
+    for name, cube in (('metallicity_counts', 'metallicity_cube'),
+                       ('mass_metallicity_counts', 'mass_metallicity_cube')):
+        np.testing.assert_array_equal(
+            plot_stars.regroup_cube(figures_data['fine_age_counts'][name],
+                                    figures_data['fine_age_separators'],
+                                    age_bins_separator),
+            regrouped_data[cube]['counts'])
+    with pytest.raises(ValueError):
+        plot_stars.regroup_cube(figures_data['fine_age_counts']['kde_counts'],
+                                figures_data['fine_age_separators'], [2])
+
+
+@pytest.mark.parametrize('bands', ['poisson', None])
+def test_export_statistics_bands(bands, tmp_path):
+    # The method of the bands is saved with their confidence level.
+    data_filename = str(tmp_path / 'catalog.dat')
+    stats_filename = str(tmp_path / 'statistics.npz')
+    benchmark.generate_catalog(data_filename, 2000)
+    plot_stars.export_statistics(data_filename, stats_filename, bands=bands)
+    statistics = stats_export.read_statistics(stats_filename)
+    assert statistics['bands'] == ('none' if bands is None else bands)
+    assert statistics['bands_confidence'] == plot_stars.bands_confidence
+    assert ('metallicity_frequencies_lower' in statistics) == (bands is not None)
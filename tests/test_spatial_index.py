@@ -0,0 +1,91 @@
+################################################################################
+#  The queries of the grid index (see spatial_index.py) must return exactly
+#  the stars found by checking every star, also for stars and regions on the
+#  edges of the cells and of the grid.
+################################################################################
+
+import numpy as np
+import pytest
+
+import spatial_index
+
+
+
+def _brute_force_box(x, y, xlim, ylim):
+    return np.flatnonzero((x >= min(xlim)) & (x <= max(xlim))
+                          & (y >= min(ylim)) & (y <= max(ylim)))
+
+
+def _random_catalog(rng):
+    # Rounded coordinates, so that many stars lie on the edges of the cells.
+    num_of_stars = rng.integers(1, 400)
+    x = np.round(rng.uniform(-4., 4., num_of_stars), 1)
+    y = np.round(rng.uniform(-3., 3., num_of_stars), 1)
+    return x, y, spatial_index.build_index(x, y, int(rng.integers(1, 12)))
+
+
+def _random_coordinate(rng, edges, values):
+    # A cell edge, a star's coordinate or any value, also outside the grid.
+    choice = rng.random()
+    if choice < 0.4:
+        return float(rng.choice(edges))
+    if choice < 0.7:
+        return float(rng.choice(values))
+    return rng.uniform(-5., 5.)
+
+
+def test_box_on_grid_edge():
+    x = y = np.array([0., .5, 1.])
+    index = spatial_index.build_index(x, y, cells_per_axis=2)
+    assert spatial_index.query_box(index, x, y, (1., 2.), (0., 2.)).tolist() == [2]
+    assert spatial_index.query_box(index, x, y, (-1., 0.), (-1., 0.)).tolist() == [0]
+    assert spatial_index.query_box(index, x, y, (1.5, 2.), (0., 2.)).tolist() == []
+
+
+def test_box_on_cell_edge():
+    # The cells' bounds must be the edges the stars were binned with.
+    x = np.array([-3.9, 3.3, 3.3])
+    y = np.array([-3., -0.9, 3.])
+    index = spatial_index.build_index(x, y, cells_per_axis=3)
+    rows = spatial_index.query_box(index, x, y, (0.8999999999999999, 3.2999999999999994),
+                                   (-3., 1.))
+    assert rows.tolist() == []
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_box_against_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(60):
+        x, y, index = _random_catalog(rng)
+        x_edges, y_edges = spatial_index._cell_edges(index)
+        for _ in range(10):
+            xlim = (_random_coordinate(rng, x_edges, x), _random_coordinate(rng, x_edges, x))
+            ylim = (_random_coordinate(rng, y_edges, y), _random_coordinate(rng, y_edges, y))
+            np.testing.assert_array_equal(spatial_index.query_box(index, x, y, xlim, ylim),
+                                          _brute_force_box(x, y, xlim, ylim))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_polygon_against_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(60):
+        x, y, index = _random_catalog(rng)
+        x_edges, y_edges = spatial_index._cell_edges(index)
+        for _ in range(10):
+            num_of_vertices = rng.integers(3, 7)
+            ring = np.array([(_random_coordinate(rng, x_edges, x),
+                              _random_coordinate(rng, y_edges, y))
+                             for _ in range(num_of_vertices)])
+            np.testing.assert_array_equal(
+                spatial_index.query_polygon(index, x, y, [ring]),
+                np.flatnonzero(spatial_index.points_in_polygon(x, y, [ring])))
+
+
+def test_saved_index_gives_same_rows(tmp_path):
+    rng = np.random.default_rng(0)
+    x, y, index = _random_catalog(rng)
+    spatial_index.save_index(str(tmp_path), index)
+    loaded = spatial_index.load_index(str(tmp_path))
+    xlim, ylim = (-1., 2.), (-2., 0.5)
+    np.testing.assert_array_equal(spatial_index.query_box(loaded, x, y, xlim, ylim),
+                                  _brute_force_box(x, y, xlim, ylim))
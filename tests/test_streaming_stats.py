@@ -0,0 +1,66 @@
+################################################################################
+#  The statistics of the age groups computed chunk by chunk (see
+#  streaming_stats.py), against NumPy on all the values at once.
+################################################################################
+
+import numpy as np
+import pytest
+
+import streaming_stats
+
+
+
+NUM_OF_GROUPS = 4
+
+
+def _grouped_values(num_of_values=10001, seed=0):
+    # Rounded values, so that there are ties; group 3 has no values.
+    rng = np.random.default_rng(seed)
+    values = np.round(rng.normal(-0.5, 0.4, num_of_values), 2)
+    group_of_star = rng.integers(0, NUM_OF_GROUPS - 1, num_of_values)
+    group_of_star[:2] = 0
+    return values, group_of_star
+
+
+# Few bins and candidates, so that the values are narrowed in several passes.
+@pytest.mark.parametrize('kwargs', [{}, {'num_of_bins': 4, 'max_candidates': 16}])
+def test_group_medians(kwargs):
+    values, group_of_star = _grouped_values()
+
+    def chunk_source():
+        return streaming_stats.iter_group_chunks(values, group_of_star, chunk_rows=1000)
+    medians = streaming_stats.group_medians(chunk_source, NUM_OF_GROUPS, **kwargs)
+
+    for group in range(NUM_OF_GROUPS - 1):
+        assert medians[group] == np.median(values[group_of_star == group])
+    assert np.isnan(medians[NUM_OF_GROUPS - 1])
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'num_of_bins': 4, 'max_candidates': 16}])
+def test_group_quantiles(kwargs):
+    values, group_of_star = _grouped_values()
+    quantiles = [0., 0.05, 0.25, 0.5, 0.9, 1.]
+
+    def chunk_source():
+        return streaming_stats.iter_group_chunks(values, group_of_star, chunk_rows=1000)
+    result = streaming_stats.group_quantiles(chunk_source, NUM_OF_GROUPS, quantiles,
+                                             **kwargs)
+
+    for group in range(NUM_OF_GROUPS - 1):
+        np.testing.assert_array_equal(
+            result[group], np.quantile(values[group_of_star == group], quantiles))
+    assert np.all(np.isnan(result[NUM_OF_GROUPS - 1]))
+
+
+def test_group_moments():
+    values, group_of_star = _grouped_values()
+    moments = streaming_stats.group_moments(
+        streaming_stats.iter_group_chunks(values, group_of_star, chunk_rows=1000),
+        NUM_OF_GROUPS)
+    for group in range(NUM_OF_GROUPS - 1):
+        group_values = values[group_of_star == group]
+        assert moments['count'][group] == group_values.size
+        assert moments['mean'][group] == pytest.approx(group_values.mean())
+        assert (streaming_stats.variance(moments)[group]
+                == pytest.approx(group_values.var()))
+    assert moments['count'][NUM_OF_GROUPS - 1] == 0
@@ -0,0 +1,56 @@
+################################################################################
+#  The zoomed views drawn from the tile pyramid (see tile_pyramid.py) must
+#  match the images drawn from the stars (see density.py).
+################################################################################
+
+import numpy as np
+import pytest
+
+import density
+import tile_pyramid
+
+
+
+AGE_BINS_EDGES = [0., 1., 3., 6., 13.5]
+
+
+@pytest.fixture(scope='module')
+def pyramid(tmp_path_factory):
+    # A small pyramid: the finest level has 4 * 2**2 = 16 cells per axis.
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0., 1., 50000)
+    y = rng.uniform(0., 1., 50000)
+    age = rng.uniform(0., 13.5, 50000)
+    tiles_dir = str(tmp_path_factory.mktemp('tiles'))
+    tile_pyramid.build_pyramid(tiles_dir, x, y, age, (0., 1.), (0., 1.), AGE_BINS_EDGES,
+                               num_of_levels=3, base_cells=4)
+    return (x, y, age), tile_pyramid.open_pyramid(tiles_dir)
+
+
+@pytest.mark.parametrize('mode', ['mean', 'majority'])
+def test_view_at_pixel_resolution(pyramid, mode):
+    # The whole grid, one pixel per cell of the finest level.
+    (x, y, age), tiles = pyramid
+    np.testing.assert_allclose(
+        tile_pyramid.render_view(tiles, (0., 1.), (0., 1.), (16, 16), mode),
+        density.rasterize_ages(x, y, age, (0., 1.), (0., 1.), (16, 16),
+                               AGE_BINS_EDGES, mode))
+
+
+@pytest.mark.parametrize('mode', ['mean', 'majority'])
+def test_deep_zoom(pyramid, mode):
+    # A view of 4 x 2 cells of the finest level on 12 x 8 pixels: each cell
+    # is painted over 3 x 4 pixels, the image of the stars at the cells'
+    # resolution scaled up.
+    (x, y, age), tiles = pyramid
+    xlim, ylim = (0.25, 0.5), (0.75, 0.625)
+    expected = density.rasterize_ages(x, y, age, xlim, ylim, (4, 2), AGE_BINS_EDGES, mode)
+    image = tile_pyramid.render_view(tiles, xlim, ylim, (12, 8), mode)
+    np.testing.assert_allclose(image, np.repeat(np.repeat(expected, 4, axis=0), 3, axis=1))
+
+
+def test_deep_zoom_has_no_gaps(pyramid):
+    # Every cell has stars: so has every pixel of a view within the cells.
+    (x, y, age), tiles = pyramid
+    image = tile_pyramid.render_view(tiles, (0.3012, 0.3391), (0.52, 0.5317), (360, 290))
+    assert np.isfinite(image).all()
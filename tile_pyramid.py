@@ -0,0 +1,331 @@
+################################################################################
+#  Here we build a multi-resolution "tile pyramid" of the colour-magnitude
+#  diagram, to draw zoomed views of figure 1 without going through the stars.
+#  Each level of the pyramid is a grid of cells over the diagram, level  z
+#  has  base_cells * 2**z  cells along each axis (each level halves the cells
+#  of the previous one, as in a quadtree). For each non empty cell we store
+#  the number of stars, the sum of their ages and the number of stars in each
+#  age bin (the 35 bins of the colormap).
+#  Only the non empty cells are stored, sorted by row (y) and column (x), so
+#  the cells inside a viewport are found with a binary search per row. The
+#  levels are saved in a directory next to the catalog (e.g.
+#  Nemo_6670.dat.tiles) as .npy files, which are memory-mapped when read.
+################################################################################
+
+
+
+import json
+import os
+
+import numpy as np
+
+import binning
+
+
+
+TILES_VERSION = 1
+TILES_SUFFIX = '.tiles'
+TILES_META_FILENAME = 'meta.json'
+
+# Cells along each axis of level 0, and number of levels: the finest level
+# has  64 * 2**6 = 4096  cells along each axis.
+DEFAULT_BASE_CELLS = 64
+DEFAULT_NUM_OF_LEVELS = 7
+
+# The arrays stored for each level:
+#   cells       index of the cell,  row * cells per axis + column
+#   cell_counts number of stars in the cell
+#   age_sums    sum of the ages of the stars in the cell
+#   bin_keys    cell * number of age bins + age bin
+#   bin_counts  number of stars in the cell and age bin
+LEVEL_ARRAYS = ('cells', 'cell_counts', 'age_sums', 'bin_keys', 'bin_counts')
+
+
+
+def default_tiles_dir(data_filename):
+    return data_filename + TILES_SUFFIX
+
+
+def _level_filename(tiles_dir, level, name):
+    return os.path.join(tiles_dir, 'level_{}_{}.npy'.format(level, name))
+
+
+def _reduce(keys, values):
+    # Sum the values with the same key, return the sorted unique keys and sums.
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    return unique_keys, np.bincount(inverse.ravel(), weights=values,
+                                    minlength=unique_keys.size)
+
+
+def _merge(level, keys, values):
+    # Add (keys, values) to the running sums  level  (a (keys, sums) pair).
+    if level is not None:
+        keys = np.concatenate((level[0], keys))
+        values = np.concatenate((level[1], values))
+    return _reduce(keys, values)
+
+
+def _age_bin_of_star(age, age_bins_edges):
+    # As the colormap does, ages outside the edges go to the first or last bin.
+    return np.clip(np.searchsorted(age_bins_edges, age, side='right') - 1,
+                   0, len(age_bins_edges) - 2)
+
+
+def _coarser(keys, cells_per_axis, num_of_age_bins=1):
+    # The keys of the parent cells (half the cells per axis).
+    cell, age_bin = np.divmod(keys, num_of_age_bins)
+    row, column = np.divmod(cell, cells_per_axis)
+    return ((row // 2) * (cells_per_axis // 2) + column // 2) * num_of_age_bins + age_bin
+
+
+
+
+################################################################################
+#  Building the pyramid.
+################################################################################
+
+def build_pyramid(tiles_dir, x, y, age, xlim, ylim, age_bins_edges,
+                  num_of_levels=DEFAULT_NUM_OF_LEVELS,
+                  base_cells=DEFAULT_BASE_CELLS,
+                  chunk_rows=binning.DEFAULT_CHUNK_ROWS, source=None):
+    """Build the pyramid of the stars (x, y, age) in the region  xlim x ylim
+    and save it in  tiles_dir . Stars outside the region are left out.
+
+    source  is anything JSON-like identifying the data (e.g. the hashes of
+    the columns), saved with the pyramid to tell if it is up to date.
+    """
+    os.makedirs(tiles_dir, exist_ok=True)
+    meta_filename = os.path.join(tiles_dir, TILES_META_FILENAME)
+    # The pyramid is invalid until the new meta file is written at the end.
+    try:
+        os.remove(meta_filename)
+    except FileNotFoundError:
+        pass
+
+    num_of_age_bins = len(age_bins_edges) - 1
+    finest = num_of_levels - 1
+    cells_per_axis = base_cells << finest
+    x_edges = binning.uniform_edges(min(xlim), max(xlim), cells_per_axis)
+    y_edges = binning.uniform_edges(min(ylim), max(ylim), cells_per_axis)
+
+    # The finest level, chunk by chunk.
+    cells = bins = None
+    for start in range(0, len(x), chunk_rows):
+        stop = start + chunk_rows
+        column = binning.bin_index(x[start:stop], x_edges)
+        row = binning.bin_index(y[start:stop], y_edges)
+        inside = (column >= 0) & (row >= 0)
+        cell = (row[inside].astype(np.int64) * cells_per_axis + column[inside])
+        chunk_age = np.asarray(age[start:stop])[inside]
+        cells = _merge(cells, cell, chunk_age)
+        bins = _merge(bins, cell * num_of_age_bins
+                      + _age_bin_of_star(chunk_age, age_bins_edges),
+                      np.ones(cell.size))
+    if cells is None:
+        cells = bins = (np.empty(0, dtype=np.int64), np.empty(0))
+    # The star counts per cell are the sums of the counts of its age bins.
+    cell_counts = _reduce(bins[0] // num_of_age_bins, bins[1])[1]
+
+    # The other levels, each from the finer one.
+    for level in range(finest, -1, -1):
+        arrays = {'cells': cells[0],
+                  'cell_counts': cell_counts.astype(np.int64),
+                  'age_sums': cells[1],
+                  'bin_keys': bins[0],
+                  'bin_counts': bins[1].astype(np.int64)}
+        for name in LEVEL_ARRAYS:
+            np.save(_level_filename(tiles_dir, level, name), arrays[name])
+
+        if level:
+            parent_cells = _coarser(cells[0], cells_per_axis)
+            cell_counts = _reduce(parent_cells, cell_counts)[1]
+            cells = _reduce(parent_cells, cells[1])
+            bins = _reduce(_coarser(bins[0], cells_per_axis, num_of_age_bins),
+                           bins[1])
+            cells_per_axis //= 2
+
+    with open(meta_filename + '.tmp', 'w') as meta_file:
+        json.dump({'version': TILES_VERSION,
+                   'xlim': [float(min(xlim)), float(max(xlim))],
+                   'ylim': [float(min(ylim)), float(max(ylim))],
+                   'age_bins_edges': [float(edge) for edge in age_bins_edges],
+                   'num_of_levels': num_of_levels,
+                   'base_cells': base_cells,
+                   'source': source}, meta_file, indent=2)
+    os.replace(meta_filename + '.tmp', meta_filename)
+
+
+def read_meta(tiles_dir):
+    try:
+        with open(os.path.join(tiles_dir, TILES_META_FILENAME)) as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_pyramid_valid(tiles_dir, xlim, ylim, age_bins_edges, source=None,
+                     num_of_levels=DEFAULT_NUM_OF_LEVELS,
+                     base_cells=DEFAULT_BASE_CELLS):
+    """Check that the pyramid was built from the same data with the same
+    parameters."""
+    meta = read_meta(tiles_dir)
+    return (meta is not None and meta['version'] == TILES_VERSION
+            and meta['xlim'] == [float(min(xlim)), float(max(xlim))]
+            and meta['ylim'] == [float(min(ylim)), float(max(ylim))]
+            and meta['age_bins_edges'] == [float(edge) for edge in age_bins_edges]
+            and meta['num_of_levels'] == num_of_levels
+            and meta['base_cells'] == base_cells
+            and meta['source'] == source)
+
+
+def open_pyramid(tiles_dir):
+    """Return the pyramid: its meta data and, for each level, a dict of the
+    memory-mapped arrays (see LEVEL_ARRAYS)."""
+    meta = read_meta(tiles_dir)
+    levels = []
+    for level in range(meta['num_of_levels']):
+        arrays = {}
+        for name in LEVEL_ARRAYS:
+            filename = _level_filename(tiles_dir, level, name)
+            # np.load() can't memory-map an empty array.
+            arrays[name] = (np.load(filename, mmap_mode='r')
+                            if os.path.getsize(filename) > 128 else np.load(filename))
+        levels.append(arrays)
+    return {'meta': meta, 'levels': levels}
+
+
+
+
+################################################################################
+#  Queries.
+################################################################################
+
+def _viewport_cells(meta, level, xlim, ylim):
+    # The range of rows and columns of the cells of  level  overlapping the
+    # viewport, and the number of cells per axis.
+    cells_per_axis = meta['base_cells'] << level
+    (x0, x1), (y0, y1) = meta['xlim'], meta['ylim']
+
+    def cell_range(lo, hi, start, stop):
+        first = int(np.floor((lo - start) / (stop - start) * cells_per_axis))
+        last = int(np.floor((hi - start) / (stop - start) * cells_per_axis))
+        return max(first, 0), min(last, cells_per_axis - 1)
+
+    return (cell_range(min(xlim), max(xlim), x0, x1),
+            cell_range(min(ylim), max(ylim), y0, y1), cells_per_axis)
+
+
+def query(pyramid, level, xlim, ylim, keys='cells'):
+    """Return the positions, in the arrays of  level , of the cells (or of the
+    (cell, age bin) pairs if  keys  is 'bin_keys') overlapping the viewport."""
+    meta = pyramid['meta']
+    (first_column, last_column), (first_row, last_row), cells_per_axis = \
+        _viewport_cells(meta, level, xlim, ylim)
+    if first_column > last_column or first_row > last_row:
+        return np.empty(0, dtype=np.intp)
+    multiplier = len(meta['age_bins_edges']) - 1 if keys == 'bin_keys' else 1
+
+    # A binary search for the first and the last cell of each row.
+    rows = np.arange(first_row, last_row + 1, dtype=np.int64)
+    sorted_keys = pyramid['levels'][level][keys]
+    starts = np.searchsorted(sorted_keys,
+                             (rows*cells_per_axis + first_column) * multiplier)
+    stops = np.searchsorted(sorted_keys,
+                            (rows*cells_per_axis + last_column + 1) * multiplier)
+
+    # The concatenation of the ranges  starts[i]:stops[i] .
+    lengths = stops - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def level_for_view(pyramid, xlim, ylim, shape):
+    """Return the coarsest level with at least one cell per pixel of an image
+    of  shape  (pixels along x, along y) of the viewport, or the finest one."""
+    meta = pyramid['meta']
+    (x0, x1), (y0, y1) = meta['xlim'], meta['ylim']
+    view = ((max(xlim) - min(xlim)) / (x1 - x0), (max(ylim) - min(ylim)) / (y1 - y0))
+    for level in range(meta['num_of_levels']):
+        cells_per_axis = meta['base_cells'] << level
+        if all(fraction * cells_per_axis >= pixels
+               for fraction, pixels in zip(view, shape)):
+            return level
+    return meta['num_of_levels'] - 1
+
+
+def render_view(pyramid, xlim, ylim, shape, mode='mean'):
+    """Return the image of the viewport as  density.rasterize_ages()  does
+    (rows along y, columns along x, NaN where there are no stars), computed
+    from the cells of the pyramid instead of the stars.
+
+    Cells smaller than the pixels go to the pixel containing their centre.
+    When the view is zoomed beyond the finest level the cells are larger than
+    the pixels: each cell is painted over the pixels whose centres it holds.
+    """
+    meta = pyramid['meta']
+    level = level_for_view(pyramid, xlim, ylim, shape)
+    arrays = pyramid['levels'][level]
+    cells_per_axis = meta['base_cells'] << level
+    num_of_age_bins = len(meta['age_bins_edges']) - 1
+    num_of_pixels = shape[0] * shape[1]
+
+    def pixel_range(index, grid_lim, lim, num_of_pixels):
+        # The first and last pixel (along one axis) covered by the cells
+        # index , first > last  for the cells covering no pixel.
+        cell_width = (grid_lim[1] - grid_lim[0]) / cells_per_axis
+        pixel_width = (max(lim) - min(lim)) / num_of_pixels
+        low = grid_lim[0] + index * cell_width
+        if cell_width <= pixel_width:
+            pixel = binning.bin_index(low + cell_width / 2,
+                                      binning.uniform_edges(min(lim), max(lim),
+                                                            num_of_pixels))
+            return np.where(pixel >= 0, pixel, 0), pixel
+        # The pixels with centre  min(lim) + (i + 0.5) * pixel_width  in
+        # [low, low + cell_width) .
+        first = np.ceil((low - min(lim)) / pixel_width - 0.5).astype(np.int64)
+        last = np.ceil((low + cell_width - min(lim)) / pixel_width - 0.5).astype(np.int64) - 1
+        return np.maximum(first, 0), np.minimum(last, num_of_pixels - 1)
+
+    def pixels_of_cells(cell):
+        # The pixels covered by each cell: the positions in  cell  and the
+        # pixels, one pair per (cell, pixel).
+        row, column = np.divmod(cell, cells_per_axis)
+        first_x, last_x = pixel_range(column, meta['xlim'], xlim, shape[0])
+        first_y, last_y = pixel_range(row, meta['ylim'], ylim, shape[1])
+        size_x = np.maximum(last_x - first_x + 1, 0)
+        size_y = np.maximum(last_y - first_y + 1, 0)
+        sizes = size_x * size_y
+        which = np.repeat(np.arange(len(cell)), sizes)
+        k = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        pixel_x = first_x[which] + k // size_y[which]
+        pixel_y = first_y[which] + k % size_y[which]
+        return which, pixel_x * shape[1] + pixel_y
+
+    if mode == 'mean':
+        selected = query(pyramid, level, xlim, ylim)
+        which, pixel = pixels_of_cells(np.asarray(arrays['cells'][selected]))
+        counts = np.bincount(pixel, minlength=num_of_pixels,
+                             weights=np.asarray(arrays['cell_counts'][selected])[which])
+        age_sums = np.bincount(pixel, minlength=num_of_pixels,
+                               weights=np.asarray(arrays['age_sums'][selected])[which])
+        with np.errstate(invalid='ignore'):
+            image = age_sums / counts
+
+    elif mode == 'majority':
+        selected = query(pyramid, level, xlim, ylim, keys='bin_keys')
+        cell, age_bin = np.divmod(np.asarray(arrays['bin_keys'][selected]),
+                                  num_of_age_bins)
+        which, pixel = pixels_of_cells(cell)
+        counts = np.bincount(pixel*num_of_age_bins + age_bin[which],
+                             weights=np.asarray(arrays['bin_counts'][selected])[which],
+                             minlength=num_of_pixels*num_of_age_bins
+                             ).reshape(num_of_pixels, num_of_age_bins)
+        age_bins_centres = binning.bin_centres(meta['age_bins_edges'])
+        image = np.where(counts.any(axis=1),
+                         age_bins_centres[counts.argmax(axis=1)], np.nan)
+
+    else:
+        raise ValueError('unknown render mode {!r}, expected mean or '
+                         'majority'.format(mode))
+
+    return image.reshape(shape).T